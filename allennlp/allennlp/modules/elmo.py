@@ -1,6 +1,7 @@
 import json
 import logging
-from typing import Union, List, Dict, Any
+from functools import lru_cache
+from typing import Union, List, Dict, Any, Tuple
 import warnings
 
 import torch
@@ -17,7 +18,7 @@ from allennlp.common.checks import ConfigurationError
 from allennlp.common import Params
 from allennlp.common.util import lazy_groups_of
 from allennlp.modules.elmo_lstm import ElmoLstm
-from allennlp.modules.elmo_lstm_oneward import ElmoLstm_Oneward
+from allennlp.modules.elmo_lstm_multiward import ElmoLstm_Multiward
 from allennlp.modules.highway import Highway
 from allennlp.modules.scalar_mix import ScalarMix
 from allennlp.nn.util import remove_sentence_boundaries, add_sentence_boundary_token_ids, get_device_of
@@ -232,6 +233,49 @@ def batch_to_ids(batch: List[List[str]]) -> torch.Tensor:
     return dataset.as_tensor_dict()['elmo']['character_ids']
 
 
+# The permuted versions of the omnidirectional models, after forward and backward, in
+# the order of their LSTMs and of their activations.
+_PERMUTE_VERSIONS = ['inward', 'outward', 'skip2forward', 'skip2backward', 'skip3forward', 'skip3backward']
+
+
+# The ``ELMoCharacterMapper`` characters of the tokens before and after each version of the
+# sentences.
+_BOUNDARY_CHARACTERS = {
+        'forward': ('beginning_of_sentence_characters', 'end_of_sentence_characters'),
+        'inward': ('middle_of_sentence_characters', 'side_of_sentence_characters'),
+        'outward': ('side_of_sentence_characters', 'middle_of_sentence_characters'),
+        'skip2forward': ('skip2start_characters', 'skip2end_characters'),
+        'skip2backward': ('skip2end_characters', 'skip2start_characters'),
+        'skip3forward': ('skip3start_characters', 'skip3end_characters'),
+        'skip3backward': ('skip3end_characters', 'skip3start_characters'),
+}
+
+# The ``_ElmoBiLm`` attributes of the cached embeddings of the boundary tokens.
+_CACHED_BOUNDARY_EMBEDDINGS = {
+        'beginning_of_sentence_characters': '_bos_embedding',
+        'end_of_sentence_characters': '_eos_embedding',
+        'middle_of_sentence_characters': '_mos_embedding',
+        'side_of_sentence_characters': '_sos_embedding',
+        'skip2start_characters': '_skip2start_embedding',
+        'skip2end_characters': '_skip2end_embedding',
+        'skip3start_characters': '_skip3start_embedding',
+        'skip3end_characters': '_skip3end_embedding',
+}
+
+
+def _boundary_token_names(permute_number: int) -> List[str]:
+    """
+    The ``ELMoCharacterMapper`` characters of the boundary tokens of a model reading the
+    forward version and the first ``permute_number - 2`` permuted versions of the sentences.
+    """
+    names: List[str] = []
+    for permute_version in ['forward'] + _PERMUTE_VERSIONS[:permute_number - 2]:
+        for name in _BOUNDARY_CHARACTERS[permute_version]:
+            if name not in names:
+                names.append(name)
+    return names
+
+
 class _ElmoCharacterEncoder(torch.nn.Module):
     """
     Compute context insensitive token representation using pretrained biLM.
@@ -288,31 +332,22 @@ class _ElmoCharacterEncoder(torch.nn.Module):
         self._load_weights()
         # load embedding calculation weights: same for every direction lstm
 
-        # Cache the arrays for use in forward -- +1 due to masking.
-        self._beginning_of_sentence_characters = torch.from_numpy(
-                numpy.array(ELMoCharacterMapper.beginning_of_sentence_characters) + 1
-        )
-        self._end_of_sentence_characters = torch.from_numpy(
-                numpy.array(ELMoCharacterMapper.end_of_sentence_characters) + 1
-        )
-        self._middle_of_sentence_characters = torch.from_numpy(
-            numpy.array(ELMoCharacterMapper.middle_of_sentence_characters) + 1
-        )
-        self._side_of_sentence_characters = torch.from_numpy(
-            numpy.array(ELMoCharacterMapper.side_of_sentence_characters) + 1
-        )
-        self._skip2start_characters = torch.from_numpy(
-            numpy.array(ELMoCharacterMapper.skip2start_characters) + 1
-        )
-        self._skip2end_characters = torch.from_numpy(
-            numpy.array(ELMoCharacterMapper.skip2end_characters) + 1
-        )
-        self._skip3start_characters = torch.from_numpy(
-            numpy.array(ELMoCharacterMapper.skip3start_characters) + 1
-        )
-        self._skip3end_characters = torch.from_numpy(
-            numpy.array(ELMoCharacterMapper.skip3end_characters) + 1
-        )
+        # Cache the arrays for use in forward -- +1 due to masking.  Only the boundary tokens
+        # of the versions of the sentences this model reads have characters in the model.
+        n_characters = self._char_embedding_weights.size(0)
+        self._boundary_characters = {}
+        for name in _boundary_token_names(self.permute_number):
+            characters = numpy.array(getattr(ELMoCharacterMapper, name)) + 1
+            if numpy.any(characters >= n_characters):
+                logger.warning("Characters of %s not in the model, using zeros", name)
+                characters = numpy.zeros_like(characters)
+            self._boundary_characters[name] = torch.from_numpy(characters)
+        # The boundary tokens only depend on the weights, so unless they are fine tuned
+        # their embeddings are computed once here rather than in every forward pass.
+        self._boundary_embeddings = None
+        if not requires_grad:
+            with torch.no_grad():
+                self._boundary_embeddings = self.embed_boundary_tokens()
 
     def get_output_dim(self):
         return self.output_dim
@@ -339,66 +374,22 @@ class _ElmoCharacterEncoder(torch.nn.Module):
         ``'mask'``:  ``torch.Tensor``
             Shape ``(batch_size, sequence_length + 2)`` long tensor with sequence mask.
         """
-        # Add BOS/EOS
+        # The embeddings of the tokens do not depend on their order or on the boundary
+        # tokens, so the permuted versions of the sentences share them (see
+        # ``embed_tokens`` and ``add_boundary_embeddings``).
         mask = ((inputs > 0).long().sum(dim=-1) > 0).long()
-        if permute_version == 'forward':   # bos, eos
-            character_ids_with_boundary, mask_with_boundary = add_sentence_boundary_token_ids(
-                    inputs,
-                    mask,
-                    self._beginning_of_sentence_characters,
-                    self._end_of_sentence_characters
-            )
-        elif permute_version == 'inward':  # <SI>, <MD>
-            character_ids_with_boundary, mask_with_boundary = add_sentence_boundary_token_ids(
-                inputs,
-                mask,
-                self._middle_of_sentence_characters,
-                self._side_of_sentence_characters
-            )
-        elif permute_version == 'outward':   # <MD>, <SI>
-            character_ids_with_boundary, mask_with_boundary = add_sentence_boundary_token_ids(
-                inputs,
-                mask,
-                self._side_of_sentence_characters,
-                self._middle_of_sentence_characters
-            )
-        elif permute_version == 'skip2forward':  # <S2S>, <S2E>
-            character_ids_with_boundary, mask_with_boundary = add_sentence_boundary_token_ids(
-                inputs,
-                mask,
-                self._skip2start_characters,
-                self._skip2end_characters
-            )
-        elif permute_version == 'skip2backward':  # <S2E>, <S2S>
-            character_ids_with_boundary, mask_with_boundary = add_sentence_boundary_token_ids(
-                inputs,
-                mask,
-                self._skip2end_characters,
-                self._skip2start_characters
-            )
-        elif permute_version == 'skip3forward':  # <S3S>, <S3E>
-            character_ids_with_boundary, mask_with_boundary = add_sentence_boundary_token_ids(
-                inputs,
-                mask,
-                self._skip3start_characters,
-                self._skip3end_characters
-            )
-        elif permute_version == 'skip3backward':   # <S3E>, <S3S>
-            character_ids_with_boundary, mask_with_boundary = add_sentence_boundary_token_ids(
-                inputs,
-                mask,
-                self._skip3end_characters,
-                self._skip3start_characters
-            )
-        else:
-            raise ValueError("Not implemented for other types.")
-
+        return self.add_boundary_embeddings(self.embed_tokens(inputs), mask, permute_version)
 
+    def embed_tokens(self, inputs: torch.Tensor) -> torch.Tensor:
+        """
+        Compute the token embeddings of character ids of shape ``(..., 50)``, without adding
+        boundary tokens.  Returns shape ``(..., embedding_dim)``.
+        """
         # the character id embedding
         max_chars_per_token = self._options['char_cnn']['max_characters_per_token']
         # (batch_size * sequence_length, max_chars_per_token, embed_dim)
         character_embedding = torch.nn.functional.embedding(
-                character_ids_with_boundary.view(-1, max_chars_per_token),
+                inputs.view(-1, max_chars_per_token),
                 self._char_embedding_weights
         )
 
@@ -432,13 +423,54 @@ class _ElmoCharacterEncoder(torch.nn.Module):
         token_embedding = self._projection(token_embedding)
 
         # reshape to (batch_size, sequence_length, embedding_dim)
-        batch_size, sequence_length, _ = character_ids_with_boundary.size()
+        return token_embedding.view(*inputs.size()[:-1], -1)
 
+    def add_boundary_embeddings(self,
+                                token_embedding: torch.Tensor,
+                                mask: torch.Tensor,
+                                permute_version: str = 'forward',
+                                boundary_embeddings: Dict[str, torch.Tensor] = None) -> Dict[str, torch.Tensor]:
+        """
+        Add the embeddings of the boundary tokens of ``permute_version`` to the token
+        embeddings of shape ``(batch_size, sequence_length, embedding_dim)`` with ``mask``
+        of shape ``(batch_size, sequence_length)``.  Returns the same dict as ``forward``.
+
+        ``boundary_embeddings`` are the embeddings to use for the boundary tokens, keyed by
+        their ``ELMoCharacterMapper`` characters (as returned by ``embed_boundary_tokens``).
+        By default they are computed from the weights.
+        """
+        if permute_version not in _BOUNDARY_CHARACTERS:
+            raise ValueError("Not implemented for other types.")
+        if any(name not in self._boundary_characters for name in _BOUNDARY_CHARACTERS[permute_version]):
+            raise ValueError("The model does not read the {} version.".format(permute_version))
+        if boundary_embeddings is None:
+            boundary_embeddings = self._boundary_embeddings
+        if boundary_embeddings is None:
+            boundary_embeddings = self.embed_boundary_tokens()
+        begin, end = _BOUNDARY_CHARACTERS[permute_version]
+        token_embedding_with_boundary, _ = add_sentence_boundary_token_ids(
+                token_embedding,
+                mask,
+                boundary_embeddings[begin].to(token_embedding.device),
+                boundary_embeddings[end].to(token_embedding.device)
+        )
+        _, mask_with_boundary = add_sentence_boundary_token_ids(mask, mask, 1, 1)
         return {
                 'mask': mask_with_boundary,
-                'token_embedding': token_embedding.view(batch_size, sequence_length, -1)
+                'token_embedding': token_embedding_with_boundary
         }
 
+    def embed_boundary_tokens(self) -> Dict[str, torch.Tensor]:
+        """
+        The embeddings of the boundary tokens of the versions of the sentences the model
+        reads, computed in one batch and keyed by their ``ELMoCharacterMapper`` characters.
+        """
+        names = list(self._boundary_characters)
+        character_ids = torch.stack([self._boundary_characters[name] for name in names])
+        character_ids = character_ids.to(self._char_embedding_weights.device)
+        embeddings = self.embed_tokens(character_ids)
+        return {name: embedding for name, embedding in zip(names, embeddings)}
+
     def _load_weights(self):
         self._load_char_embedding()
         self._load_cnn_weights()
@@ -536,6 +568,50 @@ class _ElmoCharacterEncoder(torch.nn.Module):
             self._projection.bias.requires_grad = self.requires_grad
 
 
+@lru_cache(maxsize=None)
+def _permutation(permute_version: str, length: int) -> numpy.ndarray:
+    """
+    The positions of the tokens of a sentence of ``length`` tokens, in the order the
+    ``permute_version`` LSTM reads them.
+    """
+    if permute_version == 'inward':
+        # first, last, second, second to last, ...
+        order = [k // 2 if k % 2 == 0 else length - 1 - k // 2 for k in range(length)]
+    elif permute_version == 'outward':
+        # from the middle of the sentence out, right first
+        order = [length // 2 + k // 2 if k % 2 == 0 else length // 2 - 1 - k // 2 for k in range(length)]
+    elif permute_version in ('skip2forward', 'skip3forward'):
+        skip = int(permute_version[4])
+        order = [i for start in range(skip) for i in range(start, length, skip)]
+    elif permute_version in ('skip2backward', 'skip3backward'):
+        skip = int(permute_version[4])
+        order = [length - 1 - i for start in range(skip) for i in range(start, length, skip)]
+    else:
+        raise ConfigurationError('Unknown permute version: {}'.format(permute_version))
+    return numpy.array(order, dtype=numpy.int64)
+
+
+def _permutation_indices(permute_version: str,
+                         sequence_lengths: numpy.ndarray,
+                         timesteps: int) -> Tuple[torch.LongTensor, torch.LongTensor]:
+    """
+    Returns ``(permute_indices, restore_indices)`` for a batch of sentences with
+    ``sequence_lengths``.  ``permute_indices`` has shape ``(batch_size, timesteps)`` and
+    gathers the permuted sentences from the inputs.  ``restore_indices`` has shape
+    ``(batch_size, timesteps + 2)`` and gathers the tokens of the permuted sentences, with
+    their boundary tokens, back into the order of the sentences.  The padding positions,
+    and in ``restore_indices`` the boundary positions, index themselves.
+    """
+    batch_size = len(sequence_lengths)
+    permute_indices = numpy.tile(numpy.arange(timesteps, dtype=numpy.int64), (batch_size, 1))
+    restore_indices = numpy.tile(numpy.arange(timesteps + 2, dtype=numpy.int64), (batch_size, 1))
+    for index, length in enumerate(sequence_lengths):
+        order = _permutation(permute_version, int(length))
+        permute_indices[index, :length] = order
+        restore_indices[index, order + 1] = numpy.arange(1, length + 1)
+    return torch.from_numpy(permute_indices), torch.from_numpy(restore_indices)
+
+
 class _ElmoBiLm(torch.nn.Module):
     """
     Run a pre-trained bidirectional language model, outputing the activations at each
@@ -586,7 +662,7 @@ class _ElmoBiLm(torch.nn.Module):
         self._skip3end_embedding: torch.Tensor = None
         if vocab_to_cache:  # false
             logging.info("Caching character cnn layers for words in vocabulary.")
-            # This sets 3 attributes, _word_embedding, _bos_embedding and _eos_embedding.
+            # This sets _word_embedding and the embeddings of the 8 boundary tokens.
             # They are set in the method so they can be accessed from outside the
             # constructor.
             self.create_cached_cnn_embeddings(vocab_to_cache)
@@ -598,151 +674,35 @@ class _ElmoBiLm(torch.nn.Module):
         permute_number = options.get('permute_number', 2)
         print('!!!Permute Number: %i' % permute_number)
         self.permute_number = permute_number
-        if permute_number == 2:
-            self._elmo_lstm = ElmoLstm(input_size=options['lstm']['projection_dim'],
-                                       hidden_size=options['lstm']['projection_dim'],
-                                       cell_size=options['lstm']['dim'],
-                                       num_layers=options['lstm']['n_layers'],
-                                       memory_cell_clip_value=options['lstm']['cell_clip'],
-                                       state_projection_clip_value=options['lstm']['proj_clip'],
-                                       requires_grad=requires_grad)
-            self._elmo_lstm.load_weights(weight_file)
-        elif permute_number == 4:
-            self._elmo_lstm = ElmoLstm(input_size=options['lstm']['projection_dim'],
-                                       hidden_size=options['lstm']['projection_dim'],
-                                       cell_size=options['lstm']['dim'],
-                                       num_layers=options['lstm']['n_layers'],
-                                       memory_cell_clip_value=options['lstm']['cell_clip'],
-                                       state_projection_clip_value=options['lstm']['proj_clip'],
-                                       requires_grad=requires_grad)
-            self._elmo_lstm_inward = ElmoLstm_Oneward(input_size=options['lstm']['projection_dim'],
-                                         hidden_size=options['lstm']['projection_dim'],
-                                         cell_size=options['lstm']['dim'],
-                                         num_layers=options['lstm']['n_layers'],
-                                         memory_cell_clip_value=options['lstm']['cell_clip'],
-                                         state_projection_clip_value=options['lstm']['proj_clip'],
-                                         requires_grad=requires_grad)
-            self._elmo_lstm_outward = ElmoLstm_Oneward(input_size=options['lstm']['projection_dim'],
-                                                     hidden_size=options['lstm']['projection_dim'],
-                                                     cell_size=options['lstm']['dim'],
-                                                     num_layers=options['lstm']['n_layers'],
-                                                     memory_cell_clip_value=options['lstm']['cell_clip'],
-                                                     state_projection_clip_value=options['lstm']['proj_clip'],
-                                                     requires_grad=requires_grad)
-            self._elmo_lstm.load_weights(weight_file)
-            self._elmo_lstm_inward.load_weights(weight_file, permute_version_id=3)
-            self._elmo_lstm_outward.load_weights(weight_file, permute_version_id=4)
-        elif permute_number == 6:
-            self._elmo_lstm = ElmoLstm(input_size=options['lstm']['projection_dim'],
-                                       hidden_size=options['lstm']['projection_dim'],
-                                       cell_size=options['lstm']['dim'],
-                                       num_layers=options['lstm']['n_layers'],
-                                       memory_cell_clip_value=options['lstm']['cell_clip'],
-                                       state_projection_clip_value=options['lstm']['proj_clip'],
-                                       requires_grad=requires_grad)
-            self._elmo_lstm_inward = ElmoLstm_Oneward(input_size=options['lstm']['projection_dim'],
-                                                      hidden_size=options['lstm']['projection_dim'],
-                                                      cell_size=options['lstm']['dim'],
-                                                      num_layers=options['lstm']['n_layers'],
-                                                      memory_cell_clip_value=options['lstm']['cell_clip'],
-                                                      state_projection_clip_value=options['lstm']['proj_clip'],
-                                                      requires_grad=requires_grad)
-            self._elmo_lstm_outward = ElmoLstm_Oneward(input_size=options['lstm']['projection_dim'],
-                                                       hidden_size=options['lstm']['projection_dim'],
-                                                       cell_size=options['lstm']['dim'],
-                                                       num_layers=options['lstm']['n_layers'],
-                                                       memory_cell_clip_value=options['lstm']['cell_clip'],
-                                                       state_projection_clip_value=options['lstm']['proj_clip'],
-                                                       requires_grad=requires_grad)
-            self._elmo_lstm_skip2forward = ElmoLstm_Oneward(input_size=options['lstm']['projection_dim'],
-                                                            hidden_size=options['lstm']['projection_dim'],
-                                                            cell_size=options['lstm']['dim'],
-                                                            num_layers=options['lstm']['n_layers'],
-                                                            memory_cell_clip_value=options['lstm']['cell_clip'],
-                                                            state_projection_clip_value=options['lstm']['proj_clip'],
-                                                            requires_grad=requires_grad)
-            self._elmo_lstm_skip2backward = ElmoLstm_Oneward(input_size=options['lstm']['projection_dim'],
-                                                             hidden_size=options['lstm']['projection_dim'],
-                                                             cell_size=options['lstm']['dim'],
-                                                             num_layers=options['lstm']['n_layers'],
-                                                             memory_cell_clip_value=options['lstm']['cell_clip'],
-                                                             state_projection_clip_value=options['lstm']['proj_clip'],
-                                                             requires_grad=requires_grad)
-            self._elmo_lstm.load_weights(weight_file)
-            self._elmo_lstm_inward.load_weights(weight_file, permute_version_id=3)
-            self._elmo_lstm_outward.load_weights(weight_file, permute_version_id=4)
-            self._elmo_lstm_skip2forward.load_weights(weight_file, permute_version_id=5)
-            self._elmo_lstm_skip2backward.load_weights(weight_file, permute_version_id=6)
-        elif permute_number == 8:
-            self._elmo_lstm = ElmoLstm(input_size=options['lstm']['projection_dim'],
-                                       hidden_size=options['lstm']['projection_dim'],
-                                       cell_size=options['lstm']['dim'],
-                                       num_layers=options['lstm']['n_layers'],
-                                       memory_cell_clip_value=options['lstm']['cell_clip'],
-                                       state_projection_clip_value=options['lstm']['proj_clip'],
-                                       requires_grad=requires_grad)
-            self._elmo_lstm_inward = ElmoLstm_Oneward(input_size=options['lstm']['projection_dim'],
-                                                      hidden_size=options['lstm']['projection_dim'],
-                                                      cell_size=options['lstm']['dim'],
-                                                      num_layers=options['lstm']['n_layers'],
-                                                      memory_cell_clip_value=options['lstm']['cell_clip'],
-                                                      state_projection_clip_value=options['lstm']['proj_clip'],
-                                                      requires_grad=requires_grad)
-            self._elmo_lstm_outward = ElmoLstm_Oneward(input_size=options['lstm']['projection_dim'],
-                                                       hidden_size=options['lstm']['projection_dim'],
-                                                       cell_size=options['lstm']['dim'],
-                                                       num_layers=options['lstm']['n_layers'],
-                                                       memory_cell_clip_value=options['lstm']['cell_clip'],
-                                                       state_projection_clip_value=options['lstm']['proj_clip'],
-                                                       requires_grad=requires_grad)
-            self._elmo_lstm_skip2forward = ElmoLstm_Oneward(input_size=options['lstm']['projection_dim'],
-                                                            hidden_size=options['lstm']['projection_dim'],
-                                                            cell_size=options['lstm']['dim'],
-                                                            num_layers=options['lstm']['n_layers'],
-                                                            memory_cell_clip_value=options['lstm']['cell_clip'],
-                                                            state_projection_clip_value=options['lstm']['proj_clip'],
-                                                            requires_grad=requires_grad)
-            self._elmo_lstm_skip2backward = ElmoLstm_Oneward(input_size=options['lstm']['projection_dim'],
-                                                             hidden_size=options['lstm']['projection_dim'],
-                                                             cell_size=options['lstm']['dim'],
-                                                             num_layers=options['lstm']['n_layers'],
-                                                             memory_cell_clip_value=options['lstm']['cell_clip'],
-                                                             state_projection_clip_value=options['lstm']['proj_clip'],
-                                                             requires_grad=requires_grad)
-            self._elmo_lstm_skip3forward = ElmoLstm_Oneward(input_size=options['lstm']['projection_dim'],
-                                                            hidden_size=options['lstm']['projection_dim'],
-                                                            cell_size=options['lstm']['dim'],
-                                                            num_layers=options['lstm']['n_layers'],
-                                                            memory_cell_clip_value=options['lstm']['cell_clip'],
-                                                            state_projection_clip_value=options['lstm']['proj_clip'],
-                                                            requires_grad=requires_grad)
-            self._elmo_lstm_skip3backward = ElmoLstm_Oneward(input_size=options['lstm']['projection_dim'],
-                                                            hidden_size=options['lstm']['projection_dim'],
-                                                            cell_size=options['lstm']['dim'],
-                                                            num_layers=options['lstm']['n_layers'],
-                                                            memory_cell_clip_value=options['lstm']['cell_clip'],
-                                                            state_projection_clip_value=options['lstm']['proj_clip'],
-                                                            requires_grad=requires_grad)
-            self._elmo_lstm.load_weights(weight_file)
-            self._elmo_lstm_inward.load_weights(weight_file, permute_version_id=3)  # load specific lstm weights
-            self._elmo_lstm_outward.load_weights(weight_file, permute_version_id=4)
-            self._elmo_lstm_skip2forward.load_weights(weight_file, permute_version_id=5)
-            self._elmo_lstm_skip2backward.load_weights(weight_file, permute_version_id=6)
-            self._elmo_lstm_skip3forward.load_weights(weight_file, permute_version_id=7)
-            self._elmo_lstm_skip3backward.load_weights(weight_file, permute_version_id=8)
+        if permute_number not in (2, 4, 6, 8):
+            raise ConfigurationError('permute_number must be 2, 4, 6 or 8, got {}'.format(permute_number))
+        self._permute_versions = _PERMUTE_VERSIONS[:permute_number - 2]
+        self._elmo_lstm = ElmoLstm(input_size=options['lstm']['projection_dim'],
+                                   hidden_size=options['lstm']['projection_dim'],
+                                   cell_size=options['lstm']['dim'],
+                                   num_layers=options['lstm']['n_layers'],
+                                   memory_cell_clip_value=options['lstm']['cell_clip'],
+                                   state_projection_clip_value=options['lstm']['proj_clip'],
+                                   requires_grad=requires_grad)
+        self._elmo_lstm.load_weights(weight_file)
+        if self._permute_versions:
+            # The LSTMs of the permuted versions run together; their weights are those of
+            # RNN_2, RNN_3, ... in the weight file.
+            self._elmo_lstm_permuted = ElmoLstm_Multiward(num_directions=len(self._permute_versions),
+                                                          input_size=options['lstm']['projection_dim'],
+                                                          hidden_size=options['lstm']['projection_dim'],
+                                                          cell_size=options['lstm']['dim'],
+                                                          num_layers=options['lstm']['n_layers'],
+                                                          memory_cell_clip_value=options['lstm']['cell_clip'],
+                                                          state_projection_clip_value=options['lstm']['proj_clip'],
+                                                          requires_grad=requires_grad)
+            self._elmo_lstm_permuted.load_weights(
+                    weight_file, permute_version_ids=list(range(3, len(self._permute_versions) + 3)))
         # Number of representation layers including context independent layer
         self.num_layers = options['lstm']['n_layers'] + 1
 
     def get_output_dim(self):
-        if self.permute_number == 2:
-            return 2 * self._token_embedder.get_output_dim()
-        elif self.permute_number == 4:
-            return 4 * self._token_embedder.get_output_dim()
-        elif self.permute_number == 6:
-            return 6 * self._token_embedder.get_output_dim()
-        elif self.permute_number == 8:
-            return 8 * self._token_embedder.get_output_dim()
-        # bidirectional lstm
+        return self.permute_number * self._token_embedder.get_output_dim()
 
     def forward(self,  # pylint: disable=arguments-differ
                 inputs: torch.Tensor,
@@ -770,431 +730,70 @@ class _ElmoBiLm(torch.nn.Module):
         markers.
         """
         input_mask = ((inputs > 0).long().sum(dim=-1) > 0).long()
-        sequence_lengths = input_mask.sum(dim=1).detach().cpu().numpy()
+        boundary_embeddings = None
 
         if self._word_embedding is not None and word_inputs is not None:
             try:
                 mask_without_bos_eos = (word_inputs > 0).long()
-                # The character cnn part is cached - just look it up.
+                # The character cnn part is cached - just look it up, along with the
+                # boundary tokens of every version of the sentences.
                 embedded_inputs = self._word_embedding(word_inputs) # type: ignore
-                # shape (batch_size, timesteps + 2, embedding_dim)
-                type_representation, mask = add_sentence_boundary_token_ids(
-                        embedded_inputs,
-                        mask_without_bos_eos,
-                        self._bos_embedding,
-                        self._eos_embedding
-                )
+                input_mask = mask_without_bos_eos
+                boundary_embeddings = {name: getattr(self, _CACHED_BOUNDARY_EMBEDDINGS[name])
+                                       for name in _boundary_token_names(self.permute_number)}
             except RuntimeError:
                 # Back off to running the character convolutions,
                 # as we might not have the words in the cache.
-                token_embedding = self._token_embedder(inputs)
-                mask = token_embedding['mask']
-                type_representation = token_embedding['token_embedding']
+                embedded_inputs = self._token_embedder.embed_tokens(inputs)
         else:
-            if self.permute_number == 2:
-                token_embedding = self._token_embedder(inputs)  # bxs->bx(s+2); add boundary tokens
-                mask = token_embedding['mask']
-                type_representation = token_embedding['token_embedding']
-            elif self.permute_number == 4:
-                token_embedding = self._token_embedder(inputs)
-                mask = token_embedding['mask']
-                type_representation = token_embedding['token_embedding']
-                # Inward embedding calculation
-                inward_inputs = inputs.new_zeros(inputs.shape)
-                for index, len_index in enumerate(sequence_lengths):
-                    i = 0
-                    j = len_index - 1
-                    for k in range(0, len_index):
-                        if k % 2 == 0:
-                            inward_inputs[index, k, :] = inputs[index, i, :]
-                            i += 1
-                        else:
-                            inward_inputs[index, k, :] = inputs[index, j, :]
-                            j -= 1
-                inward_token_embedding = self._token_embedder(inward_inputs, permute_version='inward')  # add boundary
-                inward_representation = inward_token_embedding['token_embedding']
-                # Outward embedding calculation
-                outward_inputs = inputs.new_zeros(inputs.shape)
-                for index, len_index in enumerate(sequence_lengths):
-                    j = int(len_index / 2)
-                    i = int(len_index / 2) - 1
-                    for k in range(0, len_index):
-                        if k % 2 == 0:
-                            outward_inputs[index, k, :] = inputs[index, j, :]
-                            j += 1
-                        else:
-                            outward_inputs[index, k, :] = inputs[index, i, :]
-                            i -= 1
-                outward_token_embedding = self._token_embedder(outward_inputs, permute_version='outward')  # add boundary
-                outward_representation = outward_token_embedding['token_embedding']
-            elif self.permute_number == 6:
-                token_embedding = self._token_embedder(inputs)
-                mask = token_embedding['mask']
-                type_representation = token_embedding['token_embedding']
-                # Inward embedding calculation
-                inward_inputs = inputs.new_zeros(inputs.shape)
-                for index, len_index in enumerate(sequence_lengths):
-                    i = 0
-                    j = len_index - 1
-                    for k in range(0, len_index):
-                        if k % 2 == 0:
-                            inward_inputs[index, k, :] = inputs[index, i, :]
-                            i += 1
-                        else:
-                            inward_inputs[index, k, :] = inputs[index, j, :]
-                            j -= 1
-                inward_token_embedding = self._token_embedder(inward_inputs, permute_version='inward')  # add boundary
-                inward_representation = inward_token_embedding['token_embedding']
-                # Outward embedding calculation
-                outward_inputs = inputs.new_zeros(inputs.shape)
-                for index, len_index in enumerate(sequence_lengths):
-                    j = int(len_index / 2)
-                    i = int(len_index / 2) - 1
-                    for k in range(0, len_index):
-                        if k % 2 == 0:
-                            outward_inputs[index, k, :] = inputs[index, j, :]
-                            j += 1
-                        else:
-                            outward_inputs[index, k, :] = inputs[index, i, :]
-                            i -= 1
-                outward_token_embedding = self._token_embedder(outward_inputs, permute_version='outward')  # add boundary
-                outward_representation = outward_token_embedding['token_embedding']
-                # Skip2forward embedding calculation
-                skip2forward_inputs = inputs.new_zeros(inputs.shape)
-                for index, len_index in enumerate(sequence_lengths):
-                    k = 0
-                    for i in range(0, len_index, 2):
-                        skip2forward_inputs[index, k, :] = inputs[index, i, :]
-                        k += 1
-                    for j in range(1, len_index, 2):
-                        skip2forward_inputs[index, k, :] = inputs[index, j, :]
-                        k += 1
-                skip2forward_token_embedding = self._token_embedder(skip2forward_inputs, permute_version='skip2forward')  # add boundary
-                skip2forward_representation = skip2forward_token_embedding['token_embedding']
-                # Skip2back embedding calculation
-                skip2backward_inputs = inputs.new_zeros(inputs.shape)
-                for index, len_index in enumerate(sequence_lengths):
-                    k = 0
-                    for i in range(len_index - 1, -1, -2):
-                        skip2backward_inputs[index, k, :] = inputs[index, i, :]
-                        k += 1
-                    for j in range(len_index - 2, -1, -2):
-                        skip2backward_inputs[index, k, :] = inputs[index, j, :]
-                        k += 1
-                skip2backward_token_embedding = self._token_embedder(skip2backward_inputs, permute_version='skip2backward')  # add boundary
-                skip2backward_representation = skip2backward_token_embedding['token_embedding']
-            elif self.permute_number == 8:
-                token_embedding = self._token_embedder(inputs)
-                mask = token_embedding['mask']
-                type_representation = token_embedding['token_embedding']
-                # Inward embedding calculation
-                inward_inputs = inputs.new_zeros(inputs.shape)
-                for index, len_index in enumerate(sequence_lengths):
-                    i = 0
-                    j = len_index - 1
-                    for k in range(0, len_index):
-                        if k % 2 == 0:
-                            inward_inputs[index, k, :] = inputs[index, i, :]
-                            i += 1
-                        else:
-                            inward_inputs[index, k, :] = inputs[index, j, :]
-                            j -= 1
-                inward_token_embedding = self._token_embedder(inward_inputs, permute_version='inward')  # add boundary
-                inward_representation = inward_token_embedding['token_embedding']
-                # Outward embedding calculation
-                outward_inputs = inputs.new_zeros(inputs.shape)
-                for index, len_index in enumerate(sequence_lengths):
-                    j = int(len_index / 2)
-                    i = int(len_index / 2) - 1
-                    for k in range(0, len_index):
-                        if k % 2 == 0:
-                            outward_inputs[index, k, :] = inputs[index, j, :]
-                            j += 1
-                        else:
-                            outward_inputs[index, k, :] = inputs[index, i, :]
-                            i -= 1
-                outward_token_embedding = self._token_embedder(outward_inputs, permute_version='outward')  # add boundary
-                outward_representation = outward_token_embedding['token_embedding']
-                # Skip2forward embedding calculation
-                skip2forward_inputs = inputs.new_zeros(inputs.shape)
-                for index, len_index in enumerate(sequence_lengths):
-                    k = 0
-                    for i in range(0, len_index, 2):
-                        skip2forward_inputs[index, k, :] = inputs[index, i, :]
-                        k += 1
-                    for j in range(1, len_index, 2):
-                        skip2forward_inputs[index, k, :] = inputs[index, j, :]
-                        k += 1
-                skip2forward_token_embedding = self._token_embedder(skip2forward_inputs, permute_version='skip2forward') # add boundary
-                skip2forward_representation = skip2forward_token_embedding['token_embedding']
-                # Skip2back embedding calculation
-                skip2backward_inputs = inputs.new_zeros(inputs.shape)
-                for index, len_index in enumerate(sequence_lengths):
-                    k = 0
-                    for i in range(len_index - 1, -1, -2):
-                        skip2backward_inputs[index, k, :] = inputs[index, i, :]
-                        k += 1
-                    for j in range(len_index - 2, -1, -2):
-                        skip2backward_inputs[index, k, :] = inputs[index, j, :]
-                        k += 1
-                skip2backward_token_embedding = self._token_embedder(skip2backward_inputs, permute_version='skip2backward') # add boundary
-                skip2backward_representation = skip2backward_token_embedding['token_embedding']
-                # Skip3forward embedding calculation
-                skip3forward_inputs = inputs.new_zeros(inputs.shape)
-                for index, len_index in enumerate(sequence_lengths):
-                    k = 0
-                    for i in range(0, len_index, 3):
-                        skip3forward_inputs[index, k, :] = inputs[index, i, :]
-                        k += 1
-                    for j in range(1, len_index, 3):
-                        skip3forward_inputs[index, k, :] = inputs[index, j, :]
-                        k += 1
-                    for m in range(2, len_index, 3):
-                        skip3forward_inputs[index, k, :] = inputs[index, m, :]
-                        k += 1
-                skip3forward_token_embedding = self._token_embedder(skip3forward_inputs, permute_version='skip3forward') # add boundary
-                skip3forward_representation = skip3forward_token_embedding['token_embedding']
-                # Skip3backward embedding calculation
-                skip3backward_inputs = inputs.new_zeros(inputs.shape)
-                for index, len_index in enumerate(sequence_lengths):
-                    k = 0
-                    for i in range(len_index - 1, -1, -3):
-                        skip3backward_inputs[index, k, :] = inputs[index, i, :]
-                        k += 1
-                    for j in range(len_index - 2, -1, -3):
-                        skip3backward_inputs[index, k, :] = inputs[index, j, :]
-                        k += 1
-                    for m in range(len_index - 3, -1, -3):
-                        skip3backward_inputs[index, k, :] = inputs[index, m, :]
-                        k += 1
-                skip3backward_token_embedding = self._token_embedder(skip3backward_inputs, permute_version='skip3backward') # add boundary
-                skip3backward_representation = skip3backward_token_embedding['token_embedding']
-        if self.permute_number == 2:
-            lstm_outputs = self._elmo_lstm(type_representation, mask)
-            output_tensors = [
-                torch.cat([type_representation, type_representation], dim=-1) * mask.float().unsqueeze(-1)
-            ]  # The default value of self.permute_number is 2
-            lstm_outputs_concat = lstm_outputs
-        elif self.permute_number == 4:
-            lstm_outputs = self._elmo_lstm(type_representation, mask)
-            lstm_inward_outputs = self._elmo_lstm_inward(inward_representation, mask)
-            lstm_outward_outputs = self._elmo_lstm_outward(outward_representation, mask)
-            # Transpose the representation and lstm_outputs; skip the two boundary token
-            inward_type_representation = inward_representation.new_zeros(inward_representation.shape)
-            outward_type_representation = outward_representation.new_zeros(outward_representation.shape)
-            lstm_inward_outputs_trans = lstm_inward_outputs.new_zeros(lstm_inward_outputs.shape)
-            lstm_outward_outputs_trans = lstm_outward_outputs.new_zeros(lstm_outward_outputs.shape)
-            for index, len_index in enumerate(sequence_lengths):
-                i = 1   # skip the first token
-                j = len_index
-                for k in range(1, len_index+1):  # skip the first token
-                    if k % 2 == 1:
-                        inward_type_representation[index, i, :] = inward_representation[index, k, :]
-                        lstm_inward_outputs_trans[:, index, i, :] = lstm_inward_outputs[:, index, k, :]
-                        i += 1
-                    else:
-                        inward_type_representation[index, j, :] = inward_representation[index, k, :]
-                        lstm_inward_outputs_trans[:, index, j, :] = lstm_inward_outputs[:, index, k, :]
-                        j -= 1
-            for index, len_index in enumerate(sequence_lengths):
-                j = int(len_index/2) + 1
-                i = int(len_index/2)
-                for k in range(1, len_index + 1):
-                    if k % 2 == 1:
-                        outward_type_representation[index, j, :] = outward_representation[index, k, :]
-                        lstm_outward_outputs_trans[:, index, j, :] = lstm_outward_outputs[:, index, k, :]
-                        j += 1
-                    else:
-                        outward_type_representation[index, i, :] = outward_representation[index, k, :]
-                        lstm_outward_outputs_trans[:, index, i, :] = lstm_outward_outputs[:, index, k, :]
-                        i -= 1
-            output_tensors = [
-                torch.cat([type_representation, type_representation, inward_type_representation, outward_type_representation], dim=-1) * mask.float().unsqueeze(-1)
-            ]
-            # concat lstm outputs
-            lstm_outputs_concat = torch.cat([lstm_outputs, lstm_inward_outputs_trans, lstm_outward_outputs_trans], dim=-1)
-        elif self.permute_number == 6:
-            lstm_outputs = self._elmo_lstm(type_representation, mask)
-            lstm_inward_outputs = self._elmo_lstm_inward(inward_representation, mask)
-            lstm_outward_outputs = self._elmo_lstm_outward(outward_representation, mask)
-            lstm_skip2forward_outputs = self._elmo_lstm_skip2forward(skip2forward_representation, mask)
-            lstm_skip2backward_outputs = self._elmo_lstm_skip2backward(skip2backward_representation, mask)
-            # Transpose the representation and lstm_outputs; skip the two boundary token
-            inward_type_representation = inward_representation.new_zeros(inward_representation.shape)
-            outward_type_representation = outward_representation.new_zeros(outward_representation.shape)
-            skip2forward_type_representation = skip2forward_representation.new_zeros(skip2forward_representation.shape)
-            skip2backward_type_representation = skip2backward_representation.new_zeros(skip2backward_representation.shape)
-            lstm_inward_outputs_trans = lstm_inward_outputs.new_zeros(lstm_inward_outputs.shape)
-            lstm_outward_outputs_trans = lstm_outward_outputs.new_zeros(lstm_outward_outputs.shape)
-            lstm_skip2forward_outputs_trans = lstm_skip2forward_outputs.new_zeros(lstm_skip2forward_outputs.shape)
-            lstm_skip2backward_outputs_trans = lstm_skip2backward_outputs.new_zeros(lstm_skip2backward_outputs.shape)
-            for index, len_index in enumerate(sequence_lengths):
-                i = 1  # skip the first token
-                j = len_index
-                for k in range(1, len_index + 1):  # skip the first token
-                    if k % 2 == 1:
-                        inward_type_representation[index, i, :] = inward_representation[index, k, :]
-                        lstm_inward_outputs_trans[:, index, i, :] = lstm_inward_outputs[:, index, k, :]
-                        i += 1
-                    else:
-                        inward_type_representation[index, j, :] = inward_representation[index, k, :]
-                        lstm_inward_outputs_trans[:, index, j, :] = lstm_inward_outputs[:, index, k, :]
-                        j -= 1
-            for index, len_index in enumerate(sequence_lengths):
-                j = int(len_index / 2) + 1
-                i = int(len_index / 2)
-                for k in range(1, len_index + 1):
-                    if k % 2 == 1:
-                        outward_type_representation[index, j, :] = outward_representation[index, k, :]
-                        lstm_outward_outputs_trans[:, index, j, :] = lstm_outward_outputs[:, index, k, :]
-                        j += 1
-                    else:
-                        outward_type_representation[index, i, :] = outward_representation[index, k, :]
-                        lstm_outward_outputs_trans[:, index, i, :] = lstm_outward_outputs[:, index, k, :]
-                        i -= 1
-            # Transpose skip2forward
-            for index, len_index in enumerate(sequence_lengths):
-                k = 1
-                for i in range(1, len_index + 1, 2):
-                    skip2forward_type_representation[index, i, :] = skip2forward_representation[index, k, :]
-                    lstm_skip2forward_outputs_trans[:, index, i, :] = lstm_skip2forward_outputs[:, index, k, :]
-                    k += 1
-                for j in range(2, len_index + 1, 2):
-                    skip2forward_type_representation[index, j, :] = skip2forward_representation[index, k, :]
-                    lstm_skip2forward_outputs_trans[:, index, j, :] = lstm_skip2forward_outputs[:, index, k, :]
-                    k += 1
-            # Transpose skip2backward
-            for index, len_index in enumerate(sequence_lengths):
-                k = 1
-                for i in range(len_index, 0, -2):
-                    skip2backward_type_representation[index, i, :] = skip2backward_representation[index, k, :]
-                    lstm_skip2backward_outputs_trans[:, index, i, :] = lstm_skip2backward_outputs[:, index, k, :]
-                    k += 1
-                for j in range(len_index - 1, 0, -2):
-                    skip2backward_type_representation[index, j, :] = skip2backward_representation[index, k, :]
-                    lstm_skip2backward_outputs_trans[:, index, j, :] = lstm_skip2backward_outputs[:, index, k, :]
-                    k += 1
-            output_tensors = [
-                torch.cat(
-                    [type_representation, type_representation, inward_type_representation, outward_type_representation,
-                     skip2forward_type_representation, skip2backward_type_representation],
-                    dim=-1) * mask.float().unsqueeze(-1)
-            ]
-            # concat lstm outputs
-            lstm_outputs_concat = torch.cat([lstm_outputs, lstm_inward_outputs_trans, lstm_outward_outputs_trans,
-                                             lstm_skip2forward_outputs_trans, lstm_skip2backward_outputs_trans],
-                                            dim=-1)
-        elif self.permute_number == 8:
-            lstm_outputs = self._elmo_lstm(type_representation, mask)
-            lstm_inward_outputs = self._elmo_lstm_inward(inward_representation, mask)
-            lstm_outward_outputs = self._elmo_lstm_outward(outward_representation, mask)
-            lstm_skip2forward_outputs = self._elmo_lstm_skip2forward(skip2forward_representation, mask)
-            lstm_skip2backward_outputs = self._elmo_lstm_skip2backward(skip2backward_representation, mask)
-            lstm_skip3forward_outputs = self._elmo_lstm_skip3forward(skip3forward_representation, mask)
-            lstm_skip3backward_outputs = self._elmo_lstm_skip3backward(skip3backward_representation, mask)
-            # Transpose the representation and lstm_outputs; skip the two boundary token
-            inward_type_representation = inward_representation.new_zeros(inward_representation.shape)
-            outward_type_representation = outward_representation.new_zeros(outward_representation.shape)
-            skip2forward_type_representation = skip2forward_representation.new_zeros(skip2forward_representation.shape)
-            skip2backward_type_representation = skip2backward_representation.new_zeros(skip2backward_representation.shape)
-            skip3forward_type_representation = skip3forward_representation.new_zeros(skip3forward_representation.shape)
-            skip3backward_type_representation = skip3backward_representation.new_zeros(skip3backward_representation.shape)
-            lstm_inward_outputs_trans = lstm_inward_outputs.new_zeros(lstm_inward_outputs.shape)
-            lstm_outward_outputs_trans = lstm_outward_outputs.new_zeros(lstm_outward_outputs.shape)
-            lstm_skip2forward_outputs_trans = lstm_skip2forward_outputs.new_zeros(lstm_skip2forward_outputs.shape)
-            lstm_skip2backward_outputs_trans = lstm_skip2backward_outputs.new_zeros(lstm_skip2backward_outputs.shape)
-            lstm_skip3forward_outputs_trans = lstm_skip3forward_outputs.new_zeros(lstm_skip3forward_outputs.shape)
-            lstm_skip3backward_outputs_trans = lstm_skip3backward_outputs.new_zeros(lstm_skip3backward_outputs.shape)
-            # Transpose inward
-            for index, len_index in enumerate(sequence_lengths):
-                i = 1
-                j = len_index
-                for k in range(1, len_index + 1):
-                    if k % 2 == 1:
-                        inward_type_representation[index, i, :] = inward_representation[index, k, :]
-                        lstm_inward_outputs_trans[:, index, i, :] = lstm_inward_outputs[:, index, k, :]
-                        i += 1
-                    else:
-                        inward_type_representation[index, j, :] = inward_representation[index, k, :]
-                        lstm_inward_outputs_trans[:, index, j, :] = lstm_inward_outputs[:, index, k, :]
-                        j -= 1
-            # Transpose outward
-            for index, len_index in enumerate(sequence_lengths):
-                j = int(len_index/2) + 1
-                i = int(len_index/2)
-                for k in range(1, len_index + 1):
-                    if k % 2 == 1:
-                        outward_type_representation[index, j, :] = outward_representation[index, k, :]
-                        lstm_outward_outputs_trans[:, index, j, :] = lstm_outward_outputs[:, index, k, :]
-                        j += 1
-                    else:
-                        outward_type_representation[index, i, :] = outward_representation[index, k, :]
-                        lstm_outward_outputs_trans[:, index, i, :] = lstm_outward_outputs[:, index, k, :]
-                        i -= 1
-            # Transpose skip2forward
-            for index, len_index in enumerate(sequence_lengths):
-                k = 1
-                for i in range(1, len_index + 1, 2):
-                    skip2forward_type_representation[index, i, :] = skip2forward_representation[index, k, :]
-                    lstm_skip2forward_outputs_trans[:, index, i, :] = lstm_skip2forward_outputs[:, index, k, :]
-                    k += 1
-                for j in range(2, len_index + 1, 2):
-                    skip2forward_type_representation[index, j, :] = skip2forward_representation[index, k, :]
-                    lstm_skip2forward_outputs_trans[:, index, j, :] = lstm_skip2forward_outputs[:, index, k, :]
-                    k += 1
-            # Transpose skip2backward
-            for index, len_index in enumerate(sequence_lengths):
-                k = 1
-                for i in range(len_index, 0, -2):
-                    skip2backward_type_representation[index, i, :] = skip2backward_representation[index, k, :]
-                    lstm_skip2backward_outputs_trans[:, index, i, :] = lstm_skip2backward_outputs[:, index, k, :]
-                    k += 1
-                for j in range(len_index - 1, 0, -2):
-                    skip2backward_type_representation[index, j, :] = skip2backward_representation[index, k, :]
-                    lstm_skip2backward_outputs_trans[:, index, j, :] = lstm_skip2backward_outputs[:, index, k, :]
-                    k += 1
-            # skip3 forward
-            for index, len_index in enumerate(sequence_lengths):
-                k = 1
-                for i in range(1, len_index + 1, 3):
-                    skip3forward_type_representation[index, i, :] = skip3forward_representation[index, k, :]
-                    lstm_skip3forward_outputs_trans[:, index, i, :] = lstm_skip3forward_outputs[:, index, k, :]
-                    k += 1
-                for j in range(2, len_index + 1, 3):
-                    skip3forward_type_representation[index, j, :] = skip3forward_representation[index, k, :]
-                    lstm_skip3forward_outputs_trans[:, index, j, :] = lstm_skip3forward_outputs[:, index, k, :]
-                    k += 1
-                for m in range(3, len_index + 1, 3):
-                    skip3forward_type_representation[index, m, :] = skip3forward_representation[index, k, :]
-                    lstm_skip3forward_outputs_trans[:, index, m, :] = lstm_skip3forward_outputs[:, index, k, :]
-                    k += 1
-            # skip3 backward
-            for index, len_index in enumerate(sequence_lengths):
-                k = 1
-                for i in range(len_index, 0, -3):
-                    skip3backward_type_representation[index, i, :] = skip3backward_representation[index, k, :]
-                    lstm_skip3backward_outputs_trans[:, index, i, :] = lstm_skip3backward_outputs[:, index, k, :]
-                    k += 1
-                for j in range(len_index - 1, 0, -3):
-                    skip3backward_type_representation[index, j, :] = skip3backward_representation[index, k, :]
-                    lstm_skip3backward_outputs_trans[:, index, j, :] = lstm_skip3backward_outputs[:, index, k, :]
-                    k += 1
-                for m in range(len_index - 2, 0, -3):
-                    skip3backward_type_representation[index, m, :] = skip3backward_representation[index, k, :]
-                    lstm_skip3backward_outputs_trans[:, index, m, :] = lstm_skip3backward_outputs[:, index, k, :]
-                    k += 1
-
-            output_tensors = [
-                torch.cat([type_representation, type_representation,
-                           inward_type_representation, outward_type_representation,
-                           skip2forward_type_representation, skip2backward_type_representation,
-                           skip3forward_type_representation, skip3backward_type_representation], dim=-1) * mask.float().unsqueeze(-1)
-            ]
-            # concat lstm outputs
-            lstm_outputs_concat = torch.cat([lstm_outputs, lstm_inward_outputs_trans, lstm_outward_outputs_trans,
-                                             lstm_skip2forward_outputs_trans, lstm_skip2backward_outputs_trans,
-                                             lstm_skip2forward_outputs_trans, lstm_skip3backward_outputs_trans],
-                                            dim=-1)
+            # The character cnn runs once, all the versions of the sentences are built from its output.
+            embedded_inputs = self._token_embedder.embed_tokens(inputs)
+
+        sequence_lengths = input_mask.sum(dim=1).detach().cpu().numpy()
+        # shape (batch_size, timesteps + 2, embedding_dim)
+        token_embedding = self._token_embedder.add_boundary_embeddings(
+                embedded_inputs, input_mask, boundary_embeddings=boundary_embeddings)
+        mask = token_embedding['mask']
+        type_representation = token_embedding['token_embedding']
+
+        lstm_outputs = self._elmo_lstm(type_representation, mask)
+        type_representations = [type_representation, type_representation]
+        permuted_lstm_outputs = []
+        if self._permute_versions:
+            # Gather the token embeddings in the order of each permuted version and add its
+            # boundary tokens, then run the LSTMs of all the versions together.
+            all_restore_indices = []
+            permuted_representations = []
+            for permute_version in self._permute_versions:
+                permute_indices, restore_indices = _permutation_indices(permute_version,
+                                                                        sequence_lengths,
+                                                                        inputs.size(1))
+                permute_indices = permute_indices.to(inputs.device)
+                all_restore_indices.append(restore_indices.to(inputs.device))
+                permuted_embeddings = embedded_inputs.gather(
+                        1, permute_indices.unsqueeze(-1).expand_as(embedded_inputs))
+                permuted_representations.append(self._token_embedder.add_boundary_embeddings(
+                        permuted_embeddings, input_mask, permute_version, boundary_embeddings)['token_embedding'])
+            # Shape (num_permuted_versions, num_layers, batch_size, timesteps + 2, hidden_size)
+            all_outputs = self._elmo_lstm_permuted(torch.stack(permuted_representations), mask)
+
+            # Gather the representations and lstm outputs back into the order of the sentence.
+            # The boundary tokens of the permuted versions are zeroed.
+            positions = torch.arange(mask.size(1), dtype=torch.long, device=mask.device).unsqueeze(0)
+            token_mask = ((positions >= 1) & (positions <= input_mask.sum(dim=1, keepdim=True))).float()
+            for representation, outputs, restore_indices in zip(permuted_representations,
+                                                                all_outputs,
+                                                                all_restore_indices):
+                type_representations.append(
+                        representation.gather(1, restore_indices.unsqueeze(-1).expand_as(representation))
+                        * token_mask.unsqueeze(-1))
+                permuted_lstm_outputs.append(
+                        outputs.gather(2, restore_indices.unsqueeze(0).unsqueeze(-1).expand_as(outputs))
+                        * token_mask.unsqueeze(0).unsqueeze(-1))
+        output_tensors = [
+            torch.cat(type_representations, dim=-1) * mask.float().unsqueeze(-1)
+        ]
+        lstm_outputs_concat = torch.cat([lstm_outputs] + permuted_lstm_outputs, dim=-1)
 
         # Prepare the output.  The first layer is duplicated.
         # Because of minor differences in how masking is applied depending
@@ -1222,7 +821,8 @@ class _ElmoBiLm(torch.nn.Module):
         the word ids are looked up from an embedding, rather than being computed on
         the fly via the CNN encoder.
 
-        This function sets 3 attributes:
+        This function sets the following attributes, the boundary tokens only for the
+        versions of the sentences the model reads (the others are None):
 
         _word_embedding : ``torch.Tensor``
             The word embedding for each word in the tokens passed to this method.
@@ -1230,13 +830,17 @@ class _ElmoBiLm(torch.nn.Module):
             The embedding for the BOS token.
         _eos_embedding : ``torch.Tensor``
             The embedding for the EOS token.
+        _mos_embedding, _sos_embedding : ``torch.Tensor``
+            The embeddings for the middle and side of sentence tokens of the inward and
+            outward versions.
+        _skip2start_embedding, _skip2end_embedding, _skip3start_embedding, _skip3end_embedding : ``torch.Tensor``
+            The embeddings for the start and end tokens of the skip versions.
 
         Parameters
         ----------
         tokens : ``List[str]``, required.
             A list of tokens to precompute character convolutions for.
         """
-        tokens = [ELMoCharacterMapper.bos_token, ELMoCharacterMapper.eos_token] + tokens
         timesteps = 32
         batch_size = 32
         chunked_tokens = lazy_groups_of(iter(tokens), timesteps)
@@ -1252,22 +856,21 @@ class _ElmoBiLm(torch.nn.Module):
             # because it's only a few convolutions and will likely be very fast.
             if device >= 0:
                 batched_tensor = batched_tensor.cuda(device)
-            output = self._token_embedder(batched_tensor)
-            token_embedding = output["token_embedding"]
-            mask = output["mask"]
-            token_embedding, _ = remove_sentence_boundaries(token_embedding, mask)
+            token_embedding = self._token_embedder.embed_tokens(batched_tensor)
             all_embeddings.append(token_embedding.view(-1, token_embedding.size(-1)))
         full_embedding = torch.cat(all_embeddings, 0)
 
         # We might have some trailing embeddings from padding in the batch, so
         # we clip the embedding and lookup to the right size.
-        full_embedding = full_embedding[:len(tokens), :]
-        embedding = full_embedding[2:len(tokens), :]
+        embedding = full_embedding[:len(tokens), :]
         vocab_size, embedding_dim = list(embedding.size())
 
         from allennlp.modules.token_embedders import Embedding # type: ignore
-        self._bos_embedding = full_embedding[0, :]
-        self._eos_embedding = full_embedding[1, :]
+        # Only the boundary tokens of the versions the model reads are embedded, the
+        # attributes of the others stay None.
+        boundary_embeddings = self._token_embedder.embed_boundary_tokens()
+        for name, boundary_embedding in boundary_embeddings.items():
+            setattr(self, _CACHED_BOUNDARY_EMBEDDINGS[name], boundary_embedding)
         self._word_embedding = Embedding(vocab_size, # type: ignore
                                          embedding_dim,
                                          weight=embedding.data,
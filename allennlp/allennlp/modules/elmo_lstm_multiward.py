@@ -0,0 +1,388 @@
+"""
+The one directional LSTMs of the permuted directions of an ELMo model, run together.
+"""
+from typing import Optional, Tuple, List
+import warnings
+
+import torch
+from torch.nn.utils.rnn import PackedSequence, pad_packed_sequence
+with warnings.catch_warnings():
+    warnings.filterwarnings("ignore", category=FutureWarning)
+    import h5py
+import numpy
+
+from allennlp.common.checks import ConfigurationError
+from allennlp.modules.encoder_base import _EncoderBase
+from allennlp.common.file_utils import cached_path
+from allennlp.nn.util import get_dropout_mask
+from allennlp.nn.initializers import block_orthogonal
+
+
+class ElmoLstm_Multiward(_EncoderBase):
+    """
+    Several stacked, one directional LSTMs with projected and clipped states and skip
+    connections between layers, one for each direction of a model which reads the
+    sentences in several orders.  Each direction computes the same thing as an
+    :class:`~allennlp.modules.elmo_lstm_oneward.ElmoLstm_Oneward` with its own weights and
+    inputs.
+
+    All the directions read sequences with the same lengths, so the batch is sorted and
+    restored once for all of them, and they advance together: the weights of the directions
+    are stacked, the inputs of all the directions and timesteps of a layer are projected with
+    one batched matrix multiplication, and at each timestep so are the states and the
+    outputs of all the directions.
+
+    Like ``ElmoLstm_Oneward``, this LSTM maintains its `own` state, which is updated every
+    time ``forward`` is called.
+
+    Parameters
+    ----------
+    num_directions : ``int``, required
+        The number of directions.
+    input_size : ``int``, required
+        The dimension of the inputs to the LSTM.
+    hidden_size : ``int``, required
+        The dimension of the outputs of the LSTM.
+    cell_size : ``int``, required.
+        The dimension of the memory cell of the LSTM.
+    num_layers : ``int``, required
+        The number of LSTMs of each direction.
+    requires_grad: ``bool``, optional
+        If True, compute gradient of ELMo parameters for fine tuning.
+    recurrent_dropout_probability: ``float``, optional (default = 0.0)
+        The dropout probability to be used in a dropout scheme as stated in
+        `A Theoretically Grounded Application of Dropout in Recurrent Neural Networks
+        <https://arxiv.org/abs/1512.05287>`_ .
+    state_projection_clip_value: ``float``, optional, (default = None)
+        The magnitude with which to clip the hidden_state after projecting it.
+    memory_cell_clip_value: ``float``, optional, (default = None)
+        The magnitude with which to clip the memory cell.
+    """
+    def __init__(self,
+                 num_directions: int,
+                 input_size: int,
+                 hidden_size: int,
+                 cell_size: int,
+                 num_layers: int,
+                 requires_grad: bool = False,
+                 recurrent_dropout_probability: float = 0.0,
+                 memory_cell_clip_value: Optional[float] = None,
+                 state_projection_clip_value: Optional[float] = None) -> None:
+        super(ElmoLstm_Multiward, self).__init__(stateful=True)
+
+        self.num_directions = num_directions
+        self.input_size = input_size
+        self.hidden_size = hidden_size
+        self.num_layers = num_layers
+        self.cell_size = cell_size
+        self.requires_grad = requires_grad
+        self.recurrent_dropout_probability = recurrent_dropout_probability
+        self.memory_cell_clip_value = memory_cell_clip_value
+        self.state_projection_clip_value = state_projection_clip_value
+
+        # The weights of each layer, stacked by direction and transposed for ``torch.bmm``.
+        lstm_input_size = input_size
+        for layer_index in range(num_layers):
+            for name, shape in [('input_weights', (lstm_input_size, 4 * cell_size)),
+                                ('state_weights', (hidden_size, 4 * cell_size)),
+                                ('state_bias', (1, 4 * cell_size)),
+                                ('projection_weights', (cell_size, hidden_size))]:
+                parameter = torch.nn.Parameter(torch.zeros(num_directions, *shape), requires_grad=requires_grad)
+                self.register_parameter('{}_{}'.format(name, layer_index), parameter)
+            lstm_input_size = hidden_size
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        # The initialization of LstmCellWithProjection, for each direction.
+        for layer_index in range(self.num_layers):
+            input_weights, state_weights, state_bias, projection_weights = self._layer_parameters(layer_index)
+            for direction in range(self.num_directions):
+                block_orthogonal(input_weights.data[direction], [input_weights.size(1), self.cell_size])
+                block_orthogonal(state_weights.data[direction], [self.hidden_size, self.cell_size])
+            state_bias.data.fill_(0.0)
+            state_bias.data[:, :, self.cell_size:2 * self.cell_size].fill_(1.0)
+            bound = 1.0 / numpy.sqrt(self.cell_size)
+            projection_weights.data.uniform_(-bound, bound)
+
+    def _layer_parameters(self, layer_index: int) -> List[torch.nn.Parameter]:
+        return [getattr(self, '{}_{}'.format(name, layer_index))
+                for name in ['input_weights', 'state_weights', 'state_bias', 'projection_weights']]
+
+    def forward(self,  # pylint: disable=arguments-differ
+                inputs: torch.Tensor,
+                mask: torch.LongTensor) -> torch.Tensor:
+        """
+        Parameters
+        ----------
+        inputs : ``torch.Tensor``, required.
+            A Tensor of shape ``(num_directions, batch_size, sequence_length, input_size)``.
+        mask : ``torch.LongTensor``, required.
+            A binary mask of shape ``(batch_size, sequence_length)`` representing the
+            non-padded elements in each sequence in the batch, the same for every direction.
+
+        Returns
+        -------
+        A ``torch.Tensor`` of shape (num_directions, num_layers, batch_size, sequence_length,
+        hidden_size), the LSTM outputs of each layer of each direction.
+        """
+        batch_size, total_sequence_length = mask.size()
+        # The directions are stacked along the features, so they are sorted together.
+        inputs = inputs.permute(1, 2, 0, 3).contiguous().view(batch_size, total_sequence_length, -1)
+        stacked_sequence_output, final_states, restoration_indices = \
+            self.sort_and_run_forward(self._lstm_forward, inputs, mask)
+
+        num_layers, num_valid, returned_timesteps, encoder_dim = stacked_sequence_output.size()
+        # Add back invalid rows which were removed in the call to sort_and_run_forward.
+        if num_valid < batch_size:
+            zeros = stacked_sequence_output.new_zeros(num_layers,
+                                                      batch_size - num_valid,
+                                                      returned_timesteps,
+                                                      encoder_dim)
+            stacked_sequence_output = torch.cat([stacked_sequence_output, zeros], 1)
+
+            # The states also need to have invalid rows added back.
+            new_states = []
+            for state in final_states:
+                state_dim = state.size(-1)
+                zeros = state.new_zeros(num_layers, batch_size - num_valid, state_dim)
+                new_states.append(torch.cat([state, zeros], 1))
+            final_states = new_states
+
+        # Add back the padding the LSTM did not need to process, as zeros.
+        sequence_length_difference = total_sequence_length - returned_timesteps
+        if sequence_length_difference > 0:
+            zeros = stacked_sequence_output.new_zeros(num_layers,
+                                                      batch_size,
+                                                      sequence_length_difference,
+                                                      encoder_dim)
+            stacked_sequence_output = torch.cat([stacked_sequence_output, zeros], 2)
+
+        self._update_states(final_states, restoration_indices)
+
+        # Restore the original indices and split the directions.
+        # Has shape (num_directions, num_layers, batch_size, sequence_length, hidden_size)
+        stacked_sequence_output = stacked_sequence_output.index_select(1, restoration_indices)
+        stacked_sequence_output = stacked_sequence_output.view(num_layers,
+                                                               batch_size,
+                                                               total_sequence_length,
+                                                               self.num_directions,
+                                                               self.hidden_size)
+        return stacked_sequence_output.permute(3, 0, 1, 2, 4)
+
+    def _lstm_forward(self,
+                      inputs: PackedSequence,
+                      initial_state: Optional[Tuple[torch.Tensor, torch.Tensor]] = None) -> \
+            Tuple[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]:
+        """
+        Parameters
+        ----------
+        inputs : ``PackedSequence``, required.
+            A batch first ``PackedSequence`` of the inputs of all the directions, concatenated.
+        initial_state : ``Tuple[torch.Tensor, torch.Tensor]``, optional, (default = None)
+            A tuple (state, memory) representing the initial hidden state and memory
+            of the LSTM, with shape (num_layers, batch_size, num_directions * hidden_size) and
+            (num_layers, batch_size, num_directions * cell_size) respectively.
+
+        Returns
+        -------
+        output_sequence : ``torch.FloatTensor``
+            The encoded sequence of shape
+            (num_layers, batch_size, sequence_length, num_directions * hidden_size)
+        final_states: ``Tuple[torch.FloatTensor, torch.FloatTensor]``
+            The per-layer final (state, memory) states of the LSTM, with shape
+            (num_layers, batch_size, num_directions * hidden_size) and
+            (num_layers, batch_size, num_directions * cell_size) respectively.
+        """
+        if initial_state is None:
+            hidden_states: List[Optional[Tuple[torch.Tensor, torch.Tensor]]] = [None] * self.num_layers
+        elif initial_state[0].size()[0] != self.num_layers:
+            raise ConfigurationError("Initial states were passed to forward() but the number of "
+                                     "initial states does not match the number of layers.")
+        else:
+            hidden_states = list(zip(initial_state[0].split(1, 0), initial_state[1].split(1, 0)))
+
+        inputs, batch_lengths = pad_packed_sequence(inputs, batch_first=True)
+        batch_size, timesteps, _ = inputs.size()
+        # Shape (num_directions, batch_size, timesteps, input_size)
+        output_sequence = inputs.view(batch_size, timesteps, self.num_directions, -1).permute(2, 0, 1, 3)
+
+        final_states = []
+        sequence_outputs = []
+        for layer_index, state in enumerate(hidden_states):
+            cache = output_sequence
+            if state is not None:
+                # Shape (num_directions, batch_size, hidden_size or cell_size)
+                state = tuple(tensor.squeeze(0).view(batch_size, self.num_directions, -1).transpose(0, 1)
+                              for tensor in state)
+            output_sequence, state = self._layer_forward(layer_index, output_sequence, batch_lengths, state)
+            # Skip connections, just adding the input to the output.
+            if layer_index != 0:
+                output_sequence = output_sequence + cache
+
+            sequence_outputs.append(output_sequence.permute(1, 2, 0, 3).contiguous().view(batch_size, timesteps, -1))
+            final_states.append(tuple(tensor.transpose(0, 1).contiguous().view(1, batch_size, -1)
+                                      for tensor in state))
+
+        # Stack the outputs by layer along the first dimension, and the hidden state and memory
+        # of each layer into 2 tensors of shape (num_layers, batch_size, num_directions * hidden_size)
+        # and (num_layers, batch_size, num_directions * cell_size) respectively.
+        stacked_sequence_outputs: torch.FloatTensor = torch.stack(sequence_outputs)
+        final_hidden_states, final_memory_states = zip(*final_states)
+        final_state_tuple: Tuple[torch.FloatTensor, torch.FloatTensor] = (torch.cat(final_hidden_states, 0),
+                                                                          torch.cat(final_memory_states, 0))
+        return stacked_sequence_outputs, final_state_tuple
+
+    def _layer_forward(self,
+                       layer_index: int,
+                       inputs: torch.FloatTensor,
+                       batch_lengths: List[int],
+                       initial_state: Optional[Tuple[torch.Tensor, torch.Tensor]] = None) -> \
+            Tuple[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]:
+        """
+        Run one layer of all the directions, as ``LstmCellWithProjection`` does for one.
+
+        Parameters
+        ----------
+        layer_index : ``int``, required.
+            The layer to run.
+        inputs : ``torch.FloatTensor``, required.
+            A tensor of shape (num_directions, batch_size, num_timesteps, input_size),
+            with the batch sorted by decreasing length.
+        batch_lengths : ``List[int]``, required.
+            A list of length batch_size containing the lengths of the sequences in batch.
+        initial_state : ``Tuple[torch.Tensor, torch.Tensor]``, optional, (default = None)
+            A tuple (state, memory) of shape (num_directions, batch_size, hidden_size) and
+            (num_directions, batch_size, cell_size).
+
+        Returns
+        -------
+        The outputs of shape (num_directions, batch_size, num_timesteps, hidden_size), zero past
+        the length of each sequence, and the final (state, memory) with the shapes of
+        ``initial_state``.
+        """
+        num_directions, batch_size, total_timesteps, input_size = inputs.size()
+        input_weights, state_weights, state_bias, projection_weights = self._layer_parameters(layer_index)
+
+        output_accumulator = inputs.new_zeros(num_directions, batch_size, total_timesteps, self.hidden_size)
+
+        # As in LstmCellWithProjection, the states are updated in place when nothing needs a gradient.
+        update_in_place = not torch.is_grad_enabled() or not (
+                inputs.requires_grad or
+                any(parameter.requires_grad for parameter in self.parameters()) or
+                (initial_state is not None and any(state.requires_grad for state in initial_state)))
+
+        if initial_state is None:
+            full_batch_previous_memory = inputs.new_zeros(num_directions, batch_size, self.cell_size)
+            full_batch_previous_state = inputs.new_zeros(num_directions, batch_size, self.hidden_size)
+        else:
+            full_batch_previous_state, full_batch_previous_memory = initial_state
+            if update_in_place:
+                full_batch_previous_state = full_batch_previous_state.clone()
+                full_batch_previous_memory = full_batch_previous_memory.clone()
+
+        # The inputs of all the timesteps are projected at once.
+        # Shape (num_directions, batch_size, total_timesteps, 4 * cell_size)
+        projected_inputs = torch.bmm(inputs.contiguous().view(num_directions, -1, input_size), input_weights)
+        projected_inputs = projected_inputs.view(num_directions, batch_size, total_timesteps, -1)
+
+        current_length_index = batch_size - 1
+        if self.recurrent_dropout_probability > 0.0 and self.training:
+            dropout_mask = get_dropout_mask(self.recurrent_dropout_probability,
+                                            full_batch_previous_state)
+        else:
+            dropout_mask = None
+
+        for timestep in range(total_timesteps):
+            # The batch is sorted by length, so the sequences which have ended are at the end.
+            while batch_lengths[current_length_index] <= timestep:
+                current_length_index -= 1
+
+            # Shape (num_directions, batch_size, cell_size)
+            previous_memory = full_batch_previous_memory[:, 0: current_length_index + 1]
+            # Shape (num_directions, batch_size, hidden_size)
+            previous_state = full_batch_previous_state[:, 0: current_length_index + 1]
+            if not update_in_place:
+                previous_memory = previous_memory.clone()
+                previous_state = previous_state.clone()
+
+            # Shape (num_directions, batch_size, 4 * cell_size)
+            projected = (projected_inputs[:, 0: current_length_index + 1, timestep] +
+                         torch.bmm(previous_state, state_weights) + state_bias)
+
+            input_gate = torch.sigmoid(projected[:, :, (0 * self.cell_size):(1 * self.cell_size)])
+            forget_gate = torch.sigmoid(projected[:, :, (1 * self.cell_size):(2 * self.cell_size)])
+            memory_init = torch.tanh(projected[:, :, (2 * self.cell_size):(3 * self.cell_size)])
+            output_gate = torch.sigmoid(projected[:, :, (3 * self.cell_size):(4 * self.cell_size)])
+            memory = input_gate * memory_init + forget_gate * previous_memory
+
+            if self.memory_cell_clip_value:
+                # pylint: disable=invalid-unary-operand-type
+                memory = torch.clamp(memory, -self.memory_cell_clip_value, self.memory_cell_clip_value)
+
+            # Shape (num_directions, batch_size, hidden_size)
+            timestep_output = torch.bmm(output_gate * torch.tanh(memory), projection_weights)
+            if self.state_projection_clip_value:
+                # pylint: disable=invalid-unary-operand-type
+                timestep_output = torch.clamp(timestep_output,
+                                              -self.state_projection_clip_value,
+                                              self.state_projection_clip_value)
+
+            # Only do dropout if the dropout prob is > 0.0 and we are in training mode.
+            if dropout_mask is not None:
+                timestep_output = timestep_output * dropout_mask[:, 0: current_length_index + 1]
+
+            if not update_in_place:
+                full_batch_previous_memory = full_batch_previous_memory.clone()
+                full_batch_previous_state = full_batch_previous_state.clone()
+            full_batch_previous_memory[:, 0:current_length_index + 1] = memory
+            full_batch_previous_state[:, 0:current_length_index + 1] = timestep_output
+            output_accumulator[:, 0:current_length_index + 1, timestep] = timestep_output
+
+        return output_accumulator, (full_batch_previous_state, full_batch_previous_memory)
+
+    def load_weights(self, weight_file: str, permute_version_ids: List[int]) -> None:
+        """
+        Load the pre-trained weights of the directions from the file, with the
+        ``permute_version_id`` of ``ElmoLstm_Oneward.load_weights`` of each direction.
+        """
+        if len(permute_version_ids) != self.num_directions:
+            raise ConfigurationError("Expected the weights of {} directions, got {}".format(
+                    self.num_directions, len(permute_version_ids)))
+        requires_grad = self.requires_grad
+        cell_size = self.cell_size
+
+        with h5py.File(cached_path(weight_file), 'r') as fin:
+            for i_layer in range(self.num_layers):
+                parameters = self._layer_parameters(i_layer)
+                input_weights, state_weights, state_bias, projection_weights = parameters
+                input_size = input_weights.size(1)
+                for direction, permute_version_id in enumerate(permute_version_ids):
+                    j_direction = permute_version_id - 1
+                    dataset = fin['RNN_%s' % j_direction]['RNN']['MultiRNNCell']['Cell%s' % i_layer]['LSTMCell']
+
+                    # tensorflow packs together both W and U matrices into one matrix,
+                    # and packs the gates as input, memory, forget, output but pytorch
+                    # uses input, forget, memory, output.  The weights are stored
+                    # transposed here, as they are in tensorflow.
+                    tf_weights = dataset['W_0'][...]
+                    torch_weights = tf_weights.copy()
+                    torch_weights[:, (1 * cell_size):(2 * cell_size)] = tf_weights[:, (2 * cell_size):(3 * cell_size)]
+                    torch_weights[:, (2 * cell_size):(3 * cell_size)] = tf_weights[:, (1 * cell_size):(2 * cell_size)]
+                    input_weights.data[direction].copy_(torch.FloatTensor(torch_weights[:input_size]))
+                    state_weights.data[direction].copy_(torch.FloatTensor(torch_weights[input_size:]))
+
+                    # the bias weights
+                    tf_bias = dataset['B'][...]
+                    # tensorflow adds 1.0 to forget gate bias instead of modifying the
+                    # parameters...
+                    tf_bias[(2 * cell_size):(3 * cell_size)] += 1
+                    torch_bias = tf_bias.copy()
+                    torch_bias[(1 * cell_size):(2 * cell_size)] = tf_bias[(2 * cell_size):(3 * cell_size)]
+                    torch_bias[(2 * cell_size):(3 * cell_size)] = tf_bias[(1 * cell_size):(2 * cell_size)]
+                    state_bias.data[direction, 0].copy_(torch.FloatTensor(torch_bias))
+
+                    # the projection weights
+                    projection_weights.data[direction].copy_(torch.FloatTensor(dataset['W_P_0'][...]))
+
+                for parameter in parameters:
+                    parameter.requires_grad = requires_grad
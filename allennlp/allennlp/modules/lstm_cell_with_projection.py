@@ -127,13 +127,29 @@ class LstmCellWithProjection(torch.nn.Module):
 
         output_accumulator = inputs.new_zeros(batch_size, total_timesteps, self.hidden_size)
 
+        # When nothing needs a gradient, the states are updated in place. Otherwise they are
+        # copied at each timestep, as autograd needs the states the previous timesteps used.
+        update_in_place = not torch.is_grad_enabled() or not (
+                inputs.requires_grad or
+                any(parameter.requires_grad for parameter in self.parameters()) or
+                (initial_state is not None and any(state.requires_grad for state in initial_state)))
+
         if initial_state is None:
             full_batch_previous_memory = inputs.new_zeros(batch_size, self.cell_size)
             full_batch_previous_state = inputs.new_zeros(batch_size, self.hidden_size)
+        elif update_in_place:
+            # Copied once, so the initial state passed in is not modified.
+            full_batch_previous_state = initial_state[0].squeeze(0).clone()
+            full_batch_previous_memory = initial_state[1].squeeze(0).clone()
         else:
             full_batch_previous_state = initial_state[0].squeeze(0)
             full_batch_previous_memory = initial_state[1].squeeze(0)
 
+        # The inputs don't depend on the state, so they are projected for all the gates
+        # and all the timesteps at once.
+        # Shape (batch_size, total_timesteps, 4 * cell_size)
+        projected_inputs = self.input_linearity(inputs)
+
         current_length_index = batch_size - 1 if self.go_forward else 0
         if self.recurrent_dropout_probability > 0.0 and self.training:
             dropout_mask = get_dropout_mask(self.recurrent_dropout_probability,
@@ -170,15 +186,16 @@ class LstmCellWithProjection(torch.nn.Module):
             # Actually get the slices of the batch which we
             # need for the computation at this timestep.
             # shape (batch_size, cell_size)
-            previous_memory = full_batch_previous_memory[0: current_length_index + 1].clone()
+            previous_memory = full_batch_previous_memory[0: current_length_index + 1]
             # Shape (batch_size, hidden_size)
-            previous_state = full_batch_previous_state[0: current_length_index + 1].clone()
-            # Shape (batch_size, input_size)
-            timestep_input = inputs[0: current_length_index + 1, index]
+            previous_state = full_batch_previous_state[0: current_length_index + 1]
+            if not update_in_place:
+                previous_memory = previous_memory.clone()
+                previous_state = previous_state.clone()
 
             # Do the projections for all the gates all at once.
             # Both have shape (batch_size, 4 * cell_size)
-            projected_input = self.input_linearity(timestep_input)
+            projected_input = projected_inputs[0: current_length_index + 1, index]
             projected_state = self.state_linearity(previous_state)
 
             # Main LSTM equations using relevant chunks of the big linear
@@ -217,10 +234,11 @@ class LstmCellWithProjection(torch.nn.Module):
                 timestep_output = timestep_output * dropout_mask[0: current_length_index + 1]
 
             # We've been doing computation with less than the full batch, so here we create a new
-            # variable for the the whole batch at this timestep and insert the result for the
-            # relevant elements of the batch into it.
-            full_batch_previous_memory = full_batch_previous_memory.clone()
-            full_batch_previous_state = full_batch_previous_state.clone()
+            # variable for the the whole batch at this timestep (unless nothing needs a gradient)
+            # and insert the result for the relevant elements of the batch into it.
+            if not update_in_place:
+                full_batch_previous_memory = full_batch_previous_memory.clone()
+                full_batch_previous_state = full_batch_previous_state.clone()
             full_batch_previous_memory[0:current_length_index + 1] = memory
             full_batch_previous_state[0:current_length_index + 1] = timestep_output
             output_accumulator[0:current_length_index + 1, index] = timestep_output
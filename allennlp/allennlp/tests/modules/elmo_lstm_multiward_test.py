@@ -0,0 +1,46 @@
+# pylint: disable=no-self-use,invalid-name,protected-access
+import numpy
+import torch
+
+from allennlp.modules.elmo_lstm_oneward import ElmoLstm_Oneward
+from allennlp.modules.elmo_lstm_multiward import ElmoLstm_Multiward
+from allennlp.common.testing import AllenNlpTestCase
+
+
+class TestElmoLstmMultiward(AllenNlpTestCase):
+    def test_elmo_lstm_multiward_matches_oneward_lstms(self):
+        input_tensor = torch.rand(2, 4, 5, 3)
+        mask = torch.ones([4, 5])
+        mask[1, 4:] = 0.
+        mask[2, 2:] = 0.
+        mask[3, 1:] = 0.
+        input_tensor = input_tensor * mask.unsqueeze(0).unsqueeze(-1)
+
+        lstm_args = dict(input_size=3,
+                         hidden_size=5,
+                         cell_size=7,
+                         num_layers=2,
+                         memory_cell_clip_value=2,
+                         state_projection_clip_value=1)
+        oneward_lstms = [ElmoLstm_Oneward(**lstm_args) for _ in range(2)]
+        multiward_lstm = ElmoLstm_Multiward(num_directions=2, **lstm_args)
+        for direction, oneward_lstm in enumerate(oneward_lstms):
+            for layer_index, cell in enumerate(oneward_lstm.oneward_layers):
+                input_weights, state_weights, state_bias, projection_weights = \
+                        multiward_lstm._layer_parameters(layer_index)
+                input_weights.data[direction] = cell.input_linearity.weight.data.t()
+                state_weights.data[direction] = cell.state_linearity.weight.data.t()
+                state_bias.data[direction, 0] = cell.state_linearity.bias.data
+                projection_weights.data[direction] = cell.state_projection.weight.data.t()
+
+        # The second call starts from the states of the first.
+        for _ in range(2):
+            output_sequence = multiward_lstm(input_tensor, mask)
+            assert list(output_sequence.size()) == [2, 2, 4, 5, 5]
+            for direction, oneward_lstm in enumerate(oneward_lstms):
+                numpy.testing.assert_array_almost_equal(output_sequence.data[direction].numpy(),
+                                                        oneward_lstm(input_tensor[direction], mask).data.numpy())
+
+        # The states of the directions are concatenated.
+        assert list(multiward_lstm._states[0].size()) == [2, 4, 10]
+        assert list(multiward_lstm._states[1].size()) == [2, 4, 14]
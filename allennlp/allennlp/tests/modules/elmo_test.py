@@ -1,6 +1,7 @@
 # pylint: disable=no-self-use,invalid-name,protected-access
 import os
 import json
+import shutil
 import warnings
 from typing import List
 
@@ -16,10 +17,11 @@ from allennlp.data.token_indexers.single_id_token_indexer import SingleIdTokenIn
 from allennlp.data import Token, Vocabulary, Instance
 from allennlp.data.dataset import Batch
 from allennlp.data.iterators import BasicIterator
-from allennlp.modules.elmo import _ElmoBiLm, Elmo, _ElmoCharacterEncoder
+from allennlp.modules.elmo import _ElmoBiLm, Elmo, _ElmoCharacterEncoder, _permutation_indices
+from allennlp.modules.elmo import _BOUNDARY_CHARACTERS, _CACHED_BOUNDARY_EMBEDDINGS, _PERMUTE_VERSIONS
 from allennlp.modules.token_embedders import ElmoTokenEmbedder
 from allennlp.data.fields import TextField
-from allennlp.nn.util import remove_sentence_boundaries
+from allennlp.nn.util import remove_sentence_boundaries, add_sentence_boundary_token_ids
 
 
 class ElmoTestCase(AllenNlpTestCase):
@@ -64,6 +66,26 @@ class ElmoTestCase(AllenNlpTestCase):
 
         return sentences, expected_lm_embeddings
 
+    def _write_permuted_model(self, permute_number: int):
+        """
+        Write the options and weights of a model reading ``permute_number`` versions of the
+        sentences, with the LSTMs of the permuted versions copied from the forward LSTM.
+        Returns the (options_file, weight_file).
+        """
+        with open(self.options_file) as fin:
+            options = json.load(fin)
+        options['permute_number'] = permute_number
+        options_file = str(self.TEST_DIR / 'permuted_options.json')
+        with open(options_file, 'w') as fout:
+            json.dump(options, fout)
+
+        weight_file = str(self.TEST_DIR / 'permuted_lm_weights.hdf5')
+        shutil.copyfile(self.weight_file, weight_file)
+        with h5py.File(weight_file, 'a') as fout:
+            for k in range(2, permute_number):
+                fout.copy('RNN_0', 'RNN_{}'.format(k))
+        return options_file, weight_file
+
     @staticmethod
     def get_vocab_and_both_elmo_indexed_ids(batch: List[List[str]]):
         instances = []
@@ -166,6 +188,71 @@ class TestElmoBiLm(ElmoTestCase):
             numpy.testing.assert_array_almost_equal(activation_cached.data.cpu().numpy(),
                                                     activation.data.cpu().numpy(), decimal=6)
 
+    def test_elmo_bilm_permuted_can_cache_char_cnn_embeddings(self):
+        sentences = [["This", "is", "a", "sentence"],
+                     ["Here", "'s", "one"],
+                     ["Another", "one"]]
+        vocab, tensor = self.get_vocab_and_both_elmo_indexed_ids(sentences)
+        words_to_cache = list(vocab.get_token_to_index_vocabulary("tokens").keys())
+        options_file, weight_file = self._write_permuted_model(4)
+        elmo_bilm = _ElmoBiLm(options_file, weight_file)
+        elmo_bilm.eval()
+        no_cache = elmo_bilm(tensor["character_ids"], tensor["character_ids"])
+
+        elmo_bilm = _ElmoBiLm(options_file, weight_file, vocab_to_cache=words_to_cache)
+        elmo_bilm.eval()
+        assert elmo_bilm.permute_number == 4
+        cached = elmo_bilm(tensor["character_ids"], tensor["tokens"])
+
+        numpy.testing.assert_array_almost_equal(no_cache["mask"].data.cpu().numpy(),
+                                                cached["mask"].data.cpu().numpy())
+        assert len(cached["activations"]) == len(no_cache["activations"])
+        for activation_cached, activation in zip(cached["activations"], no_cache["activations"]):
+            numpy.testing.assert_array_almost_equal(activation_cached.data.cpu().numpy(),
+                                                    activation.data.cpu().numpy(), decimal=6)
+
+    def test_elmo_bilm_caches_the_boundary_embeddings_of_its_versions(self):
+        sentences = [["This", "is", "a", "sentence"]]
+        vocab, tensor = self.get_vocab_and_both_elmo_indexed_ids(sentences)
+        words_to_cache = list(vocab.get_token_to_index_vocabulary("tokens").keys())
+        elmo_bilm = _ElmoBiLm(self.options_file, self.weight_file, vocab_to_cache=words_to_cache)
+
+        # The boundary tokens of every version of the model are cached with the
+        # embeddings of the character cnn.
+        token_embedder = elmo_bilm._token_embedder  # pylint: disable=protected-access
+        for permute_version in ['forward'] + _PERMUTE_VERSIONS[:elmo_bilm.permute_number - 2]:
+            begin, end = _BOUNDARY_CHARACTERS[permute_version]
+            output = token_embedder(tensor["character_ids"], permute_version=permute_version)
+            token_embedding = output['token_embedding'].data.numpy()
+            numpy.testing.assert_array_almost_equal(
+                    getattr(elmo_bilm, _CACHED_BOUNDARY_EMBEDDINGS[begin]).data.numpy(), token_embedding[0, 0])
+            numpy.testing.assert_array_almost_equal(
+                    getattr(elmo_bilm, _CACHED_BOUNDARY_EMBEDDINGS[end]).data.numpy(), token_embedding[0, 5])
+
+
+class TestPermutationIndices(AllenNlpTestCase):
+    def test_permutation_indices(self):
+        sequence_lengths = numpy.array([5, 2, 0])
+        expected = {
+                'inward': [[0, 4, 1, 3, 2], [0, 1]],
+                'outward': [[2, 1, 3, 0, 4], [1, 0]],
+                'skip2forward': [[0, 2, 4, 1, 3], [0, 1]],
+                'skip2backward': [[4, 2, 0, 3, 1], [1, 0]],
+                'skip3forward': [[0, 3, 1, 4, 2], [0, 1]],
+                'skip3backward': [[4, 1, 3, 0, 2], [1, 0]],
+        }
+        for permute_version, (order, short_order) in expected.items():
+            permute_indices, restore_indices = _permutation_indices(permute_version, sequence_lengths, 5)
+            assert permute_indices.tolist() == [order,
+                                                short_order + [2, 3, 4],
+                                                [0, 1, 2, 3, 4]]
+            # The positions of the permuted sentences with their boundaries are gathered back in order.
+            permuted_positions = torch.LongTensor([[0] + [i + 1 for i in order] + [6],
+                                                   [0] + [i + 1 for i in short_order] + [3, 4, 5, 6],
+                                                   list(range(7))])
+            assert permuted_positions.gather(1, restore_indices).tolist() == [list(range(7))] * 3
+
+
 class TestElmo(ElmoTestCase):
     def setUp(self):
         super(TestElmo, self).setUp()
@@ -342,3 +429,26 @@ class TestElmoTokenRepresentation(ElmoTestCase):
             indices = torch.from_numpy(numpy.array(indices["correct"])).view(1, 1, -1)
             embeddings = elmo_token_embedder(indices)['token_embedding']
             assert numpy.allclose(embeddings[0, correct_index, :].data.numpy(), embeddings[0, 1, :].data.numpy())
+
+    def test_elmo_token_representation_matches_character_cnn_with_boundaries(self):
+        # The tokens and the boundary tokens are embedded separately, which should give
+        # the same embeddings as running the character cnn on the sentences with boundaries.
+        # Only the versions of the fixture model have boundary characters in it.
+        sentences = [["This", "is"], ["a", "longer", "sentence"]]
+        character_ids = self.get_vocab_and_both_elmo_indexed_ids(sentences)[1]["character_ids"]
+        mask = ((character_ids > 0).long().sum(dim=-1) > 0).long()
+
+        elmo_token_embedder = _ElmoCharacterEncoder(self.options_file, self.weight_file)
+        boundary_characters = elmo_token_embedder._boundary_characters  # pylint: disable=protected-access
+        permute_versions = ['forward'] + _PERMUTE_VERSIONS[:elmo_token_embedder.permute_number - 2]
+        for permute_version in permute_versions:
+            begin, end = _BOUNDARY_CHARACTERS[permute_version]
+            ids_with_boundary, mask_with_boundary = add_sentence_boundary_token_ids(
+                    character_ids, mask, boundary_characters[begin], boundary_characters[end])
+            expected = elmo_token_embedder.embed_tokens(ids_with_boundary)
+            output = elmo_token_embedder(character_ids, permute_version=permute_version)
+
+            assert output['mask'].tolist() == mask_with_boundary.tolist()
+            token_mask = mask_with_boundary.float().unsqueeze(-1)
+            numpy.testing.assert_array_almost_equal((output['token_embedding'] * token_mask).data.numpy(),
+                                                    (expected * token_mask).data.numpy())
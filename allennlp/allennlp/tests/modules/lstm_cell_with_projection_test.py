@@ -39,3 +39,27 @@ class TestLstmCellWithProjection(AllenNlpTestCase):
         # Test the cell clipping.
         numpy.testing.assert_array_less(lstm_state[0].data.numpy(), 2.0)
         numpy.testing.assert_array_less(-lstm_state[0].data.numpy(), 2.0)
+
+    def test_elmo_lstm_cell_without_gradients_matches_with_gradients(self):
+        input_tensor = torch.rand(4, 5, 3)
+        input_tensor[1, 4:, :] = 0.
+        input_tensor[2, 2:, :] = 0.
+        input_tensor[3, 1:, :] = 0.
+        initial_state = (torch.ones([1, 4, 5]), torch.ones([1, 4, 7]))
+
+        lstm = LstmCellWithProjection(input_size=3,
+                                      hidden_size=5,
+                                      cell_size=7,
+                                      memory_cell_clip_value=2,
+                                      state_projection_clip_value=1)
+        output_sequence, lstm_state = lstm(input_tensor, [5, 4, 2, 1], initial_state)
+        # Without gradients the states are updated in place.
+        with torch.no_grad():
+            no_grad_output_sequence, no_grad_lstm_state = lstm(input_tensor, [5, 4, 2, 1], initial_state)
+
+        numpy.testing.assert_array_equal(no_grad_output_sequence.numpy(), output_sequence.data.numpy())
+        for no_grad_state, state in zip(no_grad_lstm_state, lstm_state):
+            numpy.testing.assert_array_equal(no_grad_state.numpy(), state.data.numpy())
+        # The initial state is not modified.
+        for state in initial_state:
+            numpy.testing.assert_array_equal(state.numpy(), 1.0)
@@ -1,6 +1,6 @@
 
-from .data import Batcher, TokenBatcher
-from .model import BidirectionalLanguageModel, dump_token_embeddings, \
-    dump_bilm_embeddings
+from .data import Batcher, TokenBatcher, HybridBatcher
+from .model import BidirectionalLanguageModel, DocumentEmbedder, \
+    dump_token_embeddings, dump_bilm_embeddings, load_bilm_embeddings
 from .elmo import weight_layers
 
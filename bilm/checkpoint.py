@@ -0,0 +1,177 @@
+'''
+Checkpoint saving that does not block the training loop.
+'''
+
+import os
+import glob
+import shutil
+import threading
+import queue
+
+import tensorflow as tf
+
+
+class AsyncCheckpointSaver(object):
+    '''
+    Saves checkpoints of var_list on a background thread.
+
+    Each call to save copies the variables into one of max_in_flight
+    buffers of shadow variables, which only takes a device side copy,
+    then the buffer is written to disk by a single writer thread while
+    training continues.  If all buffers are still being written, save
+    blocks until one is free, so at most max_in_flight checkpoints are
+    pending at any time.
+
+    The checkpoint files are written to a temporary directory first and
+    renamed into place, index file last, before the checkpoint state
+    file is updated, so a partially written checkpoint is never visible
+    to tf.train.latest_checkpoint.  The variable names in the files are
+    the same as with tf.train.Saver(var_list), so they can be restored
+    as usual.  The buffers of the shards of partitioned variables have
+    the save slice info of their shard, so they are saved as slices of
+    the full variable.
+    '''
+    def __init__(self, var_list, max_to_keep=2, max_in_flight=1):
+        self._max_to_keep = max_to_keep
+        self._max_in_flight = max(1, max_in_flight)
+
+        self._snapshot_ops = []
+        self._savers = []
+        self._buffer_variables = []
+        for k in range(self._max_in_flight):
+            assign_ops = []
+            name_to_buffer = {}
+            with tf.name_scope('checkpoint_buffer_%s' % k):
+                for v in var_list:
+                    # local variables so they are not part of the
+                    # checkpoints themselves
+                    with tf.device(v.device):
+                        buf = tf.Variable(
+                            tf.zeros(v.get_shape(), dtype=v.dtype.base_dtype),
+                            trainable=False,
+                            collections=[tf.GraphKeys.LOCAL_VARIABLES],
+                            name=v.op.name.replace('/', '_'))
+                        assign_ops.append(tf.assign(buf, v))
+                    slice_info = v._save_slice_info
+                    if slice_info is not None:
+                        buf._set_save_slice_info(slice_info)
+                        name_to_buffer.setdefault(
+                            slice_info.full_name, []).append(buf)
+                    else:
+                        name_to_buffer[v.op.name] = buf
+                    self._buffer_variables.append(buf)
+            self._snapshot_ops.append(tf.group(*assign_ops))
+            self._savers.append(tf.train.Saver(
+                name_to_buffer, max_to_keep=None, sharded=False))
+
+        self._sess = None
+        self._thread = None
+        self._free = queue.Queue()
+        self._pending = queue.Queue()
+        self._error = None
+        self._checkpoints = []
+
+    def start(self, sess, save_dir=None):
+        '''
+        Initialize the buffers and start the writer thread.
+
+        If save_dir already has a checkpoint state, its checkpoints are
+        kept and count towards max_to_keep.
+        '''
+        self._sess = sess
+        sess.run(tf.variables_initializer(self._buffer_variables))
+        for k in range(self._max_in_flight):
+            self._free.put(k)
+
+        if save_dir is not None:
+            ckpt_state = tf.train.get_checkpoint_state(save_dir)
+            if ckpt_state is not None:
+                self._checkpoints = list(
+                    ckpt_state.all_model_checkpoint_paths)
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def save(self, sess, save_path, global_step=None):
+        '''
+        Snapshot the variables and queue them to be written to
+        save_path-{global_step}.  Returns the checkpoint prefix.
+
+        global_step can be an int or a tensor, as for tf.train.Saver.save.
+        '''
+        self._raise_error()
+        k = self._free.get()
+
+        if isinstance(global_step, (tf.Tensor, tf.Variable)):
+            # read the step in the same run as the snapshot
+            _, global_step = sess.run([self._snapshot_ops[k], global_step])
+        else:
+            sess.run(self._snapshot_ops[k])
+
+        if global_step is None:
+            checkpoint_path = save_path
+        else:
+            checkpoint_path = '%s-%d' % (save_path, int(global_step))
+
+        self._pending.put((k, checkpoint_path))
+        return checkpoint_path
+
+    def close(self):
+        '''Wait for the pending checkpoints to be written.'''
+        if self._thread is not None:
+            self._pending.put(None)
+            self._thread.join()
+            self._thread = None
+        self._raise_error()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error = self._error
+            self._error = None
+            raise error
+
+    def _run(self):
+        while True:
+            item = self._pending.get()
+            if item is None:
+                return
+            k, checkpoint_path = item
+            try:
+                self._write(k, checkpoint_path)
+            except Exception as e:
+                # surface it in the training thread on the next save
+                self._error = e
+            finally:
+                self._free.put(k)
+
+    def _write(self, k, checkpoint_path):
+        save_dir, basename = os.path.split(checkpoint_path)
+        tmp_dir = os.path.join(save_dir, '.tmp_' + basename)
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+
+        tmp_path = os.path.join(tmp_dir, basename)
+        self._savers[k].save(self._sess, tmp_path,
+                             write_meta_graph=False, write_state=False)
+
+        # move the data files first and the index last, the index is
+        # what marks the checkpoint as complete
+        files = glob.glob(tmp_path + '.*')
+        files.sort(key=lambda f: f.endswith('.index'))
+        for fname in files:
+            os.rename(fname, os.path.join(save_dir, os.path.basename(fname)))
+        shutil.rmtree(tmp_dir)
+
+        if checkpoint_path in self._checkpoints:
+            self._checkpoints.remove(checkpoint_path)
+        self._checkpoints.append(checkpoint_path)
+        while self._max_to_keep and len(self._checkpoints) > self._max_to_keep:
+            old_path = self._checkpoints.pop(0)
+            for fname in glob.glob(old_path + '.*'):
+                os.remove(fname)
+
+        tf.train.update_checkpoint_state(
+            save_dir, checkpoint_path,
+            all_model_checkpoint_paths=self._checkpoints)
@@ -6,6 +6,7 @@ import numpy as np
 
 from typing import List
 
+from .directions import resolve_direction, direction_names
 
 
 class Vocabulary(object):
@@ -162,7 +163,9 @@ class Vocabulary(object):
         Sentence is a single string with tokens separated by whitespace.
 
         If reverse, then the sentence is assumed to be reversed, and
-            this method will swap the BOS/EOS tokens appropriately."""
+            this method will swap the BOS/EOS tokens appropriately.
+        Likewise if permuted is the name of a direction, the sentence is
+            assumed to be permuted and is wrapped in its special tokens."""
 
         if split:
             word_ids = [
@@ -171,26 +174,46 @@ class Vocabulary(object):
         else:
             word_ids = [self.word_to_id(cur_word) for cur_word in sentence]
 
-        if reverse:
-            return np.array([self.eos] + word_ids + [self.bos], dtype=np.int32)
-        else:
-            if permuted is not None:
-                if permuted == 'inward':
-                    return np.array([self.sos] + word_ids + [self.mos], dtype=np.int32)
-                elif permuted == 'outward':
-                    return np.array([self.mos] + word_ids + [self.sos], dtype=np.int32)
-                elif permuted == 'skip2forward':
-                    return np.array([self.s2s] + word_ids + [self.s2e], dtype=np.int32)
-                elif permuted == 'skip2backward':
-                    return np.array([self.s2e] + word_ids + [self.s2s], dtype=np.int32)
-                elif permuted == 'skip3forward':
-                    return np.array([self.s3s] + word_ids + [self.s3e], dtype=np.int32)
-                elif permuted == 'skip3backward':
-                    return np.array([self.s3e] + word_ids + [self.s3s], dtype=np.int32)
-                else:
-                    raise ValueError("Not implemented")
-            else:
-                return np.array([self.bos] + word_ids + [self.eos], dtype=np.int32)
+        direction = resolve_direction(reverse, permuted)
+        return np.array(
+            [getattr(self, direction.bos)] + word_ids +
+            [getattr(self, direction.eos)], dtype=np.int32)
+
+
+# char ids 0-255 come from utf-8 encoding bytes, the special chars follow
+BOW_CHAR = 258  # <begin word>
+EOW_CHAR = 259  # <end word>
+PAD_CHAR = 260  # <padding>
+
+# the special char of each sentence boundary token, keyed by the name of
+# its Vocabulary attribute (the bos and eos of the directions)
+BOUNDARY_CHARS = {
+    'bos': 256,
+    'eos': 257,
+    'mos': 261,
+    'sos': 262,
+    's2s': 263,
+    's2e': 264,
+    's3s': 265,
+    's3e': 266,
+}
+
+
+def _make_boundary_chars(c, max_word_length):
+    r = np.zeros([max_word_length], dtype=np.int32)
+    r[:] = PAD_CHAR
+    r[0] = BOW_CHAR
+    r[1] = c
+    r[2] = EOW_CHAR
+    return r
+
+
+def boundary_char_ids(name, max_word_length):
+    '''
+    The character ids of the sentence boundary token name (e.g. 'mos'),
+    as UnicodeCharsVocabulary.mos_chars.
+    '''
+    return _make_boundary_chars(BOUNDARY_CHARS[name], max_word_length)
 
 
 class UnicodeCharsVocabulary(Vocabulary):
@@ -210,17 +233,17 @@ class UnicodeCharsVocabulary(Vocabulary):
 
         # char ids 0-255 come from utf-8 encoding bytes
         # assign 256-300 to special chars
-        self.bos_char = 256  # <begin sentence>
-        self.eos_char = 257  # <end sentence>
-        self.bow_char = 258  # <begin word>
-        self.eow_char = 259  # <end word>
-        self.pad_char = 260  # <padding>
-        self.mos_char = 261  # <middle of sentence>
-        self.sos_char = 262  # <side of sentence>: similar to the start of the sentence
-        self.s2s_char = 263  # <skip2start>
-        self.s2e_char = 264  # <skip2end>
-        self.s3s_char = 265  # <skip3start>
-        self.s3e_char = 266  # <skip3end>
+        self.bos_char = BOUNDARY_CHARS['bos']  # <begin sentence>
+        self.eos_char = BOUNDARY_CHARS['eos']  # <end sentence>
+        self.bow_char = BOW_CHAR  # <begin word>
+        self.eow_char = EOW_CHAR  # <end word>
+        self.pad_char = PAD_CHAR  # <padding>
+        self.mos_char = BOUNDARY_CHARS['mos']  # <middle of sentence>
+        self.sos_char = BOUNDARY_CHARS['sos']  # <side of sentence>: similar to the start of the sentence
+        self.s2s_char = BOUNDARY_CHARS['s2s']  # <skip2start>
+        self.s2e_char = BOUNDARY_CHARS['s2e']  # <skip2end>
+        self.s3s_char = BOUNDARY_CHARS['s3s']  # <skip3start>
+        self.s3e_char = BOUNDARY_CHARS['s3e']  # <skip3end>
 
         num_words = len(self._id_to_word)
 
@@ -229,12 +252,7 @@ class UnicodeCharsVocabulary(Vocabulary):
 
         # the charcter representation of the begin/end of sentence characters
         def _make_bos_eos(c):
-            r = np.zeros([self.max_word_length], dtype=np.int32)
-            r[:] = self.pad_char
-            r[0] = self.bow_char
-            r[1] = c
-            r[2] = self.eow_char
-            return r
+            return _make_boundary_chars(c, self.max_word_length)
         self.bos_chars = _make_bos_eos(self.bos_char)
         self.eos_chars = _make_bos_eos(self.eos_char)
         self.mos_chars = _make_bos_eos(self.mos_char)
@@ -283,7 +301,7 @@ class UnicodeCharsVocabulary(Vocabulary):
         else:
             return self._convert_word_to_char_ids(word)
 
-    def encode_chars(self, sentence, reverse=False, permuted=False, split=True):
+    def encode_chars(self, sentence, reverse=False, permuted=None, split=True):
         '''
         Encode the sentence as a white space delimited string of tokens.
         '''
@@ -293,26 +311,10 @@ class UnicodeCharsVocabulary(Vocabulary):
         else:
             chars_ids = [self.word_to_char_ids(cur_word)
                      for cur_word in sentence]
-        if reverse:
-            return np.vstack([self.eos_chars] + chars_ids + [self.bos_chars])
-        else:
-            if permuted is not None:
-                if permuted == 'inward':
-                    return np.vstack([self.sos_chars] + chars_ids + [self.mos_chars])
-                elif permuted == 'outward':
-                    return np.vstack([self.mos_chars] + chars_ids + [self.sos_chars])
-                elif permuted == "skip2forward":
-                    return np.vstack([self.s2s_chars] + chars_ids + [self.s2e_chars])
-                elif permuted == "skip2backward":
-                    return np.vstack([self.s2e_chars] + chars_ids + [self.s2s_chars])
-                elif permuted == "skip3forward":
-                    return np.vstack([self.s3s_chars] + chars_ids + [self.s3e_chars])
-                elif permuted == "skip3backward":
-                    return np.vstack([self.s3e_chars] + chars_ids + [self.s3s_chars])
-                else:
-                    raise ValueError("Not implemented")
-            else:
-                return np.vstack([self.bos_chars] + chars_ids + [self.eos_chars])
+        direction = resolve_direction(reverse, permuted)
+        return np.vstack(
+            [getattr(self, direction.bos + '_chars')] + chars_ids +
+            [getattr(self, direction.eos + '_chars')])
 
 
 class Batcher(object):
@@ -385,9 +387,67 @@ class TokenBatcher(object):
         return X_ids
 
 
+class HybridBatcher(object):
+    '''
+    Batch sentences of tokenized text into token id matrices and the
+    character ids of the tokens not in the vocabulary, for the hybrid
+    inputs of BidirectionalLanguageModel.
+    '''
+    def __init__(self, lm_vocab_file: str, max_token_length: int):
+        '''
+        lm_vocab_file = the language model vocabulary file (one line per
+            token), the vocabulary of the embedding_weight_file
+        max_token_length = the maximum number of characters in each token
+        '''
+        self._lm_vocab = UnicodeCharsVocabulary(
+            lm_vocab_file, max_token_length
+        )
+        self._max_token_length = max_token_length
+
+    def batch_sentences(self, sentences: List[List[str]]):
+        '''
+        Batch the sentences as token ids and character ids
+        Each sentence is a list of tokens without <s> or </s>, e.g.
+        [['The', 'first', 'sentence', '.'], ['Second', '.']]
+
+        Returns (token ids, character ids), the token ids as TokenBatcher
+        and the character ids as Batcher for the tokens not in the
+        vocabulary, zero for the others.
+        '''
+        n_sentences = len(sentences)
+        max_length = max(len(sentence) for sentence in sentences) + 2
+
+        X_ids = np.zeros((n_sentences, max_length), dtype=np.int64)
+        X_char_ids = np.zeros(
+            (n_sentences, max_length, self._max_token_length),
+            dtype=np.int64
+        )
+
+        for k, sent in enumerate(sentences):
+            length = len(sent) + 2
+            ids_without_mask = self._lm_vocab.encode(sent, split=False)
+            # add one so that 0 is the mask value
+            X_ids[k, :length] = ids_without_mask + 1
+            for i, token in enumerate(sent):
+                if self._lm_vocab.word_to_id(token) == self._lm_vocab.unk:
+                    # the embedding of the token id is replaced by the
+                    # char CNN, any id in the vocabulary will do
+                    X_ids[k, i + 1] = max(self._lm_vocab.unk, 0) + 1
+                    X_char_ids[k, i + 1, :] = \
+                        self._lm_vocab.word_to_char_ids(token) + 1
+
+        return X_ids, X_char_ids
+
+
 ##### for training
-def _get_batch(generator, batch_size, num_steps, max_word_length):
-    """Read batches of input."""
+def _get_batch(generator, batch_size, num_steps, max_word_length,
+               flush=False):
+    """Read batches of input.
+
+    If flush, the streams are drained once the generator is exhausted
+    instead of dropping the incomplete batches, and each batch has
+    next_token_weights, 1 for the real targets and 0 for the padding.
+    """
     cur_stream = [None] * batch_size
 
     no_more_data = False
@@ -399,6 +459,7 @@ def _get_batch(generator, batch_size, num_steps, max_word_length):
         else:
             char_inputs = None
         targets = np.zeros([batch_size, num_steps], np.int32)
+        weights = np.zeros([batch_size, num_steps], np.float32)
 
         for i in range(batch_size):
             cur_pos = 0
@@ -420,6 +481,7 @@ def _get_batch(generator, batch_size, num_steps, max_word_length):
                     char_inputs[i, cur_pos:next_pos] = cur_stream[i][1][
                                                                     :how_many]
                 targets[i, cur_pos:next_pos] = cur_stream[i][0][1:how_many+1]
+                weights[i, cur_pos:next_pos] = 1.0
 
                 cur_pos = next_pos
 
@@ -427,79 +489,19 @@ def _get_batch(generator, batch_size, num_steps, max_word_length):
                 if max_word_length is not None:
                     cur_stream[i][1] = cur_stream[i][1][how_many:]
 
-        if no_more_data:
-            # There is no more data.  Note: this will not return data
-            # for the incomplete batch
+        if no_more_data and (not flush or not weights.any()):
+            # There is no more data.  Note: unless flushing, this will not
+            # return data for the incomplete batch
             break
 
         X = {'token_ids': inputs, 'tokens_characters': char_inputs,
                  'next_token_id': targets}
+        if flush:
+            X['next_token_weights'] = weights
 
         yield X
 
 
-# TODO(permute list for a sequence)
-def _permute_list(list, permute_pattern):
-    permuted = []
-    if permute_pattern == 'inward':
-        i = 0
-        j = len(list)-1
-        for k in range(0, len(list)):
-            if k % 2 == 0:
-                permuted.append(list[i])
-                i += 1
-            else:
-                permuted.append(list[j])
-                j -= 1
-    elif permute_pattern == 'outward':
-        j = int(len(list)/2)
-        i = int(len(list)/2) - 1
-        for k in range(0, len(list)):
-            if k % 2 == 0:
-                permuted.append(list[j])
-                j += 1
-            else:
-                permuted.append(list[i])
-                i -= 1
-    elif permute_pattern == "skip2forward":
-        i = 0
-        j = 1
-        for k in range(i, len(list), 2):
-            permuted.append(list[k])
-        for k in range(j, len(list), 2):
-            permuted.append(list[k])
-    elif permute_pattern == "skip2backward":
-        i = len(list) - 1
-        j = len(list) - 2
-        for k in range(i, -1, -2):
-            permuted.append(list[k])
-        for k in range(j, -1, -2):
-            permuted.append(list[k])
-    elif permute_pattern == "skip3forward":
-        i = 0
-        j = 1
-        k = 2
-        for m in range(i, len(list), 3):
-            permuted.append(list[m])
-        for m in range(j, len(list), 3):
-            permuted.append(list[m])
-        for m in range(k, len(list), 3):
-            permuted.append(list[m])
-    elif permute_pattern == "skip3backward":
-        i = len(list) - 1
-        j = len(list) - 2
-        k = len(list) - 3
-        for m in range(i, -1, -3):
-            permuted.append(list[m])
-        for m in range(j, -1, -3):
-            permuted.append(list[m])
-        for m in range(k, -1, -3):
-            permuted.append(list[m])
-    else:
-        raise ValueError('Pattern error')
-    return permuted
-
-
 class LMDataset(object):
     """
     Hold a language model dataset.
@@ -509,22 +511,29 @@ class LMDataset(object):
     """
     # NOTE(feiga): add param permuted, like the reverse
     def __init__(self, filepattern, vocab, reverse=False, permuted=None, test=False,
-                 shuffle_on_load=False):
+                 shuffle_on_load=False, task_index=0, n_tasks=1):
         '''
         filepattern = a glob string that specifies the list of files.
         vocab = an instance of Vocabulary or UnicodeCharsVocabulary
         reverse = if True, then iterate over tokens in each sentence in reverse
+        permuted = the name of a direction (see bilm.directions) to permute
+            the tokens in each sentence
         test = if True, then iterate through all data once then stop.
             Otherwise, iterate forever.
         shuffle_on_load = if True, then shuffle the sentences after loading.
+        task_index, n_tasks = for distributed training, only use every
+            n_tasks-th file starting from task_index of the sorted files.
         '''
         self._vocab = vocab
         self._all_shards = glob.glob(filepattern)
+        if n_tasks > 1:
+            self._all_shards = sorted(self._all_shards)[task_index::n_tasks]
         print('Found %d shards at %s' % (len(self._all_shards), filepattern))
         self._shards_to_choose = []
 
         self._reverse = reverse
         self._permuted = permuted
+        self._direction = resolve_direction(reverse, permuted)
         self._test = test
         self._shuffle_on_load = shuffle_on_load
         self._use_char_inputs = hasattr(vocab, 'encode_chars')
@@ -570,19 +579,10 @@ class LMDataset(object):
         with open(shard_name, encoding='utf-8') as f:
             sentences_raw = f.readlines()
 
-        if self._reverse:
-            sentences = []
-            for sentence in sentences_raw:
-                splitted = sentence.split()
-                splitted.reverse()
-                sentences.append(' '.join(splitted))
-        # Note(feiga): process the permuted data
-        elif self._permuted is not None:
+        if self._direction.name != 'forward':
             sentences = []
-            # for sentence in ... :
             for sentence in sentences_raw:
-                splitted = sentence.split()
-                permuted = _permute_list(splitted, self._permuted)
+                permuted = self._direction.permute(sentence.split())
                 sentences.append(' '.join(permuted))
         else:
             sentences = sentences_raw
@@ -617,9 +617,9 @@ class LMDataset(object):
         else:
             return None
 
-    def iter_batches(self, batch_size, num_steps):
+    def iter_batches(self, batch_size, num_steps, flush=False):
         for X in _get_batch(self.get_sentence(), batch_size, num_steps,
-                           self.max_word_length):
+                           self.max_word_length, flush):
 
             # token_ids = (batch_size, num_steps)
             # char_inputs = (batch_size, num_steps, 50) of character ids
@@ -632,25 +632,28 @@ class LMDataset(object):
 
 
 class BidirectionalLMDataset(object):
-    def __init__(self, filepattern, vocab, test=False, shuffle_on_load=False):
+    def __init__(self, filepattern, vocab, test=False, shuffle_on_load=False,
+                 task_index=0, n_tasks=1):
         '''
         bidirectional version of LMDataset
         '''
         self._data_forward = LMDataset(
             filepattern, vocab, reverse=False, test=test,
-            shuffle_on_load=shuffle_on_load)
+            shuffle_on_load=shuffle_on_load,
+            task_index=task_index, n_tasks=n_tasks)
         self._data_reverse = LMDataset(
             filepattern, vocab, reverse=True, test=test,
-            shuffle_on_load=shuffle_on_load)
+            shuffle_on_load=shuffle_on_load,
+            task_index=task_index, n_tasks=n_tasks)
 
-    def iter_batches(self, batch_size, num_steps):
+    def iter_batches(self, batch_size, num_steps, flush=False):
         max_word_length = self._data_forward.max_word_length
 
         for X, Xr in zip(
             _get_batch(self._data_forward.get_sentence(), batch_size,
-                      num_steps, max_word_length),
+                      num_steps, max_word_length, flush),
             _get_batch(self._data_reverse.get_sentence(), batch_size,
-                      num_steps, max_word_length)
+                      num_steps, max_word_length, flush)
             ):
 
             for k, v in Xr.items():
@@ -661,159 +664,40 @@ class BidirectionalLMDataset(object):
 
 # NOTE(feiga): Dataset for more directions beyond bidirectionial lstm
 class MultidirectionalLMDataset(object):
-    def __init__(self, filepattern, vocab, permute_number, test=False, shuffle_on_load=False):
+    def __init__(self, filepattern, vocab, permute_number=4, test=False,
+                 shuffle_on_load=False, task_index=0, n_tasks=1,
+                 directions=None):
         '''
         multidirectional version of LMDataset
-        '''
-        # NOTE(lijun): add permute number
-        self._permute_number = permute_number
-
-        # NOTE(feiga): More dataset
-        self._data_forward = LMDataset(
-            filepattern, vocab, reverse=False, test=test,
-            shuffle_on_load=shuffle_on_load)
-        self._data_reverse = LMDataset(
-            filepattern, vocab, reverse=True, test=test,
-            shuffle_on_load=shuffle_on_load)
-        # TODO(lijun):
-        if permute_number == 4:
-            # TODO(feiga):
-            self._data_permuted1 = LMDataset(
-                filepattern, vocab, reverse=False, permuted='inward', test=test,
-                shuffle_on_load=shuffle_on_load)
-            self._data_permuted2 = LMDataset(
-                filepattern, vocab, reverse=False, permuted='outward', test=test,
-                shuffle_on_load=shuffle_on_load)
-        elif permute_number == 6:
-            self._data_permuted1 = LMDataset(
-                filepattern, vocab, reverse=False, permuted='inward', test=test,
-                shuffle_on_load=shuffle_on_load)
-            self._data_permuted2 = LMDataset(
-                filepattern, vocab, reverse=False, permuted='outward', test=test,
-                shuffle_on_load=shuffle_on_load)
-            self._data_permuted3 = LMDataset(
-                filepattern, vocab, reverse=False, permuted="skip2forward", test=test,
-                shuffle_on_load=shuffle_on_load)
-            self._data_permuted4 = LMDataset(
-                filepattern, vocab, reverse=False, permuted="skip2backward", test=test,
-                shuffle_on_load=shuffle_on_load)
-        elif permute_number == 8:
-            self._data_permuted1 = LMDataset(
-                filepattern, vocab, reverse=False, permuted='inward', test=test,
-                shuffle_on_load=shuffle_on_load)
-            self._data_permuted2 = LMDataset(
-                filepattern, vocab, reverse=False, permuted='outward', test=test,
-                shuffle_on_load=shuffle_on_load)
-            self._data_permuted3 = LMDataset(
-                filepattern, vocab, reverse=False, permuted="skip2forward", test=test,
-                shuffle_on_load=shuffle_on_load)
-            self._data_permuted4 = LMDataset(
-                filepattern, vocab, reverse=False, permuted="skip2backward", test=test,
-                shuffle_on_load=shuffle_on_load)
-            self._data_permuted5 = LMDataset(
-                filepattern, vocab, reverse=False, permuted="skip3forward", test=test,
-                shuffle_on_load=shuffle_on_load)
-            self._data_permuted6 = LMDataset(
-                filepattern, vocab, reverse=False, permuted="skip3backward", test=test,
-                shuffle_on_load=shuffle_on_load)
-        else:
-            raise ValueError('Not implemented.')
 
-    def iter_batches(self, batch_size, num_steps):
-        max_word_length = self._data_forward.max_word_length
-
-        # NOTE (lijun): different permute number to combine data
-
-        if self._permute_number == 4:
-            # NOTE(feiga): get batches from every datasets
-            # TODO(feiga): for X, Xr, Xp1, Xp2...
-            for X, Xr, Xp1, Xp2 in zip(
-                _get_batch(self._data_forward.get_sentence(), batch_size,
-                          num_steps, max_word_length),
-                _get_batch(self._data_reverse.get_sentence(), batch_size,
-                          num_steps, max_word_length),
-                # Note(feiga):
-                # add for permuted data
-                _get_batch(self._data_permuted1.get_sentence(), batch_size,
-                          num_steps, max_word_length),
-                _get_batch(self._data_permuted2.get_sentence(), batch_size,
-                         num_steps, max_word_length)
-            ):
-                # TODO(feiga): for X, Xr, Xp1, Xp2...
-                for k, v in Xr.items():
-                    X[k + '_reverse'] = v
-                for k, v in Xp1.items():
-                    X[k + '_permuted1'] = v
-                for k, v in Xp2.items():
-                    X[k + '_permuted2'] = v
-
-                yield X
-
-        elif self._permute_number == 6:
-            for X, Xr, Xp1, Xp2, Xp3, Xp4 in zip(
-                    _get_batch(self._data_forward.get_sentence(), batch_size,
-                               num_steps, max_word_length),
-                    _get_batch(self._data_reverse.get_sentence(), batch_size,
-                               num_steps, max_word_length),
-                    # Note(lijun): add permute3 and permute4
-                    _get_batch(self._data_permuted1.get_sentence(), batch_size,
-                               num_steps, max_word_length),
-                    _get_batch(self._data_permuted2.get_sentence(), batch_size,
-                               num_steps, max_word_length),
-                    _get_batch(self._data_permuted3.get_sentence(), batch_size,
-                               num_steps, max_word_length),
-                    _get_batch(self._data_permuted4.get_sentence(), batch_size,
-                               num_steps, max_word_length)
-            ):
-                for k, v in Xr.items():
-                    X[k + '_reverse'] = v
-                for k, v in Xp1.items():
-                    X[k + '_permuted1'] = v
-                for k, v in Xp2.items():
-                    X[k + '_permuted2'] = v
-                for k, v in Xp3.items():
-                    X[k + '_permuted3'] = v
-                for k, v in Xp4.items():
-                    X[k + '_permuted4'] = v
-
-                yield X
-
-        elif self._permute_number == 8:
-            for X, Xr, Xp1, Xp2, Xp3, Xp4, Xp5, Xp6 in zip(
-                    _get_batch(self._data_forward.get_sentence(), batch_size,
-                               num_steps, max_word_length),
-                    _get_batch(self._data_reverse.get_sentence(), batch_size,
-                               num_steps, max_word_length),
-                    # Note(lijun): add permute3, 4, 5, 6
-                    _get_batch(self._data_permuted1.get_sentence(), batch_size,
-                               num_steps, max_word_length),
-                    _get_batch(self._data_permuted2.get_sentence(), batch_size,
-                               num_steps, max_word_length),
-                    _get_batch(self._data_permuted3.get_sentence(), batch_size,
-                               num_steps, max_word_length),
-                    _get_batch(self._data_permuted4.get_sentence(), batch_size,
-                               num_steps, max_word_length),
-                    _get_batch(self._data_permuted5.get_sentence(), batch_size,
-                               num_steps, max_word_length),
-                    _get_batch(self._data_permuted6.get_sentence(), batch_size,
-                               num_steps, max_word_length)
-            ):
-                for k, v in Xr.items():
-                    X[k + '_reverse'] = v
-                for k, v in Xp1.items():
-                    X[k + '_permuted1'] = v
-                for k, v in Xp2.items():
-                    X[k + '_permuted2'] = v
-                for k, v in Xp3.items():
-                    X[k + '_permuted3'] = v
-                for k, v in Xp4.items():
-                    X[k + '_permuted4'] = v
-                for k, v in Xp5.items():
-                    X[k + '_permuted5'] = v
-                for k, v in Xp6.items():
-                    X[k + '_permuted6'] = v
-
-                yield X
-        else:
-            raise ValueError('Not implemented.')
+        directions = the names of the directions (see bilm.directions),
+            by default forward, backward and the first permute_number - 2
+            permuted directions.
+        '''
+        if directions is None:
+            directions = direction_names(True, True, permute_number)
+        self._directions = [resolve_direction(permuted=name)
+                            for name in directions]
+
+        self._datasets = [
+            LMDataset(filepattern, vocab, permuted=direction.name, test=test,
+                      shuffle_on_load=shuffle_on_load,
+                      task_index=task_index, n_tasks=n_tasks)
+            for direction in self._directions
+        ]
+
+    def iter_batches(self, batch_size, num_steps, flush=False):
+        max_word_length = self._datasets[0].max_word_length
+
+        # get batches from every dataset and combine them, with the
+        # keys of each direction suffixed
+        for batches in zip(*[
+                _get_batch(data.get_sentence(), batch_size,
+                           num_steps, max_word_length, flush)
+                for data in self._datasets]):
+            X = {}
+            for direction, Xd in zip(self._directions, batches):
+                for k, v in Xd.items():
+                    X[k + direction.suffix] = v
 
+            yield X
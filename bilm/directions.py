@@ -0,0 +1,188 @@
+'''
+The directions a language model can read a sentence in.
+
+Each direction is a permutation of the tokens in a sentence, the special
+tokens placed before and after the permuted sentence, the suffix of its
+keys in the batches and of its placeholder names, and the variable scope
+of its LSTM.  The models, feeds and datasets are built by iterating over
+the directions in the options, so any subset of them can be trained.
+'''
+
+from collections import OrderedDict
+
+
+def _permute_list(list, permute_pattern):
+    permuted = []
+    if permute_pattern == 'inward':
+        i = 0
+        j = len(list)-1
+        for k in range(0, len(list)):
+            if k % 2 == 0:
+                permuted.append(list[i])
+                i += 1
+            else:
+                permuted.append(list[j])
+                j -= 1
+    elif permute_pattern == 'outward':
+        j = int(len(list)/2)
+        i = int(len(list)/2) - 1
+        for k in range(0, len(list)):
+            if k % 2 == 0:
+                permuted.append(list[j])
+                j += 1
+            else:
+                permuted.append(list[i])
+                i -= 1
+    elif permute_pattern == "skip2forward":
+        i = 0
+        j = 1
+        for k in range(i, len(list), 2):
+            permuted.append(list[k])
+        for k in range(j, len(list), 2):
+            permuted.append(list[k])
+    elif permute_pattern == "skip2backward":
+        i = len(list) - 1
+        j = len(list) - 2
+        for k in range(i, -1, -2):
+            permuted.append(list[k])
+        for k in range(j, -1, -2):
+            permuted.append(list[k])
+    elif permute_pattern == "skip3forward":
+        i = 0
+        j = 1
+        k = 2
+        for m in range(i, len(list), 3):
+            permuted.append(list[m])
+        for m in range(j, len(list), 3):
+            permuted.append(list[m])
+        for m in range(k, len(list), 3):
+            permuted.append(list[m])
+    elif permute_pattern == "skip3backward":
+        i = len(list) - 1
+        j = len(list) - 2
+        k = len(list) - 3
+        for m in range(i, -1, -3):
+            permuted.append(list[m])
+        for m in range(j, -1, -3):
+            permuted.append(list[m])
+        for m in range(k, -1, -3):
+            permuted.append(list[m])
+    else:
+        raise ValueError('Pattern error')
+    return permuted
+
+
+class Direction(object):
+    '''
+    name = the name of the direction, e.g. 'forward'
+    suffix = appended to the batch keys ('token_ids', 'tokens_characters',
+        'next_token_id') and to the model placeholders and attributes
+    bos, eos = the names of the Vocabulary attributes of the special
+        tokens at the start and end of the permuted sentence, e.g. 'bos'.
+        The character ids of the token are the attribute + '_chars'
+        of UnicodeCharsVocabulary.
+    scope = the variable scope of the LSTM for this direction
+    permutation = a function from a list of tokens to the permuted list
+    '''
+    def __init__(self, name, suffix, bos, eos, scope, permutation):
+        self.name = name
+        self.suffix = suffix
+        self.bos = bos
+        self.eos = eos
+        self.scope = scope
+        self.permutation = permutation
+
+    def permute(self, tokens):
+        return self.permutation(tokens)
+
+    def __repr__(self):
+        return 'Direction(%s)' % self.name
+
+
+def _pattern(name):
+    return lambda tokens: _permute_list(tokens, name)
+
+
+DIRECTIONS = OrderedDict()
+
+
+def register_direction(direction):
+    '''Add a direction to the registry.'''
+    if direction.name in DIRECTIONS:
+        raise ValueError("Direction %s already registered" % direction.name)
+    DIRECTIONS[direction.name] = direction
+    return direction
+
+
+# the suffixes and scopes are those of the existing models and checkpoints
+register_direction(Direction(
+    'forward', '', 'bos', 'eos', 'RNN_0', lambda tokens: list(tokens)))
+register_direction(Direction(
+    'backward', '_reverse', 'eos', 'bos', 'RNN_1',
+    lambda tokens: list(reversed(tokens))))
+register_direction(Direction(
+    'inward', '_permuted1', 'sos', 'mos', 'RNN_2', _pattern('inward')))
+register_direction(Direction(
+    'outward', '_permuted2', 'mos', 'sos', 'RNN_3', _pattern('outward')))
+register_direction(Direction(
+    'skip2forward', '_permuted3', 's2s', 's2e', 'RNN_4',
+    _pattern('skip2forward')))
+register_direction(Direction(
+    'skip2backward', '_permuted4', 's2e', 's2s', 'RNN_5',
+    _pattern('skip2backward')))
+register_direction(Direction(
+    'skip3forward', '_permuted5', 's3s', 's3e', 'RNN_6',
+    _pattern('skip3forward')))
+register_direction(Direction(
+    'skip3backward', '_permuted6', 's3e', 's3s', 'RNN_7',
+    _pattern('skip3backward')))
+
+
+def get_direction(name):
+    if name not in DIRECTIONS:
+        raise ValueError("Unknown direction %s" % name)
+    return DIRECTIONS[name]
+
+
+def resolve_direction(reverse=False, permuted=None):
+    '''The direction for the reverse and permuted arguments of the
+    vocabularies and LMDataset.'''
+    if reverse:
+        return DIRECTIONS['backward']
+    elif permuted:
+        return get_direction(permuted)
+    else:
+        return DIRECTIONS['forward']
+
+
+def direction_names(bidirectional=False, multidirectional=False,
+                    permute_number=4):
+    '''The directions of the bidirectional and multidirectional options,
+    the first permute_number - 2 permuted directions after forward and
+    backward.'''
+    names = ['forward']
+    if bidirectional:
+        names.append('backward')
+    if multidirectional:
+        names.extend(list(DIRECTIONS)[2:permute_number])
+    return names
+
+
+def get_directions(options, permute_number=None):
+    '''
+    The list of directions for a model with options.
+
+    options['directions'] is a list of direction names.  Otherwise they
+    are given by 'bidirectional', 'multidirectional' and 'permute_number'
+    (or permute_number if it isn't in options).
+    '''
+    if options.get('directions') is not None:
+        names = options['directions']
+    else:
+        if permute_number is None:
+            permute_number = 4
+        names = direction_names(
+            options.get('bidirectional', False),
+            options.get('multidirectional', False),
+            options.get('permute_number', permute_number))
+    return [get_direction(name) for name in names]
@@ -35,14 +35,18 @@ def weight_layers(name, bilm_ops, l2_coef=None,
         else:
             return 0.0
 
-    # Get ops for computing LM embeddings and mask
-    lm_embeddings = bilm_ops['lm_embeddings']
+    # Get ops for computing LM layers and mask.  The layers are mixed
+    # before they are stacked in lm_embeddings when the biLM returns them
+    if 'lm_layers' in bilm_ops:
+        lm_layers = bilm_ops['lm_layers']
+    else:
+        lm_layers = tf.unstack(bilm_ops['lm_embeddings'], axis=1)
     mask = bilm_ops['mask']
 
-    n_lm_layers = int(lm_embeddings.get_shape()[1])
-    lm_dim = int(lm_embeddings.get_shape()[3])
+    n_lm_layers = len(lm_layers)
+    lm_dim = int(lm_layers[-1].get_shape()[-1])
 
-    with tf.control_dependencies([lm_embeddings, mask]):
+    with tf.control_dependencies(lm_layers + [mask]):
         # Cast the mask and broadcast for layer use.
         mask_float = tf.cast(mask, 'float32')
         broadcast_mask = tf.expand_dims(mask_float, axis=-1)
@@ -59,9 +63,8 @@ def weight_layers(name, bilm_ops, l2_coef=None,
             )
 
         if use_top_only:
-            layers = tf.split(lm_embeddings, n_lm_layers, axis=1)
             # just the top layer
-            sum_pieces = tf.squeeze(layers[-1], squeeze_dims=1)
+            sum_pieces = lm_layers[-1]
             # no regularization
             reg = 0.0
         else:
@@ -77,16 +80,13 @@ def weight_layers(name, bilm_ops, l2_coef=None,
             normed_weights = tf.split(
                 tf.nn.softmax(W + 1.0 / n_lm_layers), n_lm_layers
             )
-            # split LM layers
-            layers = tf.split(lm_embeddings, n_lm_layers, axis=1)
-    
             # compute the weighted, normalized LM activations
             pieces = []
-            for w, t in zip(normed_weights, layers):
+            for w, t in zip(normed_weights, lm_layers):
                 if do_layer_norm:
-                    pieces.append(w * _do_ln(tf.squeeze(t, squeeze_dims=1)))
+                    pieces.append(w * _do_ln(t))
                 else:
-                    pieces.append(w * tf.squeeze(t, squeeze_dims=1))
+                    pieces.append(w * t)
             sum_pieces = tf.add_n(pieces)
     
             # get the regularizer 
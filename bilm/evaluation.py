@@ -0,0 +1,403 @@
+'''
+Evaluate language models on sharded test sets with several worker
+processes and merge the results into a corpus perplexity over every
+target token.
+'''
+
+import os
+import time
+import json
+import glob
+import multiprocessing
+
+import tensorflow as tf
+import numpy as np
+
+from .data import LMDataset, BidirectionalLMDataset, \
+    MultidirectionalLMDataset
+from .training import LanguageModel, _get_feed_dict_from_X, load_vocab
+from .directions import DIRECTIONS, get_directions
+
+
+def load_test_data(options, vocab, filepattern):
+    '''
+    Create the dataset to evaluate a model with the given options
+    on all files matching filepattern.
+    '''
+    kwargs = {
+        'test': True,
+        'shuffle_on_load': False,
+    }
+    names = [d.name for d in get_directions(options)]
+    if names == ['forward']:
+        return LMDataset(filepattern, vocab, **kwargs)
+    elif names == ['forward', 'backward']:
+        return BidirectionalLMDataset(filepattern, vocab, **kwargs)
+    else:
+        return MultidirectionalLMDataset(
+            filepattern, vocab, directions=names, **kwargs)
+
+
+class ShardEvaluator(object):
+    '''
+    Holds a session with a test graph restored from a checkpoint and
+    accumulates the total loss and token counts over datasets.
+
+    The graph is built once, so many shards (or checkpoints, with restore)
+    can be evaluated without paying the graph construction cost again.
+    '''
+    def __init__(self, options, ckpt_file, batch_size=256,
+                 device='/gpu:0', config=None):
+        self.options = options
+        self.batch_size = batch_size
+        self._char_inputs = 'char_cnn' in options
+        self._suffixes = [d.suffix for d in get_directions(options)]
+
+        if config is None:
+            config = tf.ConfigProto(allow_soft_placement=True)
+
+        self._graph = tf.Graph()
+        with self._graph.as_default():
+            with tf.device(device), tf.variable_scope('lm'):
+                test_options = dict(options)
+                test_options['batch_size'] = batch_size
+                test_options['unroll_steps'] = 1
+                self.model = LanguageModel(test_options, False)
+            self.sess = tf.Session(config=config)
+            self._loader = tf.train.Saver()
+        self.restore(ckpt_file)
+
+        self.directions = [d.name for d in self.model.directions]
+
+    def restore(self, ckpt_file):
+        '''Load the variables from another checkpoint of the same model.'''
+        self._loader.restore(self.sess, ckpt_file)
+
+    def _zero_batch(self):
+        X = {}
+        for suffix in self._suffixes:
+            X['token_ids' + suffix] = np.zeros(
+                [self.batch_size, 1], dtype=np.int64)
+            X['next_token_id' + suffix] = np.zeros(
+                [self.batch_size, 1], dtype=np.int64)
+            if self._char_inputs:
+                max_chars = \
+                    self.options['char_cnn']['max_characters_per_token']
+                X['tokens_characters' + suffix] = np.zeros(
+                    [self.batch_size, 1, max_chars], dtype=np.int32)
+        return X
+
+    def _feed_dict(self, X):
+        return _get_feed_dict_from_X(
+            X, 0, X['token_ids'].shape[0], self.model, self._char_inputs)
+
+    def evaluate(self, data):
+        '''
+        Run the model over all batches in data, starting from a zero
+        LSTM state.  The incomplete final batches are flushed, so every
+        target token in data is scored exactly once.
+
+        Returns a dictionary with the number of scored tokens and the
+        summed (not averaged) loss for each direction.
+        '''
+        model = self.model
+        init_state_tensors = model.init_lstm_state
+        final_state_tensors = model.final_lstm_state
+
+        init_state_values = self.sess.run(
+            init_state_tensors, feed_dict=self._feed_dict(self._zero_batch()))
+
+        n_tokens = 0
+        total_loss = np.zeros(len(self.directions), dtype=np.float64)
+        for X in data.iter_batches(self.batch_size, 1, flush=True):
+            feed_dict = {t: v for t, v in zip(
+                                        init_state_tensors, init_state_values)}
+            feed_dict.update(self._feed_dict(X))
+
+            token_losses, init_state_values = self.sess.run(
+                [model.individual_token_losses, final_state_tensors],
+                feed_dict=feed_dict
+            )
+
+            # only sum the losses of the real targets, the padding of the
+            # flushed batches has weight 0.  every direction sees the
+            # same sentences, so they have the same number of targets
+            for k, (suffix, losses) in enumerate(
+                    zip(self._suffixes, token_losses)):
+                weights = X['next_token_weights' + suffix].reshape(-1)
+                total_loss[k] += np.dot(
+                    losses.astype(np.float64), weights)
+            n_tokens += int(X['next_token_weights'].sum())
+
+        return {
+            'n_tokens': n_tokens,
+            'total_loss': dict(zip(self.directions, total_loss.tolist())),
+        }
+
+    def close(self):
+        self.sess.close()
+
+
+def merge_stats(shard_stats):
+    '''
+    Merge a list of per shard stats from ShardEvaluator.evaluate into
+    the perplexity of the whole corpus for each direction.
+    '''
+    n_tokens = sum(s['n_tokens'] for s in shard_stats)
+    directions = [d for d in DIRECTIONS
+                  if any(d in s['total_loss'] for s in shard_stats)]
+
+    ret = {'n_tokens': n_tokens, 'directions': {}}
+    mean_losses = []
+    for direction in directions:
+        total = sum(s['total_loss'].get(direction, 0.0) for s in shard_stats)
+        loss = total / max(n_tokens, 1)
+        mean_losses.append(loss)
+        ret['directions'][direction] = {
+            'total_loss': total,
+            'loss': loss,
+            'perplexity': float(np.exp(loss)),
+        }
+
+    if mean_losses:
+        ret['perplexity'] = float(np.exp(np.mean(mean_losses)))
+    else:
+        ret['perplexity'] = None
+
+    return ret
+
+
+def _assign_shards(shards, n_workers):
+    # greedily give the largest remaining shard to the least loaded worker
+    # so the workers finish at roughly the same time
+    sizes = [(os.path.getsize(shard), shard) for shard in shards]
+    assignments = [[] for _ in range(n_workers)]
+    loads = [0] * n_workers
+    for size, shard in sorted(sizes, reverse=True):
+        k = loads.index(min(loads))
+        assignments[k].append(shard)
+        loads[k] += size
+    return [a for a in assignments if len(a) > 0]
+
+
+def _run_worker(args):
+    (worker_id, shards, options, ckpt_file, vocab_file,
+     batch_size, n_gpus, n_threads) = args
+
+    if n_gpus > 0:
+        # each worker only sees its own GPU, as /gpu:0
+        config = tf.ConfigProto(allow_soft_placement=True)
+        config.gpu_options.visible_device_list = str(worker_id % n_gpus)
+        config.gpu_options.allow_growth = True
+        device = '/gpu:0'
+    else:
+        config = tf.ConfigProto(
+            allow_soft_placement=True,
+            device_count={'GPU': 0},
+            intra_op_parallelism_threads=n_threads,
+            inter_op_parallelism_threads=1,
+        )
+        device = '/cpu:0'
+
+    if 'char_cnn' in options:
+        max_word_length = options['char_cnn']['max_characters_per_token']
+    else:
+        max_word_length = None
+    vocab = load_vocab(vocab_file, max_word_length)
+
+    evaluator = ShardEvaluator(options, ckpt_file, batch_size=batch_size,
+                               device=device, config=config)
+    ret = []
+    for shard in shards:
+        t1 = time.time()
+        data = load_test_data(options, vocab, shard)
+        stats = evaluator.evaluate(data)
+        stats['shard'] = shard
+        stats['time'] = time.time() - t1
+        ret.append(stats)
+    evaluator.close()
+
+    return ret
+
+
+def parallel_test(options, ckpt_file, vocab_file, test_prefix,
+                  n_workers=1, batch_size=256, n_gpus=0, outfile=None):
+    '''
+    Get the test set perplexity, splitting the test shards across
+    n_workers processes.
+
+    Each worker builds its own graph and session, on GPU
+    (worker_id % n_gpus) if n_gpus > 0 otherwise on CPU with an equal share
+    of the cores.  The summed losses and token counts from every shard are
+    merged into the corpus perplexity for each direction.
+
+    Every target token is scored exactly once, so n_tokens does not depend
+    on n_workers.  The loss of a token still depends on the sentences
+    before it in its batch stream, so the perplexity can change slightly
+    with batch_size.
+
+    If outfile is given the report is also written to it as JSON.
+    '''
+    shards = sorted(glob.glob(test_prefix))
+    if len(shards) == 0:
+        raise ValueError("No test shards found at %s" % test_prefix)
+
+    n_workers = max(1, min(n_workers, len(shards)))
+    n_threads = max(1, multiprocessing.cpu_count() // n_workers)
+    assignments = _assign_shards(shards, n_workers)
+    worker_args = [
+        (k, worker_shards, options, ckpt_file, vocab_file,
+         batch_size, n_gpus, n_threads)
+        for k, worker_shards in enumerate(assignments)
+    ]
+
+    t1 = time.time()
+    if len(worker_args) == 1:
+        results = [_run_worker(worker_args[0])]
+    else:
+        # spawn so that no tensorflow runtime state is shared with the parent
+        ctx = multiprocessing.get_context('spawn')
+        with ctx.Pool(len(worker_args)) as pool:
+            results = pool.map(_run_worker, worker_args)
+
+    shard_stats = [s for worker_stats in results for s in worker_stats]
+    report = merge_stats(shard_stats)
+    report.update({
+        'checkpoint': ckpt_file,
+        'n_workers': len(worker_args),
+        'time': time.time() - t1,
+        'shards': sorted(shard_stats, key=lambda s: s['shard']),
+    })
+
+    for direction, d in report['directions'].items():
+        print("%s perplexity = %s" % (direction, d['perplexity']))
+    print("FINISHED!  AVERAGE PERPLEXITY = %s" % report['perplexity'])
+
+    if outfile is not None:
+        with open(outfile, 'w') as fout:
+            json.dump(report, fout, indent=2)
+
+    return report
+
+
+def _checkpoint_steps(tf_save_dir):
+    # the (global step, checkpoint prefix) of the model.ckpt-* checkpoints,
+    # a checkpoint is complete once its .index file is written
+    ret = []
+    pattern = os.path.join(tf_save_dir, 'model.ckpt-*.index')
+    for index_file in glob.glob(pattern):
+        prefix = index_file[:-len('.index')]
+        try:
+            step = int(prefix.rsplit('-', 1)[1])
+        except ValueError:
+            continue
+        ret.append((step, prefix))
+    return sorted(ret)
+
+
+def _cpu_config(n_threads=None):
+    # keep the evaluation off the GPUs used for training
+    kwargs = {}
+    if n_threads is not None:
+        kwargs['intra_op_parallelism_threads'] = n_threads
+        kwargs['inter_op_parallelism_threads'] = 1
+    return tf.ConfigProto(
+        allow_soft_placement=True, device_count={'GPU': 0}, **kwargs)
+
+
+def watch_checkpoints(tf_save_dir, vocab_file, dev_prefix, tf_log_dir=None,
+                      batch_size=256, poll_secs=60, n_threads=None,
+                      max_evals=None):
+    '''
+    Evaluate each new checkpoint written to tf_save_dir while training runs.
+
+    Polls tf_save_dir every poll_secs seconds for model.ckpt-* checkpoints
+    and evaluates the newest one not yet seen on the files matching
+    dev_prefix, on CPU with n_threads threads, skipping any checkpoints
+    that were superseded in the meantime.  The graph is built once and each
+    checkpoint restored into it.
+
+    The perplexity of each direction is added to the TensorBoard log in
+    tf_log_dir (default tf_save_dir) as dev_perplexity/<direction> at the
+    global step of the checkpoint, and the report from merge_stats is
+    appended to dev_perplexity.jsonl there.
+
+    Stops after max_evals evaluations if given, otherwise runs until killed.
+    Returns the list of reports.
+    '''
+    if tf_log_dir is None:
+        tf_log_dir = tf_save_dir
+
+    # wait for the training job to write the options
+    options_file = os.path.join(tf_save_dir, 'options.json')
+    while not os.path.exists(options_file):
+        time.sleep(poll_secs)
+    with open(options_file, 'r') as fin:
+        options = json.load(fin)
+
+    if 'char_cnn' in options:
+        max_word_length = options['char_cnn']['max_characters_per_token']
+    else:
+        max_word_length = None
+    vocab = load_vocab(vocab_file, max_word_length)
+
+    evaluator = None
+    summary_writer = tf.summary.FileWriter(tf_log_dir)
+    reports = []
+    last_step = None
+    try:
+        while max_evals is None or len(reports) < max_evals:
+            checkpoints = _checkpoint_steps(tf_save_dir)
+            if not checkpoints or checkpoints[-1][0] == last_step:
+                time.sleep(poll_secs)
+                continue
+            step, ckpt_file = checkpoints[-1]
+            last_step = step
+
+            t1 = time.time()
+            try:
+                if evaluator is None:
+                    evaluator = ShardEvaluator(
+                        options, ckpt_file, batch_size=batch_size,
+                        device='/cpu:0', config=_cpu_config(n_threads))
+                else:
+                    evaluator.restore(ckpt_file)
+            except tf.errors.NotFoundError:
+                # removed by the saver before we got to it
+                continue
+
+            shard_stats = [
+                evaluator.evaluate(load_test_data(options, vocab, shard))
+                for shard in sorted(glob.glob(dev_prefix))
+            ]
+            report = merge_stats(shard_stats)
+            report.update({
+                'checkpoint': ckpt_file,
+                'global_step': step,
+                'time': time.time() - t1,
+            })
+
+            values = [
+                tf.Summary.Value(tag='dev_perplexity/' + direction,
+                                 simple_value=d['perplexity'])
+                for direction, d in sorted(report['directions'].items())
+            ]
+            if report['perplexity'] is not None:
+                values.append(tf.Summary.Value(
+                    tag='dev_perplexity', simple_value=report['perplexity']))
+            summary_writer.add_summary(tf.Summary(value=values), step)
+            summary_writer.flush()
+
+            with open(os.path.join(tf_log_dir, 'dev_perplexity.jsonl'),
+                      'a') as fout:
+                fout.write(json.dumps(report) + '\n')
+
+            print("step=%s, dev perplexity=%s, time=%s" % (
+                step, report['perplexity'], report['time']))
+            reports.append(report)
+    finally:
+        summary_writer.close()
+        if evaluator is not None:
+            evaluator.close()
+
+    return reports
@@ -0,0 +1,143 @@
+'''
+Export the biLM inference graph for serving without the bilm code, as a
+SavedModel or as a frozen GraphDef, and load the exports back.
+'''
+
+import json
+
+import tensorflow as tf
+
+from tensorflow.tools.graph_transforms import TransformGraph
+
+from .model import BidirectionalLanguageModel
+
+SIGNATURE_NAME = 'serving_default'
+OUTPUTS = ('lm_embeddings', 'mask', 'lengths')
+
+
+def _build_serving_graph(options_file, weight_file, use_character_inputs,
+                         embedding_weight_file):
+    # a stateless biLM with named inputs and outputs, returns the
+    # input placeholder and the dict of outputs
+    with open(options_file, 'r') as fin:
+        options = json.load(fin)
+
+    if use_character_inputs:
+        max_chars = options['char_cnn']['max_characters_per_token']
+        ids_placeholder = tf.placeholder(
+            'int32', shape=(None, None, max_chars), name='character_ids')
+    else:
+        ids_placeholder = tf.placeholder(
+            'int32', shape=(None, None), name='token_ids')
+
+    model = BidirectionalLanguageModel(
+        options_file, weight_file,
+        use_character_inputs=use_character_inputs,
+        embedding_weight_file=embedding_weight_file,
+        stateless=True)
+    ops = model(ids_placeholder)
+
+    outputs = {name: tf.identity(ops[name], name=name) for name in OUTPUTS}
+    return ids_placeholder, outputs
+
+
+def export_saved_model(options_file, weight_file, export_dir,
+                       use_character_inputs=True, embedding_weight_file=None):
+    '''
+    Write a SavedModel of the biLM to export_dir, tagged 'serve', with
+    a 'serving_default' signature taking 'character_ids' of shape
+    (batch, tokens, max_characters_per_token) (or 'token_ids' of shape
+    (batch, tokens) without use_character_inputs, with the ids from
+    Batcher or TokenBatcher) and returning 'lm_embeddings', 'mask' and
+    'lengths' (see BidirectionalLanguageModel).
+
+    The exported graph is stateless, so any batch size can be served
+    concurrently.
+    '''
+    graph = tf.Graph()
+    with graph.as_default():
+        ids_placeholder, outputs = _build_serving_graph(
+            options_file, weight_file, use_character_inputs,
+            embedding_weight_file)
+        signature = tf.saved_model.signature_def_utils.predict_signature_def(
+            inputs={ids_placeholder.op.name: ids_placeholder},
+            outputs=outputs)
+
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            builder = tf.saved_model.builder.SavedModelBuilder(export_dir)
+            builder.add_meta_graph_and_variables(
+                sess, [tf.saved_model.tag_constants.SERVING],
+                signature_def_map={SIGNATURE_NAME: signature},
+                clear_devices=True)
+            builder.save()
+
+
+def export_frozen_graph(options_file, weight_file, outfile,
+                        use_character_inputs=True, embedding_weight_file=None):
+    '''
+    Write the biLM as a frozen GraphDef to outfile, with the weights as
+    constants, only the nodes needed for the outputs and the constant
+    subgraphs folded.  The input and outputs are named as in
+    export_saved_model.
+
+    The GraphDef must be smaller than 2GB, so large token embedding files
+    need export_saved_model instead.
+    '''
+    graph = tf.Graph()
+    with graph.as_default():
+        ids_placeholder, outputs = _build_serving_graph(
+            options_file, weight_file, use_character_inputs,
+            embedding_weight_file)
+
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            graph_def = tf.graph_util.convert_variables_to_constants(
+                sess, graph.as_graph_def(), list(OUTPUTS))
+
+    graph_def = tf.graph_util.remove_training_nodes(
+        graph_def, protected_nodes=list(OUTPUTS))
+    graph_def = TransformGraph(
+        graph_def, [ids_placeholder.op.name], list(OUTPUTS),
+        ['fold_constants(ignore_errors=true)'])
+
+    with tf.gfile.GFile(outfile, 'wb') as fout:
+        fout.write(graph_def.SerializeToString())
+
+
+def load_saved_model(sess, export_dir):
+    '''
+    Load a SavedModel from export_saved_model into sess.
+
+    Returns (input placeholder, dict of the output tensors).
+    '''
+    meta_graph = tf.saved_model.loader.load(
+        sess, [tf.saved_model.tag_constants.SERVING], export_dir)
+    signature = meta_graph.signature_def[SIGNATURE_NAME]
+    (input_info, ) = signature.inputs.values()
+    ids_placeholder = sess.graph.get_tensor_by_name(input_info.name)
+    outputs = {
+        name: sess.graph.get_tensor_by_name(info.name)
+        for name, info in signature.outputs.items()
+    }
+    return ids_placeholder, outputs
+
+
+def load_frozen_graph(filename, name='bilm'):
+    '''
+    Import a frozen graph from export_frozen_graph into the default
+    graph under the name scope name.
+
+    Returns (input placeholder, dict of the output tensors).
+    '''
+    graph_def = tf.GraphDef()
+    with tf.gfile.GFile(filename, 'rb') as fin:
+        graph_def.ParseFromString(fin.read())
+
+    input_names = [node.name for node in graph_def.node
+                   if node.op == 'Placeholder']
+    tensors = tf.import_graph_def(
+        graph_def,
+        return_elements=[n + ':0' for n in input_names + list(OUTPUTS)],
+        name=name)
+    return tensors[0], dict(zip(OUTPUTS, tensors[1:]))
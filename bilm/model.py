@@ -4,8 +4,10 @@ import tensorflow as tf
 import h5py
 import json
 import re
+import threading
 
-from .data import UnicodeCharsVocabulary, Batcher
+from .data import UnicodeCharsVocabulary, Batcher, boundary_char_ids
+from .directions import DIRECTIONS, get_directions
 
 DTYPE = 'float32'
 DTYPE_INT = 'int64'
@@ -19,6 +21,9 @@ class BidirectionalLanguageModel(object):
             use_character_inputs=True,
             embedding_weight_file=None,
             max_batch_size=128,
+            stateless=False,
+            hybrid_inputs=False,
+            output_layers=None,
         ):
         '''
         Creates the language model computational graph and loads weights
@@ -32,6 +37,11 @@ class BidirectionalLanguageModel(object):
                 pass use_character_inputs=False and ids_placeholder
                 of shape (None, None) to __call__.
                 In this case, embedding_weight_file is also required input
+            (3) To look up the tokens in the vocabulary and only run the
+                others through the char CNN (paired with HybridBatcher),
+                pass hybrid_inputs=True, embedding_weight_file and a
+                (token ids, character ids) pair of placeholders
+                to __call__
 
         options_file: location of the json formatted file with
                       LM hyperparameters
@@ -39,15 +49,26 @@ class BidirectionalLanguageModel(object):
         use_character_inputs: if True, then use character ids as input,
             otherwise use token ids
         max_batch_size: the maximum allowable batch size 
+        stateless: if True, every batch starts from a zero LSTM state.
+            There are no state variables or assign ops, so the batch size
+            is not limited by max_batch_size, the outputs don't depend on
+            the previous batches and the ops can be run concurrently from
+            several threads.  Otherwise, the LSTM states are carried over
+            from each batch to the next.
+        hybrid_inputs: if True, then use the token embeddings from
+            embedding_weight_file for the tokens in its vocabulary and the
+            char CNN for the others
+        output_layers: the indices of the layers to return (0 is the token
+            layer, 1 the first LSTM layer and so on), all of them if None
         '''
         with open(options_file, 'r') as fin:
             options = json.load(fin)
 
-        if not use_character_inputs:
+        if not use_character_inputs or hybrid_inputs:
             if embedding_weight_file is None:
                 raise ValueError(
                     "embedding_weight_file is required input with "
-                    "not use_character_inputs"
+                    "not use_character_inputs or hybrid_inputs"
                 )
 
         self._options = options
@@ -55,6 +76,9 @@ class BidirectionalLanguageModel(object):
         self._embedding_weight_file = embedding_weight_file
         self._use_character_inputs = use_character_inputs
         self._max_batch_size = max_batch_size
+        self._stateless = stateless
+        self._hybrid_inputs = hybrid_inputs
+        self._output_layers = output_layers
 
         self._ops = {}
         self._graphs = {}
@@ -65,11 +89,18 @@ class BidirectionalLanguageModel(object):
             with tensorflow ops:
 
             {'lm_embeddings': embedding_op,
+             'lm_layers': list of ops for each layer,
              'lengths': sequence_lengths_op,
              'mask': op to compute mask}
 
         embedding_op computes the LM embeddings and is shape
-            (None, 3, None, 1024)
+            (None, n_layers + 1, None, n_directions * projection_dim),
+            the layers of all the directions of the model concatenated in
+            the last dimension: (None, 3, None, 1024) with the forward and
+            backward directions of the pretrained biLMs
+        lm_layers are the layers of embedding_op before they are stacked,
+            each shape (None, None, n_directions * projection_dim).  Fetching them (or using
+            weight_layers) instead of embedding_op saves a copy.
         lengths_op computes the sequence lengths and is shape (None, )
         mask computes the sequence mask and is shape (None, None)
 
@@ -79,6 +110,10 @@ class BidirectionalLanguageModel(object):
                 character ids for a batch
             If use_character_input=False, it is shape (None, None) and
                 holds the input token ids for a batch
+            If hybrid_inputs=True, it is a pair of placeholders of shape
+                (None, None) and (None, None, max_characters_per_token),
+                the token ids and the character ids of the tokens not in
+                the vocabulary for a batch
         '''
         if ids_placeholder in self._ops:
             # have already created ops for this placeholder, just return them
@@ -94,7 +129,9 @@ class BidirectionalLanguageModel(object):
                     ids_placeholder,
                     embedding_weight_file=self._embedding_weight_file,
                     use_character_inputs=self._use_character_inputs,
-                    max_batch_size=self._max_batch_size)
+                    max_batch_size=self._max_batch_size,
+                    stateless=self._stateless,
+                    hybrid_inputs=self._hybrid_inputs)
             else:
                 with tf.variable_scope('', reuse=True):
                     lm_graph = BidirectionalLanguageModelGraph(
@@ -103,7 +140,9 @@ class BidirectionalLanguageModel(object):
                         ids_placeholder,
                         embedding_weight_file=self._embedding_weight_file,
                         use_character_inputs=self._use_character_inputs,
-                        max_batch_size=self._max_batch_size)
+                        max_batch_size=self._max_batch_size,
+                        stateless=self._stateless,
+                        hybrid_inputs=self._hybrid_inputs)
 
             ops = self._build_ops(lm_graph)
             self._ops[ids_placeholder] = ops
@@ -114,82 +153,63 @@ class BidirectionalLanguageModel(object):
 
     def _build_ops(self, lm_graph):
         with tf.control_dependencies([lm_graph.update_state_op]):
-            # get the LM embeddings
-            token_embeddings = lm_graph.embedding
-            layers = [
-                tf.concat([token_embeddings, token_embeddings], axis=2)
-            ]
-
-            n_lm_layers = len(lm_graph.lstm_outputs['forward'])
-            for i in range(n_lm_layers):
-                layers.append(
-                    tf.concat(
-                        [lm_graph.lstm_outputs['forward'][i],
-                         lm_graph.lstm_outputs['backward'][i]],
-                        axis=-1
-                    )
-                )
+            directions = [d.name for d in lm_graph.directions]
+            n_lm_layers = len(lm_graph.lstm_outputs[directions[0]]) + 1
+            if self._output_layers is None:
+                output_layers = list(range(n_lm_layers))
+            else:
+                output_layers = list(self._output_layers)
 
-            # The layers include the BOS/EOS tokens.  Remove them
+            # The layers include the BOS/EOS tokens.  Remove them by
+            # gathering the tokens at 1 .. length - 2 of each sentence,
+            # followed by the padding after the EOS, with the same index
+            # for all the layers
             sequence_length_wo_bos_eos = lm_graph.sequence_lengths - 2
-            layers_without_bos_eos = []
-            for layer in layers:
-                layer_wo_bos_eos = layer[:, 1:, :]
-                layer_wo_bos_eos = tf.reverse_sequence(
-                    layer_wo_bos_eos, 
-                    lm_graph.sequence_lengths - 1,
-                    seq_axis=1,
-                    batch_axis=0,
-                )
-                layer_wo_bos_eos = layer_wo_bos_eos[:, 1:, :]
-                layer_wo_bos_eos = tf.reverse_sequence(
-                    layer_wo_bos_eos,
-                    sequence_length_wo_bos_eos,
-                    seq_axis=1,
-                    batch_axis=0,
-                )
-                layers_without_bos_eos.append(layer_wo_bos_eos)
+            batch_size = tf.shape(lm_graph.mask)[0]
+            max_length_wo_bos_eos = tf.shape(lm_graph.mask)[1] - 2
+            mask_wo_bos_eos = tf.sequence_mask(
+                sequence_length_wo_bos_eos, max_length_wo_bos_eos)
+            positions = tf.tile(
+                tf.expand_dims(tf.range(max_length_wo_bos_eos), 0),
+                [batch_size, 1])
+            source_positions = positions + 2 - tf.cast(mask_wo_bos_eos,
+                                                       tf.int32)
+            batch_index = tf.tile(
+                tf.expand_dims(tf.range(batch_size), 1),
+                [1, max_length_wo_bos_eos])
+            index = tf.stack([batch_index, source_positions], axis=-1)
 
-            # concatenate the layers
-            lm_embeddings = tf.concat(
-                [tf.expand_dims(t, axis=1) for t in layers_without_bos_eos],
-                axis=1
-            )
+            # get the LM embeddings
+            lm_layers = []
+            for i in output_layers:
+                if i == 0:
+                    # the token embeddings, once for each direction
+                    token_embeddings = tf.gather_nd(lm_graph.embedding, index)
+                    pieces = [token_embeddings] * len(directions)
+                else:
+                    pieces = [tf.gather_nd(lm_graph.lstm_outputs[d][i - 1],
+                                           index)
+                              for d in directions]
+                if len(pieces) > 1:
+                    lm_layers.append(tf.concat(pieces, axis=-1))
+                else:
+                    lm_layers.append(pieces[0])
 
-            # get the mask op without bos/eos.
-            # tf doesn't support reversing boolean tensors, so cast
-            # to int then back
-            mask_wo_bos_eos = tf.cast(lm_graph.mask[:, 1:], 'int32')
-            mask_wo_bos_eos = tf.reverse_sequence(
-                mask_wo_bos_eos,
-                lm_graph.sequence_lengths - 1,
-                seq_axis=1,
-                batch_axis=0,
-            )
-            mask_wo_bos_eos = mask_wo_bos_eos[:, 1:]
-            mask_wo_bos_eos = tf.reverse_sequence(
-                mask_wo_bos_eos,
-                sequence_length_wo_bos_eos,
-                seq_axis=1,
-                batch_axis=0,
-            )
-            mask_wo_bos_eos = tf.cast(mask_wo_bos_eos, 'bool')
+            lm_embeddings = tf.stack(lm_layers, axis=1)
 
         return {
             'lm_embeddings': lm_embeddings, 
+            'lm_layers': lm_layers,
             'lengths': sequence_length_wo_bos_eos,
             'token_embeddings': lm_graph.embedding,
             'mask': mask_wo_bos_eos,
         }
 
 
-def _pretrained_initializer(varname, weight_file, embedding_weight_file=None):
-    '''
-    We'll stub out all the initializers in the pretrained LM with
-    a function that loads the weights from the file
-    '''
+def _weight_name_in_file(varname):
+    # convert the graph name to that in the weight file
     weight_name_map = {}
-    for i in range(2):
+    for i in range(len(DIRECTIONS)):
         for j in range(8):  # if we decide to add more layers
             root = 'RNN_{}/RNN/MultiRNNCell/Cell{}'.format(i, j)
             weight_name_map[root + '/rnn/lstm_cell/kernel'] = \
@@ -199,49 +219,147 @@ def _pretrained_initializer(varname, weight_file, embedding_weight_file=None):
             weight_name_map[root + '/rnn/lstm_cell/projection/kernel'] = \
                 root + '/LSTMCell/W_P_0'
 
-    # convert the graph name to that in the checkpoint
     varname_in_file = varname[5:]
     if varname_in_file.startswith('RNN'):
         varname_in_file = weight_name_map[varname_in_file]
+    return varname_in_file
+
+
+class _WeightFileReader(object):
+    '''
+    Reads the pretrained weights from the hdf5 files for the variable
+    initializers.
 
-    if varname_in_file == 'embedding':
-        with h5py.File(embedding_weight_file, 'r') as fin:
+    Each file is opened once, and each weight is read when its variable
+    is initialized and released as soon as it is assigned, so the weights
+    are neither stored in the GraphDef nor all held in memory at once.
+    The files are closed after every weight requested has been read.
+    '''
+    def __init__(self, weight_file, embedding_weight_file=None):
+        self._filenames = {'weights': weight_file,
+                           'embedding': embedding_weight_file}
+        self._files = {}
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def _file(self, varname_in_file):
+        key = 'embedding' if varname_in_file == 'embedding' else 'weights'
+        if key not in self._files:
+            self._files[key] = h5py.File(self._filenames[key], 'r')
+        return self._files[key]
+
+    def shape(self, varname_in_file):
+        with self._lock:
+            shape = list(self._file(varname_in_file)[varname_in_file].shape)
+        if varname_in_file in ('embedding', 'char_embed'):
             # Have added a special 0 index for padding not present
             # in the original model.
-            embed_weights = fin[varname_in_file][...]
-            weights = np.zeros(
-                (embed_weights.shape[0] + 1, embed_weights.shape[1]),
-                dtype=DTYPE
-            )
-            weights[1:, :] = embed_weights
-    else:
-        with h5py.File(weight_file, 'r') as fin:
-            if varname_in_file == 'char_embed':
-                # Have added a special 0 index for padding not present
-                # in the original model.
-                char_embed_weights = fin[varname_in_file][...]
-                weights = np.zeros(
-                    (char_embed_weights.shape[0] + 1,
-                     char_embed_weights.shape[1]),
-                    dtype=DTYPE
-                )
-                weights[1:, :] = char_embed_weights
+            shape[0] += 1
+        return shape
+
+    def request(self, varname_in_file):
+        with self._lock:
+            self._pending.add(varname_in_file)
+
+    def read(self, varname_in_file):
+        with self._lock:
+            ds = self._file(varname_in_file)[varname_in_file]
+            if varname_in_file in ('embedding', 'char_embed'):
+                # the padding row is zero
+                weights = np.zeros((ds.shape[0] + 1, ) + ds.shape[1:],
+                                   dtype=DTYPE)
+                ds.read_direct(weights, dest_sel=np.s_[1:])
             else:
-                weights = fin[varname_in_file][...]
+                weights = ds[...].astype(DTYPE, copy=False)
+
+            self._pending.discard(varname_in_file)
+            if not self._pending:
+                self.close()
+        return weights
+
+    def close(self):
+        for fin in self._files.values():
+            fin.close()
+        self._files = {}
+
+
+def _pretrained_initializer(varname, reader):
+    '''
+    We'll stub out all the initializers in the pretrained LM with
+    a function that loads the weights from the file with reader
+    when the variable is initialized
+    '''
+    varname_in_file = _weight_name_in_file(varname)
 
     # Tensorflow initializers are callables that accept a shape parameter
     # and some optional kwargs
     def ret(shape, **kwargs):
-        if list(shape) != list(weights.shape):
+        expected_shape = reader.shape(varname_in_file)
+        if list(shape) != expected_shape:
             raise ValueError(
                 "Invalid shape initializing {0}, got {1}, expected {2}".format(
-                    varname_in_file, shape, weights.shape)
+                    varname_in_file, shape, expected_shape)
             )
+        reader.request(varname_in_file)
+        with tf.device('/cpu:0'):
+            weights = tf.py_func(
+                lambda: reader.read(varname_in_file), [], tf.float32,
+                stateful=True, name='read_weights')
+        weights.set_shape(expected_shape)
         return weights
 
     return ret
 
 
+# the boundary tokens that Batcher and TokenBatcher add to the sentences
+_INPUT_BOUNDARIES = ('bos', 'eos')
+
+
+def _inference_directions(options):
+    # the pretrained biLMs have no direction options and are bidirectional
+    return get_directions(
+        dict(options, bidirectional=options.get('bidirectional', True)))
+
+
+def _skip_positions(k, n, skip):
+    # the tokens at r, r + skip, r + 2 * skip, ... for r = 0 .. skip - 1
+    start = tf.zeros_like(k)
+    position = tf.zeros_like(k)
+    for r in range(skip):
+        count = (n - r + skip - 1) // skip
+        position = tf.where((k >= start) & (k < start + count),
+                            skip * (k - start) + r, position)
+        start = start + count
+    return position
+
+
+_PERMUTED_POSITIONS = {
+    'forward': lambda k, n: k,
+    'backward': lambda k, n: n - 1 - k,
+    'inward': lambda k, n: tf.where(
+        tf.equal(k % 2, 0), k // 2, n - 1 - k // 2),
+    'outward': lambda k, n: tf.where(
+        tf.equal(k % 2, 0), n // 2 + k // 2, n // 2 - 1 - k // 2),
+    'skip2forward': lambda k, n: _skip_positions(k, n, 2),
+    'skip2backward': lambda k, n: n - 1 - _skip_positions(k, n, 2),
+    'skip3forward': lambda k, n: _skip_positions(k, n, 3),
+    'skip3backward': lambda k, n: n - 1 - _skip_positions(k, n, 3),
+}
+
+
+def _permuted_positions(name, k, n):
+    '''
+    The position in the sentence of the k-th token of the sentence
+    permuted in the direction name, for sentences of n tokens.  k and n
+    are int32 tensors of the same shape, and the positions are only
+    defined for 0 <= k < n.  The permutations of bilm.directions in the
+    graph.
+    '''
+    if name not in _PERMUTED_POSITIONS:
+        raise ValueError("No permutation in the graph for direction %s" % name)
+    return _PERMUTED_POSITIONS[name](k, n)
+
+
 class BidirectionalLanguageModelGraph(object):
     '''
     Creates the computational graph and holds the ops necessary for runnint
@@ -249,27 +367,63 @@ class BidirectionalLanguageModelGraph(object):
     '''
     def __init__(self, options, weight_file, ids_placeholder,
                  use_character_inputs=True, embedding_weight_file=None,
-                 max_batch_size=128):
-
+                 max_batch_size=128, token_embeddings_only=False,
+                 stateless=False, hybrid_inputs=False):
+        '''
+        token_embeddings_only: only build the context insensitive token
+            embeddings (the char CNN, highway and projection layers, or
+            the token embedding lookup), without the LSTMs
+        stateless: start the LSTMs from a zero state for every batch,
+            without state variables (see BidirectionalLanguageModel)
+        hybrid_inputs: ids_placeholder is a pair of the token ids and the
+            character ids of the tokens not in the vocabulary, which are
+            the only ones run through the char CNN
+        '''
         self.options = options
+        self.directions = _inference_directions(options)
+        self._token_embeddings_only = token_embeddings_only
+        self._stateless = stateless
         self._max_batch_size = max_batch_size
-        self.ids_placeholder = ids_placeholder
-        self.use_character_inputs = use_character_inputs
+        self._hybrid_inputs = hybrid_inputs
+        if hybrid_inputs:
+            self.ids_placeholder, self.char_ids_placeholder = ids_placeholder
+        else:
+            self.ids_placeholder = ids_placeholder
+        self.use_character_inputs = use_character_inputs and not hybrid_inputs
+
+        # the special tokens before and after the permuted sentences that
+        # aren't the <S> and </S> of the input, their embeddings are
+        # computed with the char CNN from their character ids
+        self._boundary_names = []
+        if not token_embeddings_only:
+            for direction in self.directions:
+                for name in (direction.bos, direction.eos):
+                    if name not in _INPUT_BOUNDARIES and \
+                            name not in self._boundary_names:
+                        self._boundary_names.append(name)
+        if self._boundary_names and not use_character_inputs \
+                and not hybrid_inputs:
+            raise ValueError(
+                "The token inputs have no embeddings for the boundary tokens "
+                "{0}, use character inputs".format(self._boundary_names)
+            )
 
         # this custom_getter will make all variables not trainable and
-        # override the default initializer
+        # override the default initializer to read the weights from
+        # the files, which are only opened once for all the variables
+        self._weight_reader = _WeightFileReader(
+            weight_file, embedding_weight_file)
+
         def custom_getter(getter, name, *args, **kwargs):
             kwargs['trainable'] = False
             kwargs['initializer'] = _pretrained_initializer(
-                name, weight_file, embedding_weight_file
+                name, self._weight_reader
             )
             return getter(name, *args, **kwargs)
 
         if embedding_weight_file is not None:
-            # get the vocab size
-            with h5py.File(embedding_weight_file, 'r') as fin:
-                # +1 for padding
-                self._n_tokens_vocab = fin['embedding'].shape[0] + 1
+            # get the vocab size, including the padding
+            self._n_tokens_vocab = self._weight_reader.shape('embedding')[0]
         else:
             self._n_tokens_vocab = None
 
@@ -279,9 +433,13 @@ class BidirectionalLanguageModelGraph(object):
     def _build(self):
         if self.use_character_inputs:
             self._build_word_char_embeddings()
+        elif self._hybrid_inputs:
+            self._build_word_embeddings()
+            self._build_word_char_embeddings()
         else:
             self._build_word_embeddings()
-        self._build_lstms()
+        if not self._token_embeddings_only:
+            self._build_lstms()
 
     def _build_word_char_embeddings(self):
         '''
@@ -331,9 +489,30 @@ class BidirectionalLanguageModelGraph(object):
                     dtype=DTYPE,
                     initializer=tf.random_uniform_initializer(-1.0, 1.0)
             )
+            if self._hybrid_inputs:
+                # only the tokens not in the vocabulary go through the CNN,
+                # as a single sequence of n_oov tokens
+                oov_mask = tf.reduce_any(self.char_ids_placeholder > 0, axis=2)
+                oov_index = tf.where(oov_mask)
+                char_ids = tf.expand_dims(
+                    tf.gather_nd(self.char_ids_placeholder, oov_index), 0)
+            else:
+                char_ids = self.ids_placeholder
+            if self._boundary_names:
+                # run the boundary tokens through the CNN with the batch,
+                # as a single sequence of batch_size * unroll_steps + n
+                # tokens.  The char ids are shifted by one as in Batcher.
+                boundary_ids = np.stack([
+                    boundary_char_ids(name, max_chars) + 1
+                    for name in self._boundary_names
+                ])
+                char_ids = tf.concat([
+                    tf.reshape(char_ids, [1, -1, max_chars]),
+                    tf.constant(boundary_ids[np.newaxis], dtype=tf.int32)
+                ], axis=1)
             # shape (batch_size, unroll_steps, max_chars, embed_dim)
             self.char_embedding = tf.nn.embedding_lookup(self.embedding_weights,
-                                                    self.ids_placeholder)
+                                                    char_ids)
 
         # the convolutions
         def make_convolutions(inp):
@@ -452,6 +631,27 @@ class BidirectionalLanguageModelGraph(object):
             shp = tf.concat([batch_size_n_tokens, [projection_dim]], axis=0)
             embedding = tf.reshape(embedding, shp)
 
+        if self._boundary_names or self._hybrid_inputs:
+            embedding = tf.reshape(embedding, [-1, projection_dim])
+        if self._boundary_names:
+            # split off the boundary tokens, shape (n, dim)
+            n_boundary = len(self._boundary_names)
+            self.boundary_embedding = embedding[-n_boundary:]
+            embedding = embedding[:-n_boundary]
+        if self._hybrid_inputs:
+            # scatter the tokens not in the vocabulary into the token
+            # embeddings looked up from the cache
+            oov_embedding = tf.scatter_nd(
+                oov_index, embedding,
+                tf.shape(self.embedding, out_type=tf.int64))
+            in_vocab = tf.expand_dims(1.0 - tf.cast(oov_mask, DTYPE), -1)
+            embedding = self.embedding * in_vocab + oov_embedding
+        elif self._boundary_names:
+            shp = tf.concat(
+                [tf.shape(self.ids_placeholder)[0:2], [projection_dim]],
+                axis=0)
+            embedding = tf.reshape(embedding, shp)
+
         # at last assign attributes for remainder of the model
         self.embedding = embedding
 
@@ -493,24 +693,38 @@ class BidirectionalLanguageModelGraph(object):
             mask = self.ids_placeholder > 0
         sequence_lengths = tf.reduce_sum(tf.cast(mask, tf.int32), axis=1)
         batch_size = tf.shape(sequence_lengths)[0]
+        max_length = tf.shape(mask)[1]
+
+        # the permuted sentences are gathered from the token embeddings
+        # of the batch followed by those of the boundary tokens
+        embeddings = tf.reshape(self.embedding, [-1, projection_dim])
+        if self._boundary_names:
+            embeddings = tf.concat(
+                [embeddings, self.boundary_embedding], axis=0)
+        positions = tf.tile(
+            tf.expand_dims(tf.range(max_length), 0), [batch_size, 1])
+        lengths = tf.tile(
+            tf.expand_dims(sequence_lengths, 1), [1, max_length])
+        batch_index = tf.tile(
+            tf.expand_dims(tf.range(batch_size), 1), [1, max_length])
 
         # for each direction, we'll store tensors for each layer
-        self.lstm_outputs = {'forward': [], 'backward': []}
-        self.lstm_state_sizes = {'forward': [], 'backward': []}
-        self.lstm_init_states = {'forward': [], 'backward': []}
-        self.lstm_final_states = {'forward': [], 'backward': []}
-
-        update_ops = []
-        for direction in ['forward', 'backward']:
-            if direction == 'forward':
+        self.lstm_outputs = {d.name: [] for d in self.directions}
+        self.lstm_state_sizes = {d.name: [] for d in self.directions}
+        self.lstm_init_states = {d.name: [] for d in self.directions}
+        self.lstm_final_states = {d.name: [] for d in self.directions}
+        self.update_state_ops = {d.name: [] for d in self.directions}
+
+        for direction in self.directions:
+            if direction.name == 'forward':
                 layer_input = self.embedding
             else:
-                layer_input = tf.reverse_sequence(
-                    self.embedding,
-                    sequence_lengths,
-                    seq_axis=1,
-                    batch_axis=0
-                )
+                gather_index, sentence_positions = self._permutation(
+                    direction, positions, lengths, batch_index)
+                layer_input = tf.gather(embeddings, gather_index)
+                # the outputs are scattered back to the token positions
+                scatter_index = tf.stack(
+                    [batch_index, sentence_positions], axis=-1)
 
             for i in range(n_lstm_layers):
                 if projection_dim < lstm_dim:
@@ -536,26 +750,30 @@ class BidirectionalLanguageModelGraph(object):
                 # collect the input state, run the dynamic rnn, collect
                 # the output
                 state_size = lstm_cell.state_size
-                # the LSTMs are stateful.  To support multiple batch sizes,
-                # we'll allocate size for states up to max_batch_size,
-                # then use the first batch_size entries for each batch
-                init_states = [
-                    tf.Variable(
-                        tf.zeros([self._max_batch_size, dim]),
-                        trainable=False
-                    )
-                    for dim in lstm_cell.state_size
-                ]
-                batch_init_states = [
-                    state[:batch_size, :] for state in init_states
-                ]
-
-                if direction == 'forward':
-                    i_direction = 0
+                if self._stateless:
+                    init_states = []
+                    batch_init_states = [
+                        tf.zeros(tf.stack([batch_size, dim]))
+                        for dim in lstm_cell.state_size
+                    ]
                 else:
-                    i_direction = 1
-                variable_scope_name = 'RNN_{0}/RNN/MultiRNNCell/Cell{1}'.format(
-                    i_direction, i)
+                    # the LSTMs are stateful.  To support multiple batch
+                    # sizes, we'll allocate size for states up to
+                    # max_batch_size, then use the first batch_size entries
+                    # for each batch
+                    init_states = [
+                        tf.Variable(
+                            tf.zeros([self._max_batch_size, dim]),
+                            trainable=False
+                        )
+                        for dim in lstm_cell.state_size
+                    ]
+                    batch_init_states = [
+                        state[:batch_size, :] for state in init_states
+                    ]
+
+                variable_scope_name = '{0}/RNN/MultiRNNCell/Cell{1}'.format(
+                    direction.scope, i)
                 with tf.variable_scope(variable_scope_name):
                     layer_output, final_state = tf.nn.dynamic_rnn(
                         lstm_cell,
@@ -565,95 +783,336 @@ class BidirectionalLanguageModelGraph(object):
                             *batch_init_states),
                     )
 
-                self.lstm_state_sizes[direction].append(lstm_cell.state_size)
-                self.lstm_init_states[direction].append(init_states)
-                self.lstm_final_states[direction].append(final_state)
-                if direction == 'forward':
-                    self.lstm_outputs[direction].append(layer_output)
+                self.lstm_state_sizes[direction.name].append(
+                    lstm_cell.state_size)
+                self.lstm_init_states[direction.name].append(init_states)
+                self.lstm_final_states[direction.name].append(final_state)
+                if direction.name == 'forward':
+                    self.lstm_outputs[direction.name].append(layer_output)
                 else:
-                    self.lstm_outputs[direction].append(
-                        tf.reverse_sequence(
-                            layer_output,
-                            sequence_lengths,
-                            seq_axis=1,
-                            batch_axis=0
-                        )
-                    )
+                    output = tf.scatter_nd(
+                        scatter_index, layer_output, tf.shape(layer_output))
+                    output.set_shape(layer_output.get_shape())
+                    self.lstm_outputs[direction.name].append(output)
 
                 with tf.control_dependencies([layer_output]):
                     # update the initial states
-                    for i in range(2):
+                    for i in range(len(init_states)):
                         new_state = tf.concat(
                             [final_state[i][:batch_size, :],
                              init_states[i][batch_size:, :]], axis=0)
                         state_update_op = tf.assign(init_states[i], new_state)
-                        update_ops.append(state_update_op)
+                        self.update_state_ops[direction.name].append(
+                            state_update_op)
     
                 layer_input = layer_output
 
         self.mask = mask
         self.sequence_lengths = sequence_lengths
-        self.update_state_op = tf.group(*update_ops)
+        self.update_state_op = tf.group(*[
+            op for direction in self.directions
+            for op in self.update_state_ops[direction.name]
+        ])
+
+    def _permutation(self, direction, positions, lengths, batch_index):
+        '''
+        The indices to gather the sentences permuted in direction from the
+        token and boundary embeddings, and the position in the sentence of
+        each token of the permuted sentences, shape (batch_size, max_length).
+        '''
+        last = lengths - 1
+        n_input = tf.shape(self.embedding)[1] * tf.shape(self.embedding)[0]
+        tokens = 1 + _permuted_positions(direction.name, positions - 1,
+                                         lengths - 2)
+
+        # the position of <S> and </S> when they start or end the
+        # permuted sentence, the position of the permuted boundary
+        # otherwise
+        input_boundaries = {'bos': tf.zeros_like(positions), 'eos': last}
+        first = input_boundaries.get(direction.bos, tf.zeros_like(positions))
+        end = input_boundaries.get(direction.eos, last)
+        sentence_positions = tf.where(
+            positions >= lengths, positions,
+            tf.where(tf.equal(positions, 0), first,
+                     tf.where(tf.equal(positions, last), end, tokens)))
+
+        gather_index = batch_index * tf.shape(self.embedding)[1] + \
+            sentence_positions
+        for name, is_boundary in ((direction.bos, tf.equal(positions, 0)),
+                                  (direction.eos, tf.equal(positions, last))):
+            if name not in _INPUT_BOUNDARIES:
+                k = self._boundary_names.index(name)
+                gather_index = tf.where(
+                    is_boundary & (positions < lengths),
+                    tf.fill(tf.shape(positions), n_input + k),
+                    gather_index)
+
+        return gather_index, sentence_positions
+
+
+class DocumentEmbedder(object):
+    '''
+    Computes the biLM embeddings of documents too long to run as a single
+    sequence, in windows of window_size tokens.
+
+    The forward LSTMs read the windows of each document in order and the
+    backward LSTMs in reverse order, each starting from the state at the
+    end of the previous window, so the embeddings are those of the whole
+    document run as one sequence.  The windows of up to max_batch_size
+    documents are run together, one window of each document per batch.
+    '''
+    def __init__(self, model, ids_placeholder, batcher, window_size=128):
+        '''
+        model = a BidirectionalLanguageModel with stateless=False, and
+            only forward and backward directions
+        ids_placeholder = the input placeholder of the model
+        batcher = a Batcher (or TokenBatcher) for the inputs of the model
+        window_size = the number of tokens in each window, including the
+            begin and end of document tokens
+        '''
+        if model._stateless:
+            raise ValueError("DocumentEmbedder needs a stateful model")
+        model(ids_placeholder)
+        lm_graph = model._graphs[ids_placeholder]
+        directions = [d.name for d in lm_graph.directions]
+        if not set(directions) <= set(['forward', 'backward']):
+            raise ValueError(
+                "Can't run directions {0} in windows".format(directions))
+
+        self._ids_placeholder = ids_placeholder
+        self._batcher = batcher
+        self._window_size = window_size
+        self._max_batch_size = model._max_batch_size
+        self._directions = directions
+        self._embedding = lm_graph.embedding
+        self._lstm_outputs = lm_graph.lstm_outputs
+        self._update_state_ops = {
+            d: tf.group(*lm_graph.update_state_ops[d]) for d in directions
+        }
+        state_variables = [
+            state for d in directions
+            for states in lm_graph.lstm_init_states[d] for state in states
+        ]
+        self._reset_state_op = tf.variables_initializer(state_variables)
+
+    def __call__(self, sess, documents):
+        '''
+        documents = a list of documents, each a list of tokens without
+            <s> or </s>
+
+        Returns a list with the embeddings of each document, shape
+            (3, n_tokens, 1024) as the lm_embeddings of the biLM.
+        '''
+        embeddings = []
+        for start in range(0, len(documents), self._max_batch_size):
+            embeddings.extend(self._embed_batch(
+                sess, documents[start:start + self._max_batch_size]))
+        return embeddings
+
+    def _embed_batch(self, sess, documents):
+        # the ids of each document with <S> and </S>, split in windows
+        windows = []
+        for document in documents:
+            ids = self._batcher.batch_sentences([document])[0]
+            windows.append([ids[k:k + self._window_size]
+                            for k in range(0, len(ids), self._window_size)])
+        n_steps = max(len(w) for w in windows)
+        shape = (len(documents), self._window_size) + windows[0][0].shape[1:]
+
+        # the outputs for each window of each document
+        token_layer = [[None] * len(w) for w in windows]
+        lstm_layers = {}
+        for direction in self._directions:
+            lstm_layers[direction] = [[None] * len(w) for w in windows]
+            fetches = [self._lstm_outputs[direction],
+                       self._update_state_ops[direction], self._embedding]
+            sess.run(self._reset_state_op)
+            for step in range(n_steps):
+                # the backward LSTMs read the windows from the last one
+                X = np.zeros(shape, dtype=windows[0][0].dtype)
+                batch_windows = []
+                for k, document_windows in enumerate(windows):
+                    if direction == 'forward':
+                        i = step
+                    else:
+                        i = len(document_windows) - 1 - step
+                    if 0 <= i < len(document_windows):
+                        X[k, :len(document_windows[i])] = document_windows[i]
+                        batch_windows.append((k, i))
+
+                outputs, _, embedding = sess.run(
+                    fetches, feed_dict={self._ids_placeholder: X})
+                for k, i in batch_windows:
+                    length = len(windows[k][i])
+                    lstm_layers[direction][k][i] = [
+                        layer[k, :length] for layer in outputs]
+                    token_layer[k][i] = embedding[k, :length]
+
+        # concatenate the windows and remove <S> and </S>
+        n_lstm_layers = len(self._lstm_outputs[self._directions[0]])
+        embeddings = []
+        for k in range(len(documents)):
+            token_embeddings = np.concatenate(token_layer[k])[1:-1]
+            layers = [np.concatenate(
+                [token_embeddings] * len(self._directions), axis=-1)]
+            for i in range(n_lstm_layers):
+                layers.append(np.concatenate([
+                    np.concatenate(
+                        [window[i] for window in lstm_layers[d][k]])[1:-1]
+                    for d in self._directions
+                ], axis=-1))
+            embeddings.append(np.stack(layers))
 
+        return embeddings
 
-def dump_token_embeddings(vocab_file, options_file, weight_file, outfile):
+
+def dump_token_embeddings(vocab_file, options_file, weight_file, outfile,
+                          batch_size=64, timesteps=64):
     '''
     Given an input vocabulary file, dump all the token embeddings to the
     outfile.  The result can be used as the embedding_weight_file when
     constructing a BidirectionalLanguageModel.
+
+    Every token of the vocabulary is included, along with the sentence
+    boundary tokens of all directions (<S>, </S>, <MD>, <SI>, ...) at their
+    ids in the vocabulary.  The boundary tokens of the permuted directions
+    are left as zeros for models trained without their characters, e.g.
+    bidirectional models with 261 characters.  The tokens are packed into
+    (batch_size, timesteps, max_characters_per_token) arrays of character
+    ids that are run through the char CNN and highway layers only, and
+    each batch is written to the chunked hdf5 dataset as it is computed.
     '''
     with open(options_file, 'r') as fin:
         options = json.load(fin)
     max_word_length = options['char_cnn']['max_characters_per_token']
 
     vocab = UnicodeCharsVocabulary(vocab_file, max_word_length)
-    batcher = Batcher(vocab_file, max_word_length)
+    # the Batcher shifts the character ids by one to reserve 0 for padding
+    char_ids = vocab.word_char_ids + 1
+    unknown_chars = np.any(
+        char_ids >= options['char_cnn']['n_characters'], axis=1)
+    if np.any(unknown_chars):
+        print("Characters not in the model, writing zeros for %s tokens" %
+              np.sum(unknown_chars))
+        char_ids[unknown_chars] = 0
 
     ids_placeholder = tf.placeholder('int32',
                                      shape=(None, None, max_word_length)
     )
-    model = BidirectionalLanguageModel(options_file, weight_file)
-    embedding_op = model(ids_placeholder)['token_embeddings']
+    lm_graph = BidirectionalLanguageModelGraph(
+        options, weight_file, ids_placeholder, token_embeddings_only=True)
+    embedding_op = lm_graph.embedding
 
     n_tokens = vocab.size
-    embed_dim = int(embedding_op.shape[2])
-
-    embeddings = np.zeros((n_tokens, embed_dim), dtype=DTYPE)
+    embed_dim = options['lstm']['projection_dim']
+    tokens_per_batch = batch_size * timesteps
 
     config = tf.ConfigProto(allow_soft_placement=True)
-    with tf.Session(config=config) as sess:
+    with tf.Session(config=config) as sess, \
+            h5py.File(outfile, 'w') as fout:
         sess.run(tf.global_variables_initializer())
-        for k in range(n_tokens):
-            token = vocab.id_to_word(k)
-            char_ids = batcher.batch_sentences([[token]])[0, 1, :].reshape(
-                1, 1, -1)
-            embeddings[k, :] = sess.run(
-                embedding_op, feed_dict={ids_placeholder: char_ids}
-            )
-
-    with h5py.File(outfile, 'w') as fout:
         ds = fout.create_dataset(
-            'embedding', embeddings.shape, dtype='float32', data=embeddings
+            'embedding', (n_tokens, embed_dim), dtype='float32',
+            chunks=(min(n_tokens, tokens_per_batch), embed_dim)
         )
+        for start in range(0, n_tokens, tokens_per_batch):
+            end = min(start + tokens_per_batch, n_tokens)
+            # pad the last batch to a whole number of rows of timesteps
+            n_rows = -(-(end - start) // timesteps)
+            X = np.zeros((n_rows * timesteps, max_word_length),
+                         dtype=np.int32)
+            X[:end - start] = char_ids[start:end]
+            embeddings = sess.run(
+                embedding_op,
+                feed_dict={ids_placeholder: X.reshape(
+                    n_rows, timesteps, max_word_length)}
+            )
+            embeddings = embeddings.reshape(-1, embed_dim)[:end - start]
+            embeddings[unknown_chars[start:end]] = 0.0
+            ds[start:end, :] = embeddings
+
+
+def _read_sentences(dataset_file):
+    with open(dataset_file, 'r') as fin:
+        for line in fin:
+            yield line.strip().split()
+
+
+def _bucketed_batches(sentences, batch_size, window):
+    # read window batches worth of sentences at a time and batch them
+    # sorted by length, so the batches have little padding while only a
+    # window of the dataset is in memory.  Yields (sentence_ids, sentences)
+    buf = []
+    for sentence_id, sentence in enumerate(sentences):
+        buf.append((len(sentence), sentence_id, sentence))
+        if len(buf) == batch_size * window:
+            for batch in _sorted_batches(buf, batch_size):
+                yield batch
+            buf = []
+    for batch in _sorted_batches(buf, batch_size):
+        yield batch
+
+
+def _sorted_batches(buf, batch_size):
+    buf = sorted(buf)
+    for start in range(0, len(buf), batch_size):
+        batch = buf[start:start + batch_size]
+        yield [b[1] for b in batch], [b[2] for b in batch]
+
 
 def dump_bilm_embeddings(vocab_file, dataset_file, options_file,
-                         weight_file, outfile):
+                         weight_file, outfile, contiguous=False,
+                         batch_size=64, bucket_window=100, float16=False):
+    '''
+    Write the biLM embeddings of every sentence in dataset_file, one
+    whitespace tokenized sentence per line, to the hdf5 outfile.
+
+    By default each sentence is a dataset with key str(sentence_id) of
+    shape (3, n_tokens, 1024) for the pretrained biLMs, or generally
+    (n_layers + 1, n_tokens, n_directions * projection_dim).
+
+    The sentences are run one at a time with the LSTM states carried over
+    from each sentence to the next.  With contiguous=True they are instead
+    run from a zero LSTM state, so the embeddings of a sentence don't
+    depend on the other sentences, in batches of batch_size
+    sentences of similar length (sorted within windows of bucket_window
+    batches) and all the embeddings are written to a single
+    'embeddings' dataset of shape (total_tokens, 3, 1024) (or
+    (total_tokens, n_layers + 1, n_directions * projection_dim)), with the
+    embeddings of sentence i at offsets[i]:offsets[i + 1] of the
+    'offsets' dataset.  The dataset is stored contiguously, so
+    load_bilm_embeddings can memory map it.
+
+    float16 = store the embeddings as float16 instead of float32
+    '''
     with open(options_file, 'r') as fin:
         options = json.load(fin)
     max_word_length = options['char_cnn']['max_characters_per_token']
+    dtype = 'float16' if float16 else 'float32'
 
-    vocab = UnicodeCharsVocabulary(vocab_file, max_word_length)
     batcher = Batcher(vocab_file, max_word_length)
 
     ids_placeholder = tf.placeholder('int32',
                                      shape=(None, None, max_word_length)
     )
-    model = BidirectionalLanguageModel(options_file, weight_file)
+    if contiguous:
+        # the batches mix unrelated sentences, so don't carry the states
+        model = BidirectionalLanguageModel(options_file, weight_file,
+                                           stateless=True)
+    else:
+        model = BidirectionalLanguageModel(options_file, weight_file)
     ops = model(ids_placeholder)
 
     config = tf.ConfigProto(allow_soft_placement=True)
     with tf.Session(config=config) as sess:
         sess.run(tf.global_variables_initializer())
+        if contiguous:
+            with h5py.File(outfile, 'w') as fout:
+                _dump_contiguous(sess, ops, ids_placeholder, batcher,
+                                 options, dataset_file, fout, batch_size,
+                                 bucket_window, dtype)
+            return
+
         sentence_id = 0
         with open(dataset_file, 'r') as fin, h5py.File(outfile, 'w') as fout:
             for line in fin:
@@ -664,9 +1123,59 @@ def dump_bilm_embeddings(vocab_file, dataset_file, options_file,
                 )
                 ds = fout.create_dataset(
                     '{}'.format(sentence_id),
-                    embeddings.shape[1:], dtype='float32',
+                    embeddings.shape[1:], dtype=dtype,
                     data=embeddings[0, :, :, :]
                 )
 
                 sentence_id += 1
 
+
+def _dump_contiguous(sess, ops, ids_placeholder, batcher, options,
+                     dataset_file, fout, batch_size, bucket_window, dtype):
+    # a first pass over the dataset for the offsets of the sentences
+    lengths = [len(sentence) for sentence in _read_sentences(dataset_file)]
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(lengths)
+    fout.create_dataset('offsets', data=offsets)
+
+    # the token layer and each LSTM layer, all the directions concatenated
+    n_layers = options['lstm'].get('n_layers', 1) + 1
+    dim = len(_inference_directions(options)) * options['lstm']['projection_dim']
+    # no chunks, the embeddings are stored contiguously
+    ds = fout.create_dataset(
+        'embeddings', (offsets[-1], n_layers, dim), dtype=dtype)
+
+    for sentence_ids, sentences in _bucketed_batches(
+            _read_sentences(dataset_file), batch_size, bucket_window):
+        char_ids = batcher.batch_sentences(sentences)
+        embeddings = sess.run(
+            ops['lm_embeddings'], feed_dict={ids_placeholder: char_ids})
+        # (batch, layers, tokens, dim) -> (batch, tokens, layers, dim)
+        embeddings = embeddings.transpose(0, 2, 1, 3).astype(dtype)
+        for k, sentence_id in enumerate(sentence_ids):
+            start, end = offsets[sentence_id], offsets[sentence_id + 1]
+            if end > start:
+                ds[start:end] = embeddings[k, :end - start]
+
+
+def load_bilm_embeddings(embedding_file):
+    '''
+    Memory map the embeddings written by dump_bilm_embeddings with
+    contiguous=True.
+
+    Returns (embeddings, offsets), the embeddings of sentence i are
+    embeddings[offsets[i]:offsets[i + 1]], shape (n_tokens, 3, 1024) for
+    the pretrained biLMs.
+    '''
+    with h5py.File(embedding_file, 'r') as fin:
+        ds = fin['embeddings']
+        offsets = fin['offsets'][...]
+        shape, dtype = ds.shape, ds.dtype
+        file_offset = ds.id.get_offset()
+
+    if file_offset is None:
+        # nothing was written, e.g. an empty dataset
+        return np.zeros(shape, dtype=dtype), offsets
+    embeddings = np.memmap(embedding_file, dtype=dtype, mode='r',
+                           offset=file_offset, shape=shape)
+    return embeddings, offsets
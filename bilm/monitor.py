@@ -0,0 +1,155 @@
+'''
+Per step timing and throughput statistics for the training loop.
+'''
+
+import os
+import time
+import json
+import resource
+from contextlib import contextmanager
+
+import tensorflow as tf
+
+from tensorflow.python.client import timeline
+
+
+def _host_rss_bytes():
+    # current resident set size, from /proc on Linux, otherwise fall
+    # back to the peak RSS reported by getrusage
+    try:
+        with open('/proc/self/statm') as fin:
+            rss_pages = int(fin.read().split()[1])
+        return rss_pages * resource.getpagesize()
+    except (IOError, OSError, IndexError, ValueError):
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        return max_rss * 1024 if os.uname()[0] != 'Darwin' else max_rss
+
+
+class StepMonitor(object):
+    '''
+    Records where the time of each training step goes:
+
+        data_wait: waiting on the data generator for the next batch
+        feed_dict: slicing the batch into the feed dict
+        session_run: the sess.run call
+        checkpoint: saving the checkpoint, when one is saved
+
+    Every log_every steps the means over the window, the tokens per
+    second for each direction and the host RSS are written as TensorBoard
+    scalars under 'step_stats/' (if summary_writer is given) and as one
+    JSON line to log_file.
+
+    If trace_every is given, a full RunMetadata trace is captured every
+    trace_every steps, added to the summary writer and written as a Chrome
+    trace (timeline_{step}.json) next to log_file.
+    '''
+    TIMERS = ['data_wait', 'feed_dict', 'session_run', 'checkpoint']
+
+    def __init__(self, log_file, directions, n_tokens_per_step,
+                 summary_writer=None, log_every=100, trace_every=None):
+        self._log_file = log_file
+        self._directions = directions
+        self._n_tokens_per_step = n_tokens_per_step
+        self._summary_writer = summary_writer
+        self._log_every = log_every
+        self._trace_every = trace_every
+
+        self._fout = open(log_file, 'a')
+        self._run_metadata = None
+        self._reset_window()
+
+    def _reset_window(self):
+        self._times = {name: 0.0 for name in self.TIMERS}
+        self._n_steps = 0
+        self._window_start = time.time()
+
+    def timed(self, iterable):
+        '''
+        Iterate over iterable, recording the time spent waiting
+        for each item as data_wait.
+        '''
+        iterator = iter(iterable)
+        while True:
+            t0 = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self._times['data_wait'] += time.time() - t0
+            yield item
+
+    @contextmanager
+    def time(self, name):
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            self._times[name] += time.time() - t0
+
+    def run_kwargs(self, step):
+        '''
+        The extra keyword arguments for sess.run at this step,
+        requesting a full trace every trace_every steps.
+        '''
+        if self._trace_every and step % self._trace_every == 0:
+            self._run_metadata = tf.RunMetadata()
+            return {
+                'options': tf.RunOptions(
+                    trace_level=tf.RunOptions.FULL_TRACE),
+                'run_metadata': self._run_metadata,
+            }
+        return {}
+
+    def end_step(self, step):
+        '''Finish step and write the statistics if it is a logging step.'''
+        self._n_steps += 1
+
+        if self._run_metadata is not None:
+            self._write_trace(step)
+            self._run_metadata = None
+
+        if step % self._log_every == 0:
+            self._write_stats(step)
+            self._reset_window()
+
+    def _write_trace(self, step):
+        if self._summary_writer is not None:
+            self._summary_writer.add_run_metadata(
+                self._run_metadata, 'step%d' % step, step)
+        trace = timeline.Timeline(self._run_metadata.step_stats)
+        trace_file = os.path.join(
+            os.path.dirname(self._log_file), 'timeline_%d.json' % step)
+        with open(trace_file, 'w') as fout:
+            fout.write(trace.generate_chrome_trace_format())
+
+    def _write_stats(self, step):
+        elapsed = time.time() - self._window_start
+        n_steps = max(self._n_steps, 1)
+
+        stats = {'step': step, 'time': time.time()}
+        for name in self.TIMERS:
+            stats[name + '_secs'] = self._times[name] / n_steps
+        stats['step_secs'] = elapsed / n_steps
+
+        # every direction sees the same tokens, in a different order
+        tokens_per_sec = self._n_tokens_per_step * self._n_steps / \
+            max(elapsed, 1e-6)
+        for direction in self._directions:
+            stats['tokens_per_sec_' + direction] = tokens_per_sec
+        stats['host_rss_mb'] = _host_rss_bytes() / 2.0 ** 20
+
+        self._fout.write(json.dumps(stats) + '\n')
+        self._fout.flush()
+
+        if self._summary_writer is not None:
+            summary = tf.Summary(value=[
+                tf.Summary.Value(tag='step_stats/' + key,
+                                 simple_value=float(value))
+                for key, value in sorted(stats.items())
+                if key not in ('step', 'time')
+            ])
+            self._summary_writer.add_summary(summary, step)
+
+    def close(self):
+        self._fout.close()
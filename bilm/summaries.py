@@ -0,0 +1,89 @@
+'''
+Variable histogram summaries that are cheap to compute and run off the
+training step.
+'''
+
+import re
+import threading
+
+import tensorflow as tf
+
+
+def variable_histograms(variables, allow=None, max_rows=2048):
+    '''
+    Histogram summaries of variables.
+
+    allow = an optional list of regular expressions, only the variables
+        with a name matching one of them are summarized.
+    max_rows = the histogram of a variable with more rows than this
+        is computed over max_rows rows sampled uniformly at random
+        (with replacement) at each run, e.g. for the softmax matrix and
+        its Adagrad slot.  None to always use all rows.
+    '''
+    if allow is not None:
+        patterns = [re.compile(p) for p in allow]
+        variables = [v for v in variables
+                     if any(p.search(v.op.name) for p in patterns)]
+
+    summaries = []
+    for v in variables:
+        shape = v.get_shape()
+        values = v
+        if (max_rows is not None and shape.ndims and shape.ndims > 1 and
+                shape[0].value is not None and shape[0].value > max_rows):
+            with tf.device(v.device):
+                rows = tf.random_uniform(
+                    [max_rows], 0, shape[0].value, dtype=tf.int32)
+                values = tf.gather(v, rows)
+        summaries.append(
+            tf.summary.histogram(v.name.replace(":", "_"), values))
+    return summaries
+
+
+class AsyncSummaryRunner(object):
+    '''
+    Runs summary_op on a background thread and adds the result to
+    summary_writer, so computing the summaries does not hold up the
+    training steps.
+
+    summary_op must not depend on any placeholders.  If the previous run
+    is still in progress, the new request is dropped.
+    '''
+    def __init__(self, sess, summary_op, summary_writer):
+        self._sess = sess
+        self._summary_op = summary_op
+        self._summary_writer = summary_writer
+        self._thread = None
+        self._error = None
+
+    def run(self, global_step):
+        '''Start computing the summaries for global_step, return
+        False if the previous run has not finished yet.'''
+        self._raise_error()
+        if self._thread is not None and self._thread.is_alive():
+            return False
+        self._thread = threading.Thread(target=self._run, args=(global_step, ))
+        self._thread.daemon = True
+        self._thread.start()
+        return True
+
+    def close(self):
+        '''Wait for the summaries in progress.'''
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._raise_error()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error = self._error
+            self._error = None
+            raise error
+
+    def _run(self, global_step):
+        try:
+            summary = self._sess.run(self._summary_op)
+            self._summary_writer.add_summary(summary, global_step)
+        except Exception as e:
+            # surface it in the training thread on the next run
+            self._error = e
@@ -6,13 +6,19 @@ import os
 import time
 import json
 import re
+import hashlib
 
 import tensorflow as tf
 import numpy as np
 
 from tensorflow.python.ops.init_ops import glorot_uniform_initializer
+from tensorflow.python.util import nest
 
 from .data import Vocabulary, UnicodeCharsVocabulary
+from .directions import get_directions
+from .checkpoint import AsyncCheckpointSaver
+from .monitor import StepMonitor
+from .summaries import variable_histograms, AsyncSummaryRunner
 
 DTYPE = 'float32'
 DTYPE_INT = 'int64'
@@ -25,6 +31,19 @@ def print_variable_summary():
     variables = sorted([[v.name, v.get_shape()] for v in tf.global_variables()])
     pprint.pprint(variables)
 
+def _float32_variable_getter(getter, name, shape=None, dtype=None,
+                             *args, **kwargs):
+    # store the variables requested in reduced precision in float32 and
+    # cast them when read, so the updates are applied in full precision
+    storage_dtype = dtype
+    if dtype in (tf.float16, tf.bfloat16):
+        storage_dtype = tf.float32
+    variable = getter(name, shape, storage_dtype, *args, **kwargs)
+    if storage_dtype != dtype:
+        variable = tf.cast(variable, dtype)
+    return variable
+
+
 # NOTE(feiga): Training model. 
 class LanguageModel(object):
     '''
@@ -50,14 +69,26 @@ class LanguageModel(object):
         'projection_dim' is assumed token embedding size and LSTM output size.
         'dim' is the hidden state size.
         Set 'dim' == 'projection_dim' to skip a projection layer.
+
+    partitioner is an optional variable partitioner for the large
+    vocabulary sized variables (token embeddings and softmax), e.g. to
+    shard them across parameter servers.
+
+    With 'compute_dtype': 'float16' or 'bfloat16' in options, the char CNN,
+    highway layers and LSTMs are computed in that precision while the
+    variables are kept in float32 and cast when read.  The softmax and
+    losses are always computed in float32.
     '''
-    def __init__(self, options, is_training):
+    def __init__(self, options, is_training, partitioner=None):
         self.options = options
         self.is_training = is_training
+        self.partitioner = partitioner
         # NOTE(feiga): add omnidirectional and more options
         self.bidirectional = options.get('bidirectional', False)
         self.multidirectional = options.get('multidirectional', False)
-        self.permute_number = options.get('permute_number', 2)
+        self.permute_number = options.get('permute_number', 4)
+        # the directions of the LSTMs, see bilm.directions
+        self.directions = get_directions(options)
 
         # use word or char inputs?
         self.char_inputs = 'char_cnn' in self.options
@@ -71,7 +102,13 @@ class LanguageModel(object):
 
         self.sample_softmax = options.get('sample_softmax', True)
 
-        self._build()
+        self.compute_dtype = tf.as_dtype(options.get('compute_dtype', DTYPE))
+        if self.compute_dtype != tf.as_dtype(DTYPE):
+            with tf.variable_scope(tf.get_variable_scope(),
+                                   custom_getter=_float32_variable_getter):
+                self._build()
+        else:
+            self._build()
 
     def _build_word_embeddings(self):
         n_tokens_vocab = self.options['n_tokens_vocab']
@@ -81,78 +118,27 @@ class LanguageModel(object):
         # LSTM options
         projection_dim = self.options['lstm']['projection_dim']
 
-        # the input token_ids and word embeddings
-        self.token_ids = tf.placeholder(DTYPE_INT,
-                               shape=(batch_size, unroll_steps),
-                               name='token_ids')
         # the word embeddings
         with tf.device("/cpu:0"):
             self.embedding_weights = tf.get_variable(
                 "embedding", [n_tokens_vocab, projection_dim],
                 dtype=DTYPE,
+                partitioner=self.partitioner,
             )
-            self.embedding = tf.nn.embedding_lookup(self.embedding_weights,
-                                                self.token_ids)
-
-        # if a bidirectional LM then make placeholders for reverse
-        # model and embeddings
-        # NOTE(feiga): if a omnidirectional LM then make placeholder
-        #              for permuted model and embeddings
-        if self.bidirectional:
-            self.token_ids_reverse = tf.placeholder(DTYPE_INT,
+
+        # the input token_ids and word embeddings for each direction,
+        # e.g. self.token_ids and self.embedding for forward,
+        # self.token_ids_reverse and self.embedding_reverse for backward
+        for direction in self.directions:
+            token_ids = tf.placeholder(DTYPE_INT,
                                shape=(batch_size, unroll_steps),
-                               name='token_ids_reverse')
+                               name='token_ids' + direction.suffix)
             with tf.device("/cpu:0"):
-                self.embedding_reverse = tf.nn.embedding_lookup(
-                    self.embedding_weights, self.token_ids_reverse)
-        # Note(feiga):
-        if self.multidirectional:
-             self.token_ids_permuted1 = tf.placeholder(DTYPE_INT,
-                               shape=(batch_size, unroll_steps),
-                               name='token_ids_permuted1')
-             self.token_ids_permuted2 = tf.placeholder(DTYPE_INT,
-                               shape=(batch_size, unroll_steps),
-                               name='token_ids_permuted2')
-             with tf.device("/cpu:0"):
-                self.embedding_permuted1 = tf.nn.embedding_lookup(
-                    self.embedding_weights, self.token_ids_permuted1)
-                self.embedding_permuted2 = tf.nn.embedding_lookup(
-                    self.embedding_weights, self.token_ids_permuted2)
-             if self.permute_number == 6:
-                 self.token_ids_permuted3 = tf.placeholder(DTYPE_INT,
-                                                           shape=(batch_size, unroll_steps),
-                                                           name='token_ids_permuted3')
-                 self.token_ids_permuted4 = tf.placeholder(DTYPE_INT,
-                                                           shape=(batch_size, unroll_steps),
-                                                           name='token_ids_permuted4')
-                 with tf.device("/cpu:0"):
-                     self.embedding_permuted3 = tf.nn.embedding_lookup(
-                         self.embedding_weights, self.token_ids_permuted3)
-                     self.embedding_permuted4 = tf.nn.embedding_lookup(
-                         self.embedding_weights, self.token_ids_permuted4)
-             elif self.permute_number == 8:
-                 self.token_ids_permuted3 = tf.placeholder(DTYPE_INT,
-                                                           shape=(batch_size, unroll_steps),
-                                                           name='token_ids_permuted3')
-                 self.token_ids_permuted4 = tf.placeholder(DTYPE_INT,
-                                                           shape=(batch_size, unroll_steps),
-                                                           name='token_ids_permuted4')
-                 self.token_ids_permuted5 = tf.placeholder(DTYPE_INT,
-                                                           shape=(batch_size, unroll_steps),
-                                                           name='token_ids_permuted5')
-                 self.token_ids_permuted6 = tf.placeholder(DTYPE_INT,
-                                                           shape=(batch_size, unroll_steps),
-                                                           name='token_ids_permuted6')
-                 with tf.device("/cpu:0"):
-                     self.embedding_permuted3 = tf.nn.embedding_lookup(
-                         self.embedding_weights, self.token_ids_permuted3)
-                     self.embedding_permuted4 = tf.nn.embedding_lookup(
-                         self.embedding_weights, self.token_ids_permuted4)
-                     self.embedding_permuted5 = tf.nn.embedding_lookup(
-                         self.embedding_weights, self.token_ids_permuted5)
-                     self.embedding_permuted6 = tf.nn.embedding_lookup(
-                         self.embedding_weights, self.token_ids_permuted6)
-
+                embedding = tf.nn.embedding_lookup(self.embedding_weights,
+                                                   token_ids,
+                                                   partition_strategy='div')
+            setattr(self, 'token_ids' + direction.suffix, token_ids)
+            setattr(self, 'embedding' + direction.suffix, embedding)
 
     def _build_word_char_embeddings(self):
         '''
@@ -197,10 +183,6 @@ class LanguageModel(object):
         elif cnn_options['activation'] == 'relu':
             activation = tf.nn.relu
 
-        # the input character ids 
-        self.tokens_characters = tf.placeholder(DTYPE_INT,
-                                   shape=(batch_size, unroll_steps, max_chars),
-                                   name='tokens_characters')
         # the character embeddings
         with tf.device("/cpu:0"):
             self.embedding_weights = tf.get_variable(
@@ -208,65 +190,28 @@ class LanguageModel(object):
                     dtype=DTYPE,
                     initializer=tf.random_uniform_initializer(-1.0, 1.0)
             )
-            # shape (batch_size, unroll_steps, max_chars, embed_dim)
-            self.char_embedding = tf.nn.embedding_lookup(self.embedding_weights,
-                                                    self.tokens_characters)
 
-            if self.bidirectional:
-                self.tokens_characters_reverse = tf.placeholder(DTYPE_INT,
+        # the input character ids for each direction, e.g.
+        # self.tokens_characters for forward and
+        # self.tokens_characters_reverse for backward
+        char_embeddings = []
+        for direction in self.directions:
+            tokens_characters = tf.placeholder(DTYPE_INT,
                                    shape=(batch_size, unroll_steps, max_chars),
-                                   name='tokens_characters_reverse')
-                self.char_embedding_reverse = tf.nn.embedding_lookup(
-                    self.embedding_weights, self.tokens_characters_reverse)
-            # NOTE(feiga): add for multidirectional
-            if self.multidirectional:
-                self.tokens_characters_permuted1 = tf.placeholder(DTYPE_INT,
-                                   shape=(batch_size, unroll_steps, max_chars),
-                                   name='tokens_characters_permuted1')
-                self.char_embedding_permuted1 = tf.nn.embedding_lookup(
-                    self.embedding_weights, self.tokens_characters_permuted1)
-                self.tokens_characters_permuted2 = tf.placeholder(DTYPE_INT,
-                                   shape=(batch_size, unroll_steps, max_chars),
-                                   name='tokens_characters_permuted2')
-                self.char_embedding_permuted2 = tf.nn.embedding_lookup(
-                    self.embedding_weights, self.tokens_characters_permuted2)
-                if self.permute_number == 6:
-                    self.tokens_characters_permuted3 = tf.placeholder(DTYPE_INT,
-                                                                      shape=(batch_size, unroll_steps, max_chars),
-                                                                      name='tokens_characters_permuted3')
-                    self.char_embedding_permuted3 = tf.nn.embedding_lookup(
-                        self.embedding_weights, self.tokens_characters_permuted3)
-                    self.tokens_characters_permuted4 = tf.placeholder(DTYPE_INT,
-                                                                      shape=(batch_size, unroll_steps, max_chars),
-                                                                      name='tokens_characters_permuted4')
-                    self.char_embedding_permuted4 = tf.nn.embedding_lookup(
-                        self.embedding_weights, self.tokens_characters_permuted4)
-                elif self.permute_number == 8:
-                    self.tokens_characters_permuted3 = tf.placeholder(DTYPE_INT,
-                                                                      shape=(batch_size, unroll_steps, max_chars),
-                                                                      name='tokens_characters_permuted3')
-                    self.char_embedding_permuted3 = tf.nn.embedding_lookup(
-                        self.embedding_weights, self.tokens_characters_permuted3)
-                    self.tokens_characters_permuted4 = tf.placeholder(DTYPE_INT,
-                                                                      shape=(batch_size, unroll_steps, max_chars),
-                                                                      name='tokens_characters_permuted4')
-                    self.char_embedding_permuted4 = tf.nn.embedding_lookup(
-                        self.embedding_weights, self.tokens_characters_permuted4)
-                    self.tokens_characters_permuted5 = tf.placeholder(DTYPE_INT,
-                                                                      shape=(batch_size, unroll_steps, max_chars),
-                                                                      name='tokens_characters_permuted5')
-                    self.char_embedding_permuted5 = tf.nn.embedding_lookup(
-                        self.embedding_weights, self.tokens_characters_permuted5)
-                    self.tokens_characters_permuted6 = tf.placeholder(DTYPE_INT,
-                                                                      shape=(batch_size, unroll_steps, max_chars),
-                                                                      name='tokens_characters_permuted6')
-                    self.char_embedding_permuted6 = tf.nn.embedding_lookup(
-                        self.embedding_weights, self.tokens_characters_permuted6)
-
-
+                                   name='tokens_characters' + direction.suffix)
+            with tf.device("/cpu:0"):
+                # shape (batch_size, unroll_steps, max_chars, embed_dim)
+                char_embedding = tf.nn.embedding_lookup(
+                    self.embedding_weights, tokens_characters)
+            setattr(self, 'tokens_characters' + direction.suffix,
+                    tokens_characters)
+            setattr(self, 'char_embedding' + direction.suffix,
+                    char_embedding)
+            char_embeddings.append(char_embedding)
 
         # the convolutions
         def make_convolutions(inp, reuse):
+            inp = tf.cast(inp, self.compute_dtype)
             with tf.variable_scope('CNN', reuse=reuse) as scope:
                 convolutions = []
                 for i, (width, num) in enumerate(filters):
@@ -291,9 +236,9 @@ class LanguageModel(object):
                         "W_cnn_%s" % i,
                         [1, width, char_embed_dim, num],
                         initializer=w_init,
-                        dtype=DTYPE)
+                        dtype=self.compute_dtype)
                     b = tf.get_variable(
-                        "b_cnn_%s" % i, [num], dtype=DTYPE,
+                        "b_cnn_%s" % i, [num], dtype=self.compute_dtype,
                         initializer=tf.constant_initializer(0.0))
 
                     conv = tf.nn.conv2d(
@@ -315,34 +260,13 @@ class LanguageModel(object):
 
         # for first model, this is False, for others it's True
         reuse = tf.get_variable_scope().reuse
-        embedding = make_convolutions(self.char_embedding, reuse)
-
-        self.token_embedding_layers = [embedding]
-
-        if self.bidirectional:
-            # re-use the CNN weights from forward pass
-            embedding_reverse = make_convolutions(
-                self.char_embedding_reverse, True)
-        # NOTE(feiga): add for multidirectional
-        if self.multidirectional:
-            embedding_permuted1 = make_convolutions(
-                self.char_embedding_permuted1, True)
-            embedding_permuted2 = make_convolutions(
-                self.char_embedding_permuted2, True)
-            if self.permute_number == 6:
-                embedding_permuted3 = make_convolutions(
-                    self.char_embedding_permuted3, True)
-                embedding_permuted4 = make_convolutions(
-                    self.char_embedding_permuted4, True)
-            elif self.permute_number == 8:
-                embedding_permuted3 = make_convolutions(
-                    self.char_embedding_permuted3, True)
-                embedding_permuted4 = make_convolutions(
-                    self.char_embedding_permuted4, True)
-                embedding_permuted5 = make_convolutions(
-                    self.char_embedding_permuted5, True)
-                embedding_permuted6 = make_convolutions(
-                    self.char_embedding_permuted6, True)
+        # the other directions re-use the CNN weights of the first
+        embeddings = [
+            make_convolutions(char_embedding, reuse or k > 0)
+            for k, char_embedding in enumerate(char_embeddings)
+        ]
+
+        self.token_embedding_layers = [embeddings[0]]
 
         # for highway and projection layers:
         #   reshape from (batch_size, n_tokens, dim) to
@@ -351,30 +275,8 @@ class LanguageModel(object):
         use_proj = n_filters != projection_dim
 
         if use_highway or use_proj:
-            embedding = tf.reshape(embedding, [-1, n_filters])
-            if self.bidirectional:
-                embedding_reverse = tf.reshape(embedding_reverse,
-                    [-1, n_filters])
-            # NOTE(feiga): add for multidirectional
-            if self.multidirectional:
-                embedding_permuted1 = tf.reshape(embedding_permuted1,
-                    [-1, n_filters])
-                embedding_permuted2 = tf.reshape(embedding_permuted2,
-                    [-1, n_filters])
-                if self.permute_number == 6:
-                    embedding_permuted3 = tf.reshape(embedding_permuted3,
-                                                     [-1, n_filters])
-                    embedding_permuted4 = tf.reshape(embedding_permuted4,
-                                                     [-1, n_filters])
-                elif self.permute_number == 8:
-                    embedding_permuted3 = tf.reshape(embedding_permuted3,
-                                                     [-1, n_filters])
-                    embedding_permuted4 = tf.reshape(embedding_permuted4,
-                                                     [-1, n_filters])
-                    embedding_permuted5 = tf.reshape(embedding_permuted5,
-                                                     [-1, n_filters])
-                    embedding_permuted6 = tf.reshape(embedding_permuted6,
-                                                     [-1, n_filters])
+            embeddings = [tf.reshape(embedding, [-1, n_filters])
+                          for embedding in embeddings]
 
         # set up weights for projection
         if use_proj:
@@ -384,11 +286,11 @@ class LanguageModel(object):
                         "W_proj", [n_filters, projection_dim],
                         initializer=tf.random_normal_initializer(
                             mean=0.0, stddev=np.sqrt(1.0 / n_filters)),
-                        dtype=DTYPE)
+                        dtype=self.compute_dtype)
                     b_proj_cnn = tf.get_variable(
                         "b_proj", [projection_dim],
                         initializer=tf.constant_initializer(0.0),
-                        dtype=DTYPE)
+                        dtype=self.compute_dtype)
 
         # apply highways layers
         def high(x, ww_carry, bb_carry, ww_tr, bb_tr):
@@ -406,128 +308,50 @@ class LanguageModel(object):
                         # glorit init
                         initializer=tf.random_normal_initializer(
                             mean=0.0, stddev=np.sqrt(1.0 / highway_dim)),
-                        dtype=DTYPE)
+                        dtype=self.compute_dtype)
                     b_carry = tf.get_variable(
                         'b_carry', [highway_dim],
                         initializer=tf.constant_initializer(-2.0),
-                        dtype=DTYPE)
+                        dtype=self.compute_dtype)
                     W_transform = tf.get_variable(
                         'W_transform', [highway_dim, highway_dim],
                         initializer=tf.random_normal_initializer(
                             mean=0.0, stddev=np.sqrt(1.0 / highway_dim)),
-                        dtype=DTYPE)
+                        dtype=self.compute_dtype)
                     b_transform = tf.get_variable(
                         'b_transform', [highway_dim],
                         initializer=tf.constant_initializer(0.0),
-                        dtype=DTYPE)
-
-                embedding = high(embedding, W_carry, b_carry,
-                                 W_transform, b_transform)
-                if self.bidirectional:
-                    embedding_reverse = high(embedding_reverse,
-                                             W_carry, b_carry,
-                                             W_transform, b_transform)
-                # NOTE(feiga): add for multidirectional
-                if self.multidirectional:
-                    embedding_permuted1 = high(embedding_permuted1,
-                                             W_carry, b_carry,
-                                             W_transform, b_transform)
-                    embedding_permuted2 = high(embedding_permuted2,
-                                             W_carry, b_carry,
-                                             W_transform, b_transform)
-                    if self.permute_number == 6:
-                        embedding_permuted3 = high(embedding_permuted3,
-                                                   W_carry, b_carry,
-                                                   W_transform, b_transform)
-                        embedding_permuted4 = high(embedding_permuted4,
-                                                   W_carry, b_carry,
-                                                   W_transform, b_transform)
-                    elif self.permute_number == 8:
-                        embedding_permuted3 = high(embedding_permuted3,
-                                                   W_carry, b_carry,
-                                                   W_transform, b_transform)
-                        embedding_permuted4 = high(embedding_permuted4,
-                                                   W_carry, b_carry,
-                                                   W_transform, b_transform)
-                        embedding_permuted5 = high(embedding_permuted5,
-                                                   W_carry, b_carry,
-                                                   W_transform, b_transform)
-                        embedding_permuted6 = high(embedding_permuted6,
-                                                   W_carry, b_carry,
-                                                   W_transform, b_transform)
-                
+                        dtype=self.compute_dtype)
+
+                embeddings = [high(embedding, W_carry, b_carry,
+                                   W_transform, b_transform)
+                              for embedding in embeddings]
+
                 self.token_embedding_layers.append(
-                    tf.reshape(embedding, 
+                    tf.reshape(embeddings[0],
                         [batch_size, unroll_steps, highway_dim])
                 )
 
         # finally project down to projection dim if needed
         if use_proj:
-            embedding = tf.matmul(embedding, W_proj_cnn) + b_proj_cnn
-            if self.bidirectional:
-                embedding_reverse = tf.matmul(embedding_reverse, W_proj_cnn) \
-                    + b_proj_cnn
-            # NOTE(feiga): add for multidirectional
-            if self.multidirectional:
-                embedding_permuted1 = tf.matmul(embedding_permuted1, W_proj_cnn) \
-                    + b_proj_cnn
-                embedding_permuted2 = tf.matmul(embedding_permuted2, W_proj_cnn) \
-                    + b_proj_cnn
-                if self.permute_number == 6:
-                    embedding_permuted3 = tf.matmul(embedding_permuted3, W_proj_cnn) \
-                                          + b_proj_cnn
-                    embedding_permuted4 = tf.matmul(embedding_permuted4, W_proj_cnn) \
-                                          + b_proj_cnn
-                elif self.permute_number == 8:
-                    embedding_permuted3 = tf.matmul(embedding_permuted3, W_proj_cnn) \
-                                          + b_proj_cnn
-                    embedding_permuted4 = tf.matmul(embedding_permuted4, W_proj_cnn) \
-                                          + b_proj_cnn
-                    embedding_permuted5 = tf.matmul(embedding_permuted5, W_proj_cnn) \
-                                          + b_proj_cnn
-                    embedding_permuted6 = tf.matmul(embedding_permuted6, W_proj_cnn) \
-                                          + b_proj_cnn
+            embeddings = [tf.matmul(embedding, W_proj_cnn) + b_proj_cnn
+                          for embedding in embeddings]
 
             self.token_embedding_layers.append(
-                tf.reshape(embedding,
+                tf.reshape(embeddings[0],
                         [batch_size, unroll_steps, projection_dim])
             )
 
         # reshape back to (batch_size, tokens, dim)
         if use_highway or use_proj:
             shp = [batch_size, unroll_steps, projection_dim]
-            embedding = tf.reshape(embedding, shp)
-            if self.bidirectional:
-                embedding_reverse = tf.reshape(embedding_reverse, shp)
-            # NOTE(feiga): add for multidirectional
-            if self.multidirectional:
-                embedding_permuted1 = tf.reshape(embedding_permuted1, shp)
-                embedding_permuted2 = tf.reshape(embedding_permuted2, shp)
-                if self.permute_number == 6:
-                    embedding_permuted3 = tf.reshape(embedding_permuted3, shp)
-                    embedding_permuted4 = tf.reshape(embedding_permuted4, shp)
-                elif self.permute_number == 8:
-                    embedding_permuted3 = tf.reshape(embedding_permuted3, shp)
-                    embedding_permuted4 = tf.reshape(embedding_permuted4, shp)
-                    embedding_permuted5 = tf.reshape(embedding_permuted5, shp)
-                    embedding_permuted6 = tf.reshape(embedding_permuted6, shp)
-
-        # at last assign attributes for remainder of the model
-        self.embedding = embedding
-        if self.bidirectional:
-            self.embedding_reverse = embedding_reverse
-        # NOTE(feiga): add for multidirectional
-        if self.multidirectional:
-            self.embedding_permuted1 = embedding_permuted1
-            self.embedding_permuted2 = embedding_permuted2
-            if self.permute_number == 6:
-                self.embedding_permuted3 = embedding_permuted3
-                self.embedding_permuted4 = embedding_permuted4
-            elif self.permute_number == 8:
-                self.embedding_permuted3 = embedding_permuted3
-                self.embedding_permuted4 = embedding_permuted4
-                self.embedding_permuted5 = embedding_permuted5
-                self.embedding_permuted6 = embedding_permuted6
+            embeddings = [tf.reshape(embedding, shp)
+                          for embedding in embeddings]
+
+        # at last assign attributes for remainder of the model, e.g.
+        # self.embedding and self.embedding_reverse
+        for direction, embedding in zip(self.directions, embeddings):
+            setattr(self, 'embedding' + direction.suffix, embedding)
 
     def _build(self):
         # size of input options
@@ -553,23 +377,13 @@ class LanguageModel(object):
         self.init_lstm_state = []
         self.final_lstm_state = []
 
-        # get the LSTM inputs
-        # NOTE(feiga): add for multidirectional
-        if self.multidirectional and self.bidirectional:
-            lstm_inputs = [self.embedding, self.embedding_reverse, self.embedding_permuted1, self.embedding_permuted2]
-            if self.permute_number == 6:
-                lstm_inputs = [self.embedding, self.embedding_reverse,
-                               self.embedding_permuted1, self.embedding_permuted2,
-                               self.embedding_permuted3, self.embedding_permuted4]
-            elif self.permute_number == 8:
-                lstm_inputs = [self.embedding, self.embedding_reverse,
-                               self.embedding_permuted1, self.embedding_permuted2,
-                               self.embedding_permuted3, self.embedding_permuted4,
-                               self.embedding_permuted5, self.embedding_permuted6]
-        elif self.bidirectional:
-            lstm_inputs = [self.embedding, self.embedding_reverse]
-        else:
-            lstm_inputs = [self.embedding]
+        # get the LSTM inputs, one per direction
+        # the word embeddings are looked up in float32
+        lstm_inputs = [
+            tf.cast(getattr(self, 'embedding' + direction.suffix),
+                    self.compute_dtype)
+            for direction in self.directions
+        ]
 
         # now compute the LSTM outputs
         cell_clip = self.options['lstm'].get('cell_clip')
@@ -580,8 +394,12 @@ class LanguageModel(object):
         if use_skip_connections:
             print("USING SKIP CONNECTIONS")
 
+        # NOTE: a forward only model has no variable scope for the LSTM,
+        # for backward compatibility with existing models...
+        use_direction_scopes = [d.name for d in self.directions] != ['forward']
+
         lstm_outputs = []
-        for lstm_num, lstm_input in enumerate(lstm_inputs):
+        for direction, lstm_input in zip(self.directions, lstm_inputs):
             lstm_cells = []
             for i in range(n_lstm_layers):
                 if projection_dim < lstm_dim:
@@ -618,14 +436,10 @@ class LanguageModel(object):
 
             with tf.control_dependencies([lstm_input]):
                 self.init_lstm_state.append(
-                    lstm_cell.zero_state(batch_size, DTYPE))
-
-                # NOTE(feiga): add for multidirectional
-      
-                # NOTE: this variable scope is for backward compatibility
-                # with existing models...
-                if self.bidirectional or self.multidirectional:
-                    with tf.variable_scope('RNN_%s' % lstm_num):
+                    lstm_cell.zero_state(batch_size, self.compute_dtype))
+
+                if use_direction_scopes:
+                    with tf.variable_scope(direction.scope):
                         _lstm_output_unpacked, final_state = tf.nn.static_rnn(
                             lstm_cell,
                             tf.unstack(lstm_input, axis=1),
@@ -640,6 +454,8 @@ class LanguageModel(object):
             # (batch_size * unroll_steps, 512)
             lstm_output_flat = tf.reshape(
                 tf.stack(_lstm_output_unpacked, axis=1), [-1, projection_dim])
+            # the softmax is computed in float32
+            lstm_output_flat = tf.cast(lstm_output_flat, DTYPE)
             if self.is_training:
                 # add dropout to output
                 lstm_output_flat = tf.nn.dropout(lstm_output_flat,
@@ -655,6 +471,8 @@ class LanguageModel(object):
         '''
         Create:
             self.total_loss: total loss op for training
+            self.individual_token_losses: the loss of every target in the
+                batch, (batch_size * unroll_steps, ), for each direction
             self.softmax_W, softmax_b: the softmax variables
             self.next_token_id / _reverse: placeholders for gold input
 
@@ -672,23 +490,13 @@ class LanguageModel(object):
                                    name=name)
             return id_placeholder
 
-        # get the window and weight placeholders
-        self.next_token_id = _get_next_token_placeholders('')
-        if self.bidirectional:
-            self.next_token_id_reverse = _get_next_token_placeholders(
-                '_reverse')
-        # NOTE(feiga): add for multidirectional
-        if self.multidirectional:
-            self.next_token_id_permuted1 = _get_next_token_placeholders('_permuted1')
-            self.next_token_id_permuted2 = _get_next_token_placeholders('_permuted2')
-            if self.permute_number == 6:
-                self.next_token_id_permuted3 = _get_next_token_placeholders('_permuted3')
-                self.next_token_id_permuted4 = _get_next_token_placeholders('_permuted4')
-            elif self.permute_number == 8:
-                self.next_token_id_permuted3 = _get_next_token_placeholders('_permuted3')
-                self.next_token_id_permuted4 = _get_next_token_placeholders('_permuted4')
-                self.next_token_id_permuted5 = _get_next_token_placeholders('_permuted5')
-                self.next_token_id_permuted6 = _get_next_token_placeholders('_permuted6')
+        # get the window and weight placeholders for each direction,
+        # e.g. self.next_token_id and self.next_token_id_reverse
+        next_ids = []
+        for direction in self.directions:
+            id_placeholder = _get_next_token_placeholders(direction.suffix)
+            setattr(self, 'next_token_id' + direction.suffix, id_placeholder)
+            next_ids.append(id_placeholder)
 
         # DEFINE THE SOFTMAX VARIABLES
         # get the dimension of the softmax weights
@@ -708,7 +516,8 @@ class LanguageModel(object):
                 self.softmax_W = tf.get_variable(
                     'W', [n_tokens_vocab, softmax_dim],
                     dtype=DTYPE,
-                    initializer=softmax_init
+                    initializer=softmax_init,
+                    partitioner=self.partitioner,
                 )
             self.softmax_b = tf.get_variable(
                 'b', [n_tokens_vocab],
@@ -718,23 +527,7 @@ class LanguageModel(object):
         # now calculate losses
         # loss for each direction of the LSTM
         self.individual_losses = []
-
-        # NOTE(feiga): add for multidirectional
-        if self.multidirectional and self.bidirectional:
-            next_ids = [self.next_token_id, self.next_token_id_reverse, self.next_token_id_permuted1, self.next_token_id_permuted2]
-            if self.permute_number == 6:
-                next_ids = [self.next_token_id, self.next_token_id_reverse,
-                            self.next_token_id_permuted1, self.next_token_id_permuted2,
-                            self.next_token_id_permuted3, self.next_token_id_permuted4]
-            elif self.permute_number == 8:
-                next_ids = [self.next_token_id, self.next_token_id_reverse,
-                            self.next_token_id_permuted1, self.next_token_id_permuted2,
-                            self.next_token_id_permuted3, self.next_token_id_permuted4,
-                            self.next_token_id_permuted5, self.next_token_id_permuted6]
-        elif self.bidirectional:
-            next_ids = [self.next_token_id, self.next_token_id_reverse]
-        else:
-            next_ids = [self.next_token_id]
+        self.individual_token_losses = []
 
         for id_placeholder, lstm_output_flat in zip(next_ids, lstm_outputs):
             # flatten the LSTM output and next token id gold to shape:
@@ -749,7 +542,8 @@ class LanguageModel(object):
                                    next_token_id_flat, lstm_output_flat,
                                    self.options['n_negative_samples_batch'],
                                    self.options['n_tokens_vocab'],
-                                   num_true=1)
+                                   num_true=1,
+                                   partition_strategy='div')
 
                 else:
                     # get the full softmax loss
@@ -765,35 +559,12 @@ class LanguageModel(object):
                         labels=tf.squeeze(next_token_id_flat, squeeze_dims=[1])
                     )
 
+            self.individual_token_losses.append(losses)
             self.individual_losses.append(tf.reduce_mean(losses))
 
         # now make the total loss -- it's the mean of the individual losses
-        if self.bidirectional and self.multidirectional:
-            self.total_loss = 0.25 * (self.individual_losses[0]
-                                      + self.individual_losses[1]
-                                      + self.individual_losses[2]
-                                      + self.individual_losses[3])
-            if self.permute_number == 6:
-                self.total_loss = 1./6. * (self.individual_losses[0]
-                                           + self.individual_losses[1]
-                                           + self.individual_losses[2]
-                                           + self.individual_losses[3]
-                                           + self.individual_losses[4]
-                                           + self.individual_losses[5])
-            elif self.permute_number == 8:
-                self.total_loss = 1. / 8. * (self.individual_losses[0]
-                                             + self.individual_losses[1]
-                                             + self.individual_losses[2]
-                                             + self.individual_losses[3]
-                                             + self.individual_losses[4]
-                                             + self.individual_losses[5]
-                                             + self.individual_losses[6]
-                                             + self.individual_losses[7])
-        if self.bidirectional:
-            self.total_loss = 0.5 * (self.individual_losses[0]
-                                     + self.individual_losses[1])
-        else:
-            self.total_loss = self.individual_losses[0]
+        self.total_loss = tf.add_n(self.individual_losses) / \
+            len(self.individual_losses)
 
 
 def average_gradients(tower_grads, batch_size, options):
@@ -814,18 +585,10 @@ def average_gradients(tower_grads, batch_size, options):
         if isinstance(g0, tf.IndexedSlices):
             # If the gradient is type IndexedSlices then this is a sparse
             #   gradient with attributes indices and values.
-            # To average, need to concat them individually then create
-            #   a new IndexedSlices object.
-            indices = []
-            values = []
-            for g, v in grad_and_vars:
-                indices.append(g.indices)
-                values.append(g.values)
-            all_indices = tf.concat(indices, 0)
-            avg_values = tf.concat(values, 0) / len(grad_and_vars)
-            # deduplicate across indices
-            av, ai = _deduplicate_indexed_slices(avg_values, all_indices)
-            grad = tf.IndexedSlices(av, ai, dense_shape=g0.dense_shape)
+            grad = _average_indexed_slices(
+                [g for g, v in grad_and_vars], g0.dense_shape,
+                int(v0.get_shape()[0]),
+                options.get('sparse_grad_dense_threshold', 1.0))
 
         else:
             # a normal tensor can just do a simple average
@@ -853,6 +616,227 @@ def average_gradients(tower_grads, batch_size, options):
     return average_grads
 
 
+class GradientAccumulator(object):
+    '''
+    Accumulates (already tower averaged) gradients over several
+    micro-batches so that the optimizer sees their average, as if the
+    batch was n_steps times larger.
+
+    grads = [(grad1, var1), (grad2, var2), ...] as from average_gradients
+
+    Dense gradients are summed into a buffer the size of the variable.
+    Sparse gradients (IndexedSlices) are added with scatter_add to a buffer
+    and the rows they touch are recorded, so the accumulated gradient is
+    still an IndexedSlices with only the touched (unique) rows and both
+    the update and the reset only cost the number of touched rows.
+
+    The buffers are placed with their variables, or on device if given.
+    '''
+    def __init__(self, grads, n_steps, device=None):
+        self.n_steps = n_steps
+        self.variables = []
+
+        self._grads_and_vars = grads
+        self._buffers = []
+        accumulate_ops = []
+        for g, v in grads:
+            if g is None:
+                self._buffers.append(None)
+                continue
+
+            shape = v.get_shape()
+            with tf.device(device or v.device), \
+                    tf.name_scope('grad_accumulator'):
+                acc = tf.Variable(
+                    tf.zeros(shape, dtype=v.dtype.base_dtype),
+                    trainable=False,
+                    collections=[tf.GraphKeys.LOCAL_VARIABLES],
+                    name=v.op.name.replace('/', '_'))
+                self.variables.append(acc)
+
+                if isinstance(g, tf.IndexedSlices):
+                    touched = tf.Variable(
+                        tf.zeros([shape[0]], dtype=tf.int32),
+                        trainable=False,
+                        collections=[tf.GraphKeys.LOCAL_VARIABLES],
+                        name=v.op.name.replace('/', '_') + '_touched')
+                    self.variables.append(touched)
+                    accumulate_ops.append(
+                        tf.scatter_add(acc, g.indices, g.values))
+                    accumulate_ops.append(
+                        tf.scatter_update(touched, g.indices,
+                            tf.ones_like(g.indices, dtype=tf.int32)))
+                else:
+                    touched = None
+                    accumulate_ops.append(tf.assign_add(acc, g))
+
+            self._buffers.append((acc, touched))
+
+        self.accumulate_op = tf.group(*accumulate_ops)
+        self._accumulated = None
+
+    def accumulated_gradients(self):
+        '''
+        The average gradients over the micro-batches, including the one
+        added by accumulate_op in the same run.
+        '''
+        if self._accumulated is not None:
+            return self._accumulated
+
+        self._accumulated = []
+        self._touched_rows = []
+        with tf.control_dependencies([self.accumulate_op]):
+            for (g, v), buf in zip(self._grads_and_vars, self._buffers):
+                if buf is None:
+                    self._accumulated.append((None, v))
+                    self._touched_rows.append(None)
+                    continue
+
+                acc, touched = buf
+                with tf.device(acc.device):
+                    if touched is not None:
+                        rows = tf.cast(
+                            tf.where(touched > 0)[:, 0], g.indices.dtype)
+                        values = tf.gather(acc, rows) / self.n_steps
+                        grad = tf.IndexedSlices(
+                            values, rows, dense_shape=g.dense_shape)
+                    else:
+                        rows = None
+                        grad = tf.identity(acc) / self.n_steps
+                self._accumulated.append((grad, v))
+                self._touched_rows.append(rows)
+
+        return self._accumulated
+
+    def reset_op(self):
+        '''
+        Zero the buffers.  Create it under a control dependency on the op
+        that applies the accumulated gradients.
+        '''
+        self.accumulated_gradients()
+
+        reset_ops = []
+        for (g, v), buf, rows in zip(
+                self._accumulated, self._buffers, self._touched_rows):
+            if buf is None:
+                continue
+            acc, touched = buf
+            with tf.device(acc.device):
+                if touched is not None:
+                    reset_ops.append(
+                        tf.scatter_update(acc, rows, tf.zeros_like(g.values)))
+                    reset_ops.append(
+                        tf.scatter_update(touched, rows,
+                            tf.zeros_like(rows, dtype=tf.int32)))
+                else:
+                    reset_ops.append(tf.assign(acc, tf.zeros_like(acc)))
+
+        return tf.group(*reset_ops)
+
+
+class LossScale(object):
+    '''
+    Loss scaling for training with float16 activations.
+
+    The loss is multiplied by the scale before the gradients are computed
+    so that small gradients don't underflow in float16, and the gradients
+    are divided by it again before they are clipped and applied.
+
+    If dynamic, a step where any gradient overflows is skipped (its
+    gradients are replaced by zeros, which leaves the variables and the
+    Adagrad accumulators unchanged) and the scale is divided by factor.
+    After increment_every steps without overflow the scale is multiplied
+    by factor.  The scale is a variable so it is saved in the checkpoints.
+    '''
+    def __init__(self, initial_scale=2.0 ** 15, dynamic=True,
+                 increment_every=2000, factor=2.0, min_scale=1.0):
+        self.dynamic = dynamic
+        self.increment_every = increment_every
+        self.factor = factor
+        self.min_scale = min_scale
+
+        self.scale = tf.get_variable(
+            'loss_scale', [],
+            initializer=tf.constant_initializer(initial_scale),
+            trainable=False)
+        if dynamic:
+            self.good_steps = tf.get_variable(
+                'loss_scale_good_steps', [], dtype=tf.int64,
+                initializer=tf.constant_initializer(0), trainable=False)
+
+    def scale_loss(self, loss):
+        return loss * self.scale
+
+    def unscale_gradients(self, grads):
+        '''
+        Divide the gradients by the scale.  Returns the gradients and
+        a boolean tensor that is True if they are all finite.
+        '''
+        inv_scale = 1.0 / self.scale
+        unscaled = []
+        checks = []
+        for g, v in grads:
+            if g is None:
+                unscaled.append((g, v))
+                continue
+            if isinstance(g, tf.IndexedSlices):
+                values = g.values * inv_scale
+                checks.append(tf.reduce_all(tf.is_finite(values)))
+                g = tf.IndexedSlices(values, g.indices, g.dense_shape)
+            else:
+                g = g * inv_scale
+                checks.append(tf.reduce_all(tf.is_finite(g)))
+            unscaled.append((g, v))
+        finite = tf.reduce_all(tf.stack(checks))
+
+        if not self.dynamic:
+            return unscaled, finite
+
+        # a cond rather than a multiply so inf and nan don't propagate
+        def _zero_if_overflow(x):
+            return tf.cond(finite, lambda: x, lambda: tf.zeros_like(x))
+
+        ret = []
+        for g, v in unscaled:
+            if isinstance(g, tf.IndexedSlices):
+                g = tf.IndexedSlices(
+                    _zero_if_overflow(g.values), g.indices, g.dense_shape)
+            elif g is not None:
+                g = _zero_if_overflow(g)
+            ret.append((g, v))
+        return ret, finite
+
+    def update_op(self, finite):
+        '''Adjust the scale after a step with finite (or not) gradients.'''
+        if not self.dynamic:
+            return tf.no_op()
+
+        good_steps = tf.where(
+            finite, self.good_steps + 1, tf.zeros_like(self.good_steps))
+        grow = tf.logical_and(finite, good_steps >= self.increment_every)
+        new_scale = tf.where(
+            finite,
+            tf.where(grow, self.scale * self.factor, self.scale),
+            tf.maximum(self.scale / self.factor, self.min_scale))
+        good_steps = tf.where(grow, tf.zeros_like(good_steps), good_steps)
+        return tf.group(tf.assign(self.scale, new_scale),
+                        tf.assign(self.good_steps, good_steps))
+
+
+def _get_loss_scale(options):
+    # dynamic loss scaling by default with float16, bfloat16 has the
+    # range of float32 so doesn't need it
+    compute_dtype = options.get('compute_dtype', DTYPE)
+    loss_scale = options.get(
+        'loss_scale', 'dynamic' if compute_dtype == 'float16' else None)
+    if loss_scale is None:
+        return None
+    elif loss_scale == 'dynamic':
+        return LossScale(dynamic=True)
+    else:
+        return LossScale(initial_scale=float(loss_scale), dynamic=False)
+
+
 def summary_gradient_updates(grads, opt, lr):
     '''get summary ops for the magnitude of gradient updates'''
 
@@ -874,17 +858,20 @@ def summary_gradient_updates(grads, opt, lr):
 
         if isinstance(g, tf.IndexedSlices):
             # a sparse gradient - only take norm of params that are updated
-            values = tf.gather(v, g.indices)
+            with tf.device(v.device):
+                values = tf.gather(v, g.indices)
+                if a is not None:
+                    accumulators = tf.gather(a, g.indices)
             updates = lr * g.values
             if a is not None:
-                updates /= tf.sqrt(tf.gather(a, g.indices))
+                updates /= tf.sqrt(accumulators)
         else:
             values = v
             updates = lr * g
             if a is not None:
                 updates /= tf.sqrt(a)
 
-        values_norm = tf.sqrt(tf.reduce_sum(v * v)) + 1.0e-7
+        values_norm = tf.sqrt(tf.reduce_sum(values * values)) + 1.0e-7
         updates_norm = tf.sqrt(tf.reduce_sum(updates * updates))
         ret.append(
                 tf.summary.scalar('UPDATE/' + vname.replace(":", "_"), updates_norm / values_norm))
@@ -892,6 +879,53 @@ def summary_gradient_updates(grads, opt, lr):
     return ret
 
 
+def _average_indexed_slices(tower_slices, dense_shape, n_rows,
+                            dense_threshold):
+    '''
+    Average the sparse gradients of one variable across the towers.
+
+    If the towers together touch more than dense_threshold * n_rows rows,
+    (e.g. the char embedding), each tower's gradient is scattered to a
+    dense tensor on its own device and the dense tensors averaged.
+    Otherwise (e.g. the sampled softmax) each tower's gradient is first
+    deduplicated on its own device, so the final deduplication only sees
+    the rows that are unique within each tower.
+
+    The density is estimated from the static shapes, if they are unknown
+    the sparse path is used.
+    '''
+    n_towers = len(tower_slices)
+
+    n_slices = [g.values.get_shape()[0].value for g in tower_slices]
+    if dense_threshold is not None and None not in n_slices and \
+            sum(n_slices) > dense_threshold * n_rows:
+        dense_grads = []
+        for g in tower_slices:
+            with tf.device(g.values.device):
+                dense_grads.append(tf.expand_dims(
+                    tf.unsorted_segment_sum(g.values, g.indices, n_rows), 0))
+        return tf.reduce_mean(tf.concat(dense_grads, 0), 0)
+
+    indices = []
+    values = []
+    for g in tower_slices:
+        with tf.device(g.values.device):
+            tv, ti = _deduplicate_indexed_slices(g.values, g.indices)
+        indices.append(ti)
+        values.append(tv)
+
+    if n_towers == 1:
+        av, ai = values[0], indices[0]
+    else:
+        # deduplicate across towers, only needed for the already
+        # unique rows of each tower
+        av, ai = _deduplicate_indexed_slices(
+            tf.concat(values, 0), tf.concat(indices, 0))
+    av = av / n_towers
+
+    return tf.IndexedSlices(av, ai, dense_shape=dense_shape)
+
+
 def _deduplicate_indexed_slices(values, indices):
     """Sums `values` associated with any non-unique `indices`.
     Args:
@@ -910,190 +944,374 @@ def _deduplicate_indexed_slices(values, indices):
     return (summed_values, unique_indices)
 
 
-# NOTE(feiga): add multidirectional
-# NOTE(lijun): ad more permute patten
-def _get_feed_dict_from_X(X, start, end, model, char_inputs, bidirectional, multidirectional, permute_number):
+def _get_feed_dict_from_X(X, start, end, model, char_inputs):
+    # the inputs and the targets with weights of each direction of model
     feed_dict = {}
-    if not char_inputs:
-        token_ids = X['token_ids'][start:end]
-        feed_dict[model.token_ids] = token_ids
-    else:
-        # character inputs
-        char_ids = X['tokens_characters'][start:end]
-        feed_dict[model.tokens_characters] = char_ids
-
-    if bidirectional:
+    for direction in model.directions:
+        suffix = direction.suffix
         if not char_inputs:
-            feed_dict[model.token_ids_reverse] = \
-                X['token_ids_reverse'][start:end]
+            feed_dict[getattr(model, 'token_ids' + suffix)] = \
+                X['token_ids' + suffix][start:end]
         else:
-            feed_dict[model.tokens_characters_reverse] = \
-                X['tokens_characters_reverse'][start:end]
-    # NOTE(feiga)
-    if multidirectional:
-        if not char_inputs:
-            feed_dict[model.token_ids_permuted1] = \
-                X['token_ids_permuted1'][start:end]
-            feed_dict[model.token_ids_permuted2] = \
-                X['token_ids_permuted2'][start:end]
-            if permute_number == 6:
-                feed_dict[model.token_ids_permuted3] = \
-                    X['token_ids_permuted3'][start:end]
-                feed_dict[model.token_ids_permuted4] = \
-                    X['token_ids_permuted4'][start:end]
-            elif permute_number == 8:
-                feed_dict[model.token_ids_permuted3] = \
-                    X['token_ids_permuted3'][start:end]
-                feed_dict[model.token_ids_permuted4] = \
-                    X['token_ids_permuted4'][start:end]
-                feed_dict[model.token_ids_permuted5] = \
-                    X['token_ids_permuted5'][start:end]
-                feed_dict[model.token_ids_permuted6] = \
-                    X['token_ids_permuted6'][start:end]
-        else:
-            feed_dict[model.tokens_characters_permuted1] = \
-                X['tokens_characters_permuted1'][start:end]
-            feed_dict[model.tokens_characters_permuted2] = \
-                X['tokens_characters_permuted2'][start:end]
-            if permute_number == 6:
-                feed_dict[model.tokens_characters_permuted3] = \
-                    X['tokens_characters_permuted3'][start:end]
-                feed_dict[model.tokens_characters_permuted4] = \
-                    X['tokens_characters_permuted4'][start:end]
-            elif permute_number == 8:
-                feed_dict[model.tokens_characters_permuted3] = \
-                    X['tokens_characters_permuted3'][start:end]
-                feed_dict[model.tokens_characters_permuted4] = \
-                    X['tokens_characters_permuted4'][start:end]
-                feed_dict[model.tokens_characters_permuted5] = \
-                    X['tokens_characters_permuted5'][start:end]
-                feed_dict[model.tokens_characters_permuted6] = \
-                    X['tokens_characters_permuted6'][start:end]
-    # now the targets with weights
-    next_id_placeholders = [[model.next_token_id, '']]
-    if bidirectional:
-        next_id_placeholders.append([model.next_token_id_reverse, '_reverse'])
-
-    if multidirectional:
-        next_id_placeholders.append([model.next_token_id_permuted1, '_permuted1'])
-        next_id_placeholders.append([model.next_token_id_permuted2, '_permuted2'])
-        if permute_number == 6:
-            next_id_placeholders.append([model.next_token_id_permuted3, '_permuted3'])
-            next_id_placeholders.append([model.next_token_id_permuted4, '_permuted4'])
-        elif permute_number == 8:
-            next_id_placeholders.append([model.next_token_id_permuted1, '_permuted3'])
-            next_id_placeholders.append([model.next_token_id_permuted2, '_permuted4'])
-            next_id_placeholders.append([model.next_token_id_permuted1, '_permuted5'])
-            next_id_placeholders.append([model.next_token_id_permuted2, '_permuted6'])
-
-    for id_placeholder, suffix in next_id_placeholders:
-        name = 'next_token_id' + suffix
-        feed_dict[id_placeholder] = X[name][start:end]
+            # character inputs
+            feed_dict[getattr(model, 'tokens_characters' + suffix)] = \
+                X['tokens_characters' + suffix][start:end]
+        feed_dict[getattr(model, 'next_token_id' + suffix)] = \
+            X['next_token_id' + suffix][start:end]
 
     return feed_dict
 
 
-def train(options, data, n_gpus, tf_save_dir, tf_log_dir, permute_number=4,
-          restart_ckpt_file=None):
+def make_cluster(ps_hosts, worker_hosts):
+    '''
+    Make the cluster dict for train from comma separated lists of
+    host:port for the parameter servers and the workers.
+    '''
+    return {'ps': ps_hosts.split(','), 'worker': worker_hosts.split(',')}
 
-    # not restarting so save the options
-    if restart_ckpt_file is None:
-        with open(os.path.join(tf_save_dir, 'options.json'), 'w') as fout:
-            fout.write(json.dumps(options))
 
-    with tf.device('/cpu:0'):
-        global_step = tf.get_variable(
-            'global_step', [],
-            initializer=tf.constant_initializer(0), trainable=False)
-
-        # set up the optimizer
-        lr = options.get('learning_rate', 0.2)
-        opt = tf.train.AdagradOptimizer(learning_rate=lr,
-                                        initial_accumulator_value=1.0)
-
-        # calculate the gradients on each GPU
-        tower_grads = []
-        models = []
-        train_perplexity = tf.get_variable(
-            'train_perplexity', [],
-            initializer=tf.constant_initializer(0.0), trainable=False)
-        norm_summaries = []
-        for k in range(n_gpus):
-            with tf.device('/gpu:%d' % k):
-                with tf.variable_scope('lm', reuse=k > 0):
-                    # calculate the loss for one model replica and get
-                    #   lstm states
-                    model = LanguageModel(options, True)
-                    loss = model.total_loss
-                    models.append(model)
-                    # get gradients
-                    grads = opt.compute_gradients(
-                        loss * options['unroll_steps'],
-                        aggregation_method=tf.AggregationMethod.EXPERIMENTAL_TREE,
-                    )
-                    tower_grads.append(grads)
-                    # keep track of loss across all GPUs
-                    train_perplexity += loss
-
-        print_variable_summary()
-
-        # calculate the mean of each gradient across all GPUs
-        grads = average_gradients(tower_grads, options['batch_size'], options)
-        grads, norm_summary_ops = clip_grads(grads, options, True, global_step)
-        norm_summaries.extend(norm_summary_ops)
-
-        # log the training perplexity
-        train_perplexity = tf.exp(train_perplexity / n_gpus)
-        perplexity_summmary = tf.summary.scalar(
-            'train_perplexity', train_perplexity)
-
-        # some histogram summaries.  all models use the same parameters
-        # so only need to summarize one
-        histogram_summaries = [
-            tf.summary.histogram('token_embedding', models[0].embedding)
-        ]
-        # tensors of the output from the LSTM layer
-        lstm_out = tf.get_collection('lstm_output_embeddings')
+def run_parameter_server(cluster, task_index):
+    '''
+    Start parameter server task_index of the cluster and serve forever.
+    '''
+    server = tf.train.Server(tf.train.ClusterSpec(cluster), job_name='ps',
+                             task_index=task_index)
+    server.join()
+
+
+def _wait_for_variables(sess, report_uninitialized_op):
+    # wait for the chief worker to initialize or restore the variables
+    while len(sess.run(report_uninitialized_op)) > 0:
+        print("Waiting for the chief worker to initialize the variables")
+        time.sleep(1.0)
+
+
+def _build_train_graph(options, n_gpus, permute_number, partitioner,
+                       local_device):
+    # build the towers, gradients and summaries for train, returns the
+    # models and a dict of the tensors and ops the training loop runs
+    endpoints = {}
+    global_step = tf.get_variable(
+        'global_step', [],
+        initializer=tf.constant_initializer(0), trainable=False)
+
+    # set up the optimizer
+    lr = options.get('learning_rate', 0.2)
+    opt = tf.train.AdagradOptimizer(learning_rate=lr,
+                                    initial_accumulator_value=1.0)
+
+    loss_scale = _get_loss_scale(options)
+
+    # calculate the gradients on each GPU
+    tower_grads = []
+    models = []
+    train_perplexity = tf.get_variable(
+        'train_perplexity', [],
+        initializer=tf.constant_initializer(0.0), trainable=False)
+    norm_summaries = []
+    for k in range(n_gpus):
+        with tf.device('/gpu:%d' % k):
+            with tf.variable_scope('lm', reuse=k > 0):
+                # calculate the loss for one model replica and get
+                #   lstm states
+                model = LanguageModel(options, True,
+                                      partitioner=partitioner)
+                loss = model.total_loss
+                models.append(model)
+                # get gradients
+                scaled_loss = loss * options['unroll_steps']
+                if loss_scale is not None:
+                    scaled_loss = loss_scale.scale_loss(scaled_loss)
+                grads = opt.compute_gradients(
+                    scaled_loss,
+                    aggregation_method=tf.AggregationMethod.EXPERIMENTAL_TREE,
+                )
+                tower_grads.append(grads)
+                # keep track of loss across all GPUs
+                train_perplexity += loss
+
+    print_variable_summary()
+
+    # calculate the mean of each gradient across all GPUs
+    grads = average_gradients(tower_grads, options['batch_size'], options)
+
+    # optionally average the gradients over several micro-batches
+    # before applying them
+    grad_accum_steps = options.get('grad_accum_steps', 1)
+    if grad_accum_steps > 1:
+        accumulator = GradientAccumulator(grads, grad_accum_steps,
+                                          device=local_device)
+        endpoints['accumulate_op'] = accumulator.accumulate_op
+        grads = accumulator.accumulated_gradients()
+
+    if loss_scale is not None:
+        grads, grads_finite = loss_scale.unscale_gradients(grads)
+        norm_summaries.append(
+            tf.summary.scalar('loss_scale', loss_scale.scale))
+
+    grads, norm_summary_ops = clip_grads(grads, options, True, global_step)
+    norm_summaries.extend(norm_summary_ops)
+
+    # log the training perplexity
+    train_perplexity = tf.exp(train_perplexity / n_gpus)
+    perplexity_summmary = tf.summary.scalar(
+        'train_perplexity', train_perplexity)
+
+    # some histogram summaries.  all models use the same parameters
+    # so only need to summarize one
+    histogram_summaries = [
+        tf.summary.histogram('token_embedding',
+                             tf.cast(models[0].embedding, DTYPE))
+    ]
+    # tensors of the output from the LSTM layer
+    lstm_out = tf.get_collection('lstm_output_embeddings')
+    histogram_summaries.append(
+            tf.summary.histogram('lstm_embedding_0',
+                                 tf.cast(lstm_out[0], DTYPE)))
+    if options.get('bidirectional', False):
+        # also have the backward embedding
         histogram_summaries.append(
-                tf.summary.histogram('lstm_embedding_0', lstm_out[0]))
-        if options.get('bidirectional', False):
-            # also have the backward embedding
-            histogram_summaries.append(
-                tf.summary.histogram('lstm_embedding_1', lstm_out[1]))
+            tf.summary.histogram('lstm_embedding_1',
+                                 tf.cast(lstm_out[1], DTYPE)))
+
+    # apply the gradients to create the training operation
+    train_op = opt.apply_gradients(grads, global_step=global_step)
+    if grad_accum_steps > 1:
+        with tf.control_dependencies([train_op]):
+            train_op = accumulator.reset_op()
+    if loss_scale is not None:
+        with tf.control_dependencies([train_op]):
+            train_op = loss_scale.update_op(grads_finite)
+
+    # histograms of variables, computed on a background thread since
+    # they don't depend on the batch.  Large matrices are row sampled.
+    variable_histogram_summaries = variable_histograms(
+        tf.global_variables(),
+        allow=options.get('histogram_variables'),
+        max_rows=options.get('histogram_max_rows', 2048))
+    if variable_histogram_summaries:
+        variable_hist_summary_op = tf.summary.merge(
+            variable_histogram_summaries)
+    else:
+        variable_hist_summary_op = None
+
+    # get the gradient updates -- these aren't histograms, but we'll
+    # only update them when histograms are computed
+    histogram_summaries.extend(
+        summary_gradient_updates(grads, opt, lr))
+
+    summary_op = tf.summary.merge(
+        [perplexity_summmary] + norm_summaries
+    )
+    hist_summary_op = tf.summary.merge(histogram_summaries)
 
-        # apply the gradients to create the training operation
-        train_op = opt.apply_gradients(grads, global_step=global_step)
+    endpoints.update({
+        'global_step': global_step,
+        'train_perplexity': train_perplexity,
+        'train_op': train_op,
+        'summary_op': summary_op,
+        'hist_summary_op': hist_summary_op,
+        'variable_hist_summary_op': variable_hist_summary_op,
+    })
+    return models, endpoints
 
-        # histograms of variables
-        for v in tf.global_variables():
-            histogram_summaries.append(tf.summary.histogram(v.name.replace(":", "_"), v))
 
-        # get the gradient updates -- these aren't histograms, but we'll
-        # only update them when histograms are computed
-        histogram_summaries.extend(
-            summary_gradient_updates(grads, opt, lr))
+# the model attributes the training loop feeds or fetches
+_TOWER_INPUT_PREFIXES = ('token_ids', 'tokens_characters', 'next_token_id')
+_TOWER_STATE_ATTRIBUTES = ('init_lstm_state', 'final_lstm_state')
 
+
+class _ImportedTower(object):
+    '''
+    Stands in for a LanguageModel in the training loop when the graph
+    was imported from a MetaGraph, with the input placeholders and the
+    flattened lstm states looked up from the graph collections.
+    '''
+    def __init__(self, k, directions):
+        self.directions = directions
+        prefix = 'train_graph/tower_%d/' % k
+        for key in tf.get_default_graph().get_all_collection_keys():
+            if key.startswith(prefix):
+                name = key[len(prefix):]
+                value = tf.get_collection(key)
+                if name not in _TOWER_STATE_ATTRIBUTES:
+                    value = value[0]
+                setattr(self, name, value)
+
+
+# the options read when building the training graph, the others (e.g.
+# n_epochs, n_train_tokens or save_every_batches) only change the loop
+_TRAIN_GRAPH_OPTIONS = (
+    'bidirectional', 'multidirectional', 'permute_number', 'directions',
+    'n_tokens_vocab', 'batch_size', 'unroll_steps', 'lstm', 'char_cnn',
+    'dropout', 'share_embedding_softmax', 'sample_softmax',
+    'n_negative_samples_batch', 'compute_dtype', 'loss_scale',
+    'learning_rate', 'all_clip_norm_val', 'grad_accum_steps',
+    'sparse_grad_dense_threshold', 'histogram_variables',
+    'histogram_max_rows',
+)
+
+
+def _train_graph_key(options, n_gpus, permute_number, cluster, task_index):
+    # the graph only depends on these, and the tensorflow version
+    graph_options = {k: v for k, v in options.items()
+                     if k in _TRAIN_GRAPH_OPTIONS}
+    key = json.dumps([graph_options, n_gpus, permute_number, cluster,
+                      task_index, tf.__version__], sort_keys=True)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+
+def _export_train_graph(graph_file, models, endpoints):
+    # record the tensors train needs in collections so they can be found
+    # after importing the MetaGraph, then write it
+    for k, model in enumerate(models):
+        prefix = 'train_graph/tower_%d/' % k
+        for name, value in vars(model).items():
+            if name.startswith(_TOWER_INPUT_PREFIXES) and \
+                    isinstance(value, tf.Tensor):
+                tf.add_to_collection(prefix + name, value)
+        for name in _TOWER_STATE_ATTRIBUTES:
+            for t in nest.flatten(getattr(model, name)):
+                tf.add_to_collection(prefix + name, t)
+    for name, value in endpoints.items():
+        if value is not None:
+            tf.add_to_collection('train_graph/' + name, value)
+
+    # write to a temporary file first, a partially written graph would
+    # fail the next restart
+    tmp_file = graph_file + '.tmp'
+    tf.train.export_meta_graph(filename=tmp_file)
+    os.rename(tmp_file, graph_file)
+
+
+def _import_train_endpoints(n_gpus, directions):
+    models = [_ImportedTower(k, directions) for k in range(n_gpus)]
+    endpoints = {}
+    for key in tf.get_default_graph().get_all_collection_keys():
+        if key.startswith('train_graph/') and \
+                not key.startswith('train_graph/tower_'):
+            endpoints[key[len('train_graph/'):]] = tf.get_collection(key)[0]
+    return models, endpoints
+
+
+def train(options, data, n_gpus, tf_save_dir, tf_log_dir, permute_number=4,
+          restart_ckpt_file=None, cluster=None, task_index=0):
+    '''
+    Train a language model with the given options on data, with in-graph
+    replication across n_gpus GPUs.
+
+    For data parallel training across hosts, pass cluster, a dict with
+    the host:port lists of the 'ps' and 'worker' jobs (see make_cluster),
+    and the task_index of this worker.  Every worker runs train with its own
+    share of the data, the variables live on the parameter servers
+    (run_parameter_server) with the softmax and token embeddings sharded
+    across them, and the gradients are applied asynchronously.  Worker 0 is
+    the chief: it initializes or restores the variables and writes the
+    checkpoints and summaries.
+    '''
+    if cluster is not None:
+        cluster_spec = tf.train.ClusterSpec(cluster)
+        n_workers = cluster_spec.num_tasks('worker')
+        n_ps = cluster_spec.num_tasks('ps')
+        server = tf.train.Server(cluster_spec, job_name='worker',
+                                 task_index=task_index)
+        target = server.target
+        worker_device = '/job:worker/task:%d' % task_index
+        device_setter = tf.train.replica_device_setter(
+            worker_device=worker_device, cluster=cluster_spec)
+        # the per worker variables (e.g. gradient accumulators) must not be
+        # shared through the parameter servers
+        local_device = worker_device + '/cpu:0'
+        if n_ps > 1:
+            partitioner = tf.fixed_size_partitioner(n_ps)
+        else:
+            partitioner = None
+    else:
+        n_workers = 1
+        target = ''
+        device_setter = None
+        local_device = None
+        partitioner = None
+    is_chief = task_index == 0
+
+    # record the directions in the options, so the model, the feed dicts
+    # and the saved options all agree on them
+    if options.get('directions') is None:
+        options = dict(options, directions=[
+            d.name for d in get_directions(options, permute_number)])
+
+    # not restarting so save the options
+    if restart_ckpt_file is None and is_chief:
+        with open(os.path.join(tf_save_dir, 'options.json'), 'w') as fout:
+            fout.write(json.dumps(options))
+
+    # Building the multi tower graph in python is slow for many
+    # directions, so it is saved as a MetaGraph the first time and
+    # imported again when restarting with the same options.
+    graph_file = os.path.join(tf_save_dir, 'train_graph-%s.meta' % (
+        _train_graph_key(options, n_gpus, permute_number, cluster,
+                         task_index), ))
+    if restart_ckpt_file is not None and os.path.exists(graph_file):
+        print("Importing the training graph from %s" % graph_file)
+        tf.train.import_meta_graph(graph_file)
+        models, endpoints = _import_train_endpoints(
+            n_gpus, get_directions(options))
+    else:
+        with tf.device(device_setter), tf.device('/cpu:0'):
+            models, endpoints = _build_train_graph(
+                options, n_gpus, permute_number, partitioner, local_device)
+        _export_train_graph(graph_file, models, endpoints)
+
+    global_step = endpoints['global_step']
+    train_perplexity = endpoints['train_perplexity']
+    train_op = endpoints['train_op']
+    summary_op = endpoints['summary_op']
+    hist_summary_op = endpoints['hist_summary_op']
+    variable_hist_summary_op = endpoints.get('variable_hist_summary_op')
+    grad_accum_steps = options.get('grad_accum_steps', 1)
+    if grad_accum_steps > 1:
+        accumulate_op = endpoints['accumulate_op']
+
+    with tf.device(device_setter), tf.device('/cpu:0'):
         saver = tf.train.Saver(tf.global_variables(), max_to_keep=2)
-        summary_op = tf.summary.merge(
-            [perplexity_summmary] + norm_summaries
-        )
-        hist_summary_op = tf.summary.merge(histogram_summaries)
+        if is_chief and options.get('async_checkpoint', False):
+            # write the checkpoints from a snapshot on a background thread
+            async_saver = AsyncCheckpointSaver(
+                tf.global_variables(), max_to_keep=2,
+                max_in_flight=options.get('max_in_flight_checkpoints', 1))
+        else:
+            async_saver = None
 
         init = tf.initialize_all_variables()
+        local_init = tf.local_variables_initializer()
+        report_uninitialized_op = tf.report_uninitialized_variables(
+            tf.global_variables())
 
     # do the training loop
-    bidirectional = options.get('bidirectional', False)
-    multidirectional = options.get('multidirectional', False)
-    with tf.Session(config=tf.ConfigProto(
+    directions = get_directions(options)
+    with tf.Session(target, config=tf.ConfigProto(
             allow_soft_placement=True)) as sess:
-        sess.run(init)
-
-        # load the checkpoint data if needed
-        if restart_ckpt_file is not None:
+        if not is_chief:
+            _wait_for_variables(sess, report_uninitialized_op)
+        elif restart_ckpt_file is not None:
+            # load the checkpoint data, all the variables are restored
+            # so other workers never see the initial values
             loader = tf.train.Saver()
             loader.restore(sess, restart_ckpt_file)
-            
-        summary_writer = tf.summary.FileWriter(tf_log_dir, sess.graph)
+        else:
+            sess.run(init)
+        sess.run(local_init)
+
+        if is_chief:
+            summary_writer = tf.summary.FileWriter(tf_log_dir, sess.graph)
+        if is_chief and variable_hist_summary_op is not None:
+            variable_hist_runner = AsyncSummaryRunner(
+                sess, variable_hist_summary_op, summary_writer)
+        else:
+            variable_hist_runner = None
+
+        if async_saver is not None:
+            async_saver.start(sess, tf_save_dir)
 
         # For each batch:
         # Get a batch of data from the generator. The generator will
@@ -1107,176 +1325,109 @@ def train(options, data, n_gpus, tf_save_dir, tf_log_dir, permute_number=4,
         batch_size = options['batch_size']
         unroll_steps = options['unroll_steps']
         n_train_tokens = options.get('n_train_tokens', 768648884)
-        n_tokens_per_batch = batch_size * unroll_steps * n_gpus
+        n_tokens_per_batch = batch_size * unroll_steps * n_gpus * n_workers
         n_batches_per_epoch = int(n_train_tokens / n_tokens_per_batch)
         n_batches_total = options['n_epochs'] * n_batches_per_epoch
+        # with gradient accumulation, round up to a whole number of
+        # optimizer steps so that the last batches are applied
+        n_batches_total = -(-n_batches_total // grad_accum_steps) * \
+            grad_accum_steps
         print("Training for %s epochs and %s batches" % (
             options['n_epochs'], n_batches_total))
 
+        # checkpoints are saved every save_every_batches batches and,
+        # if given, every save_every_secs seconds
+        save_every_batches = options.get('save_every_batches', 1250)
+        save_every_secs = options.get('save_every_secs')
+        checkpoint_path = os.path.join(tf_save_dir, 'model.ckpt')
+
         # get the initial lstm states
         init_state_tensors = []
         final_state_tensors = []
         for model in models:
-            init_state_tensors.extend(model.init_lstm_state)
-            final_state_tensors.extend(model.final_lstm_state)
+            init_state_tensors.extend(nest.flatten(model.init_lstm_state))
+            final_state_tensors.extend(nest.flatten(model.final_lstm_state))
 
         char_inputs = 'char_cnn' in options
         if char_inputs:
             max_chars = options['char_cnn']['max_characters_per_token']
 
-        if not char_inputs:
-            feed_dict = {
-                model.token_ids:
-                    np.zeros([batch_size, unroll_steps], dtype=np.int64)
-                for model in models
-            }
-        else:
-            feed_dict = {
-                model.tokens_characters:
-                    np.zeros([batch_size, unroll_steps, max_chars],
-                             dtype=np.int32)
-                for model in models
-            }
-
-        if bidirectional:
-            if not char_inputs:
-                feed_dict.update({
-                    model.token_ids_reverse:
-                        np.zeros([batch_size, unroll_steps], dtype=np.int64)
-                    for model in models
-                })
-            else:
-                feed_dict.update({
-                    model.tokens_characters_reverse:
-                        np.zeros([batch_size, unroll_steps, max_chars],
-                                 dtype=np.int32)
-                    for model in models
-                })
-        if multidirectional:
-            if not char_inputs:
-                feed_dict.update({
-                    model.token_ids_permuted1:
-                        np.zeros([batch_size, unroll_steps], dtype=np.int64)
-                    for model in models
-                })
-                feed_dict.update({
-                    model.token_ids_permuted2:
+        # zero inputs for every direction to get the initial states
+        feed_dict = {}
+        for model in models:
+            for direction in directions:
+                if not char_inputs:
+                    feed_dict[getattr(model, 'token_ids' + direction.suffix)] = \
                         np.zeros([batch_size, unroll_steps], dtype=np.int64)
-                    for model in models
-                })
-                if permute_number == 6:
-                    feed_dict.update({
-                        model.token_ids_permuted3:
-                            np.zeros([batch_size, unroll_steps], dtype=np.int64)
-                        for model in models
-                    })
-                    feed_dict.update({
-                        model.token_ids_permuted4:
-                            np.zeros([batch_size, unroll_steps], dtype=np.int64)
-                        for model in models
-                    })
-                elif permute_number == 8:
-                    feed_dict.update({
-                        model.token_ids_permuted3:
-                            np.zeros([batch_size, unroll_steps], dtype=np.int64)
-                        for model in models
-                    })
-                    feed_dict.update({
-                        model.token_ids_permuted4:
-                            np.zeros([batch_size, unroll_steps], dtype=np.int64)
-                        for model in models
-                    })
-                    feed_dict.update({
-                        model.token_ids_permuted5:
-                            np.zeros([batch_size, unroll_steps], dtype=np.int64)
-                        for model in models
-                    })
-                    feed_dict.update({
-                        model.token_ids_permuted6:
-                            np.zeros([batch_size, unroll_steps], dtype=np.int64)
-                        for model in models
-                    })
-            else:
-                feed_dict.update({
-                    model.tokens_characters_permuted1:
-                        np.zeros([batch_size, unroll_steps, max_chars],
-                                 dtype=np.int32)
-                    for model in models
-                })
-                feed_dict.update({
-                    model.tokens_characters_permuted2:
+                else:
+                    feed_dict[getattr(
+                        model, 'tokens_characters' + direction.suffix)] = \
                         np.zeros([batch_size, unroll_steps, max_chars],
                                  dtype=np.int32)
-                    for model in models
-                })
-                if permute_number == 6:
-                    feed_dict.update({
-                        model.tokens_characters_permuted3:
-                            np.zeros([batch_size, unroll_steps, max_chars],
-                                     dtype=np.int32)
-                        for model in models
-                    })
-                    feed_dict.update({
-                        model.tokens_characters_permuted4:
-                            np.zeros([batch_size, unroll_steps, max_chars],
-                                     dtype=np.int32)
-                        for model in models
-                    })
-                elif permute_number == 8:
-                    feed_dict.update({
-                        model.tokens_characters_permuted3:
-                            np.zeros([batch_size, unroll_steps, max_chars],
-                                     dtype=np.int32)
-                        for model in models
-                    })
-                    feed_dict.update({
-                        model.tokens_characters_permuted4:
-                            np.zeros([batch_size, unroll_steps, max_chars],
-                                     dtype=np.int32)
-                        for model in models
-                    })
-                    feed_dict.update({
-                        model.tokens_characters_permuted5:
-                            np.zeros([batch_size, unroll_steps, max_chars],
-                                     dtype=np.int32)
-                        for model in models
-                    })
-                    feed_dict.update({
-                        model.tokens_characters_permuted6:
-                            np.zeros([batch_size, unroll_steps, max_chars],
-                                     dtype=np.int32)
-                        for model in models
-                    })
 
         init_state_values = sess.run(init_state_tensors, feed_dict=feed_dict)
 
+        # time spent on the data, feed dict, session and checkpoints
+        # for each step, written every log_step_stats_every batches
+        if is_chief:
+            step_stats_file = os.path.join(tf_log_dir, 'step_stats.jsonl')
+        else:
+            step_stats_file = os.path.join(
+                tf_log_dir, 'step_stats_worker%d.jsonl' % task_index)
+        monitor = StepMonitor(
+            step_stats_file, [d.name for d in directions],
+            batch_size * unroll_steps * n_gpus,
+            summary_writer=summary_writer if is_chief else None,
+            log_every=options.get('log_step_stats_every', 100),
+            trace_every=options.get('trace_every_batches'))
+
         t1 = time.time()
+        last_save_time = t1
+        save_pending = False
         data_gen = data.iter_batches(batch_size * n_gpus, unroll_steps)
-        for batch_no, batch in enumerate(data_gen, start=1):
+        for batch_no, batch in enumerate(monitor.timed(data_gen), start=1):
 
             # slice the input in the batch for the feed_dict
             X = batch
-            feed_dict = {t: v for t, v in zip(
+            with monitor.time('feed_dict'):
+                feed_dict = {t: v for t, v in zip(
                                         init_state_tensors, init_state_values)}
-            for k in range(n_gpus):
-                model = models[k]
-                start = k * batch_size
-                end = (k + 1) * batch_size
-
-                feed_dict.update(
-                    _get_feed_dict_from_X(X, start, end, model,
-                                          char_inputs, bidirectional, multidirectional, permute_number)
-                )
+                for k in range(n_gpus):
+                    model = models[k]
+                    start = k * batch_size
+                    end = (k + 1) * batch_size
+
+                    feed_dict.update(
+                        _get_feed_dict_from_X(X, start, end, model,
+                                              char_inputs)
+                    )
+
+            # With gradient accumulation, the optimizer only takes a step
+            # every grad_accum_steps batches.  The LSTM states are carried
+            # across all batches as usual.
+            apply_step = batch_no % grad_accum_steps == 0
+            step_no = batch_no // grad_accum_steps
 
             # This runs the train_op, summaries and the "final_state_tensors"
             #   which just returns the tensors, passing in the initial
             #   state tensors, token ids and next token ids
-            if batch_no % 1250 != 0:
-                ret = sess.run(
-                    [train_op, summary_op, train_perplexity] +
+            run_kwargs = monitor.run_kwargs(batch_no)
+            if not apply_step:
+                # only add the gradients of this batch to the accumulators
+                with monitor.time('session_run'):
+                    ret = sess.run(
+                        [accumulate_op, train_perplexity] + final_state_tensors,
+                        feed_dict=feed_dict, **run_kwargs
+                    )
+                init_state_values = ret[2:]
+
+            elif step_no % 1250 != 0:
+                with monitor.time('session_run'):
+                    ret = sess.run(
+                        [train_op, summary_op, train_perplexity] +
                                                 final_state_tensors,
-                    feed_dict=feed_dict
-                )
+                        feed_dict=feed_dict, **run_kwargs
+                    )
 
                 # first three entries of ret are:
                 #  train_op, summary_op, train_perplexity
@@ -1287,31 +1438,58 @@ def train(options, data, n_gpus, tf_save_dir, tf_log_dir, permute_number=4,
 
             else:
                 # also run the histogram summaries
-                ret = sess.run(
-                    [train_op, summary_op, train_perplexity, hist_summary_op] + 
+                with monitor.time('session_run'):
+                    ret = sess.run(
+                        [train_op, summary_op, train_perplexity, hist_summary_op] + 
                                                 final_state_tensors,
-                    feed_dict=feed_dict
-                )
+                        feed_dict=feed_dict, **run_kwargs
+                    )
                 init_state_values = ret[4:]
                 
 
-            if batch_no % 1250 == 0:
+            if is_chief and apply_step and step_no % 1250 == 0:
                 summary_writer.add_summary(ret[3], batch_no)
-            if batch_no % 100 == 0:
+                if variable_hist_runner is not None:
+                    variable_hist_runner.run(batch_no)
+            if apply_step and step_no % 100 == 0:
                 # write the summaries to tensorboard and display perplexity
-                summary_writer.add_summary(ret[1], batch_no)
+                if is_chief:
+                    summary_writer.add_summary(ret[1], batch_no)
                 print("Batch %s, train_perplexity=%s" % (batch_no, ret[2]))
                 print("Total time: %s" % (time.time() - t1))
 
-            if (batch_no % 1250 == 0) or (batch_no == n_batches_total):
-                # save the model
-                checkpoint_path = os.path.join(tf_save_dir, 'model.ckpt')
-                saver.save(sess, checkpoint_path, global_step=global_step)
+            if is_chief and (
+                    (batch_no % save_every_batches == 0) or
+                    (batch_no == n_batches_total) or
+                    (save_every_secs is not None and
+                     time.time() - last_save_time >= save_every_secs)):
+                save_pending = True
+            if save_pending and apply_step:
+                # save the model.  The accumulated gradients are not in the
+                # checkpoint, so only save once they have been applied
+                save_pending = False
+                with monitor.time('checkpoint'):
+                    if async_saver is not None:
+                        async_saver.save(sess, checkpoint_path,
+                                         global_step=global_step)
+                    else:
+                        saver.save(sess, checkpoint_path,
+                                   global_step=global_step)
+                last_save_time = time.time()
+
+            monitor.end_step(batch_no)
 
             if batch_no == n_batches_total:
                 # done training!
                 break
 
+        monitor.close()
+        if variable_hist_runner is not None:
+            variable_hist_runner.close()
+        if async_saver is not None:
+            # wait for the last checkpoints before closing the session
+            async_saver.close()
+
 
 def clip_by_global_norm_summary(t_list, clip_norm, norm_name, variables):
     # wrapper around tf.clip_by_global_norm that also does summary ops of norms
@@ -1374,8 +1552,6 @@ def test(options, ckpt_file, data, batch_size=256, permute_number=4):
     Get the test set perplexity!
     '''
 
-    bidirectional = options.get('bidirectional', False)
-    multidirectional = options.get('multidirectional', False)
     char_inputs = 'char_cnn' in options
     if char_inputs:
         max_chars = options['char_cnn']['max_characters_per_token']
@@ -1390,6 +1566,9 @@ def test(options, ckpt_file, data, batch_size=256, permute_number=4):
             # batch is bounded above batch_size * unroll_steps
             test_options['batch_size'] = batch_size
             test_options['unroll_steps'] = 1
+            if test_options.get('directions') is None:
+                test_options['directions'] = [
+                    d.name for d in get_directions(options, permute_number)]
             model = LanguageModel(test_options, False)
             # we use the "Saver" class to load the variables
             loader = tf.train.Saver()
@@ -1399,106 +1578,16 @@ def test(options, ckpt_file, data, batch_size=256, permute_number=4):
         # perplexity is exp(loss)
         init_state_tensors = model.init_lstm_state
         final_state_tensors = model.final_lstm_state
-        if not char_inputs:
-            feed_dict = {
-                model.token_ids:
-                        np.zeros([batch_size, unroll_steps], dtype=np.int64)
-            }
-            if bidirectional:
-                feed_dict.update({
-                    model.token_ids_reverse:
-                        np.zeros([batch_size, unroll_steps], dtype=np.int64)
-                })
-            if multidirectional:
-                feed_dict.update({
-                    model.token_ids_permuted1:
-                        np.zeros([batch_size, unroll_steps], dtype=np.int64)
-                })
-                feed_dict.update({
-                    model.token_ids_permuted2:
-                        np.zeros([batch_size, unroll_steps], dtype=np.int64)
-                })
-                if permute_number == 6:
-                    feed_dict.update({
-                        model.token_ids_permuted3:
-                            np.zeros([batch_size, unroll_steps], dtype=np.int64)
-                    })
-                    feed_dict.update({
-                        model.token_ids_permuted4:
-                            np.zeros([batch_size, unroll_steps], dtype=np.int64)
-                    })
-                elif permute_number == 8:
-                    feed_dict.update({
-                        model.token_ids_permuted3:
-                            np.zeros([batch_size, unroll_steps], dtype=np.int64)
-                    })
-                    feed_dict.update({
-                        model.token_ids_permuted4:
-                            np.zeros([batch_size, unroll_steps], dtype=np.int64)
-                    })
-                    feed_dict.update({
-                        model.token_ids_permuted5:
-                            np.zeros([batch_size, unroll_steps], dtype=np.int64)
-                    })
-                    feed_dict.update({
-                        model.token_ids_permuted6:
-                            np.zeros([batch_size, unroll_steps], dtype=np.int64)
-                    })
-        else:
-            feed_dict = {
-                model.tokens_characters:
-                   np.zeros([batch_size, unroll_steps, max_chars],
-                                 dtype=np.int32)
-            }
-            if bidirectional:
-                feed_dict.update({
-                    model.tokens_characters_reverse:
-                        np.zeros([batch_size, unroll_steps, max_chars],
-                            dtype=np.int32)
-                })
-            if multidirectional:
-                feed_dict.update({
-                    model.tokens_characters_permuted1:
-                        np.zeros([batch_size, unroll_steps, max_chars],
-                            dtype=np.int32)
-                })
-                feed_dict.update({
-                    model.tokens_characters_permuted2:
-                        np.zeros([batch_size, unroll_steps, max_chars],
-                            dtype=np.int32)
-                })
-                if permute_number == 6:
-                    feed_dict.update({
-                        model.tokens_characters_permuted3:
-                            np.zeros([batch_size, unroll_steps, max_chars],
-                                     dtype=np.int32)
-                    })
-                    feed_dict.update({
-                        model.tokens_characters_permuted4:
-                            np.zeros([batch_size, unroll_steps, max_chars],
-                                     dtype=np.int32)
-                    })
-                elif permute_number == 8:
-                    feed_dict.update({
-                        model.tokens_characters_permuted3:
-                            np.zeros([batch_size, unroll_steps, max_chars],
-                                     dtype=np.int32)
-                    })
-                    feed_dict.update({
-                        model.tokens_characters_permuted4:
-                            np.zeros([batch_size, unroll_steps, max_chars],
-                                     dtype=np.int32)
-                    })
-                    feed_dict.update({
-                        model.tokens_characters_permuted5:
-                            np.zeros([batch_size, unroll_steps, max_chars],
-                                     dtype=np.int32)
-                    })
-                    feed_dict.update({
-                        model.tokens_characters_permuted6:
-                            np.zeros([batch_size, unroll_steps, max_chars],
-                                     dtype=np.int32)
-                    })
+        feed_dict = {}
+        for direction in model.directions:
+            if not char_inputs:
+                feed_dict[getattr(model, 'token_ids' + direction.suffix)] = \
+                    np.zeros([batch_size, unroll_steps], dtype=np.int64)
+            else:
+                feed_dict[getattr(
+                    model, 'tokens_characters' + direction.suffix)] = \
+                    np.zeros([batch_size, unroll_steps, max_chars],
+                             dtype=np.int32)
 
         init_state_values = sess.run(
             init_state_tensors,
@@ -1516,8 +1605,8 @@ def test(options, ckpt_file, data, batch_size=256, permute_number=4):
                                         init_state_tensors, init_state_values)}
 
             feed_dict.update(
-                _get_feed_dict_from_X(X, 0, X['token_ids'].shape[0], model, 
-                                          char_inputs, bidirectional, multidirectional, permute_number)
+                _get_feed_dict_from_X(X, 0, X['token_ids'].shape[0], model,
+                                      char_inputs)
             )
 
             ret = sess.run(
@@ -0,0 +1,101 @@
+
+import argparse
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from bilm.training import average_gradients, _deduplicate_indexed_slices
+
+
+def _concat_average(tower_slices):
+    # the previous aggregation: concat every tower then deduplicate once
+    indices = tf.concat([g.indices for g in tower_slices], 0)
+    values = tf.concat([g.values for g in tower_slices], 0) / len(tower_slices)
+    av, ai = _deduplicate_indexed_slices(values, indices)
+    return tf.IndexedSlices(av, ai, dense_shape=tower_slices[0].dense_shape)
+
+
+def _sampled_rows(args):
+    # label rows follow a Zipfian distribution like real text, the
+    # negative samples come from the log uniform sampler used by
+    # sampled_softmax_loss, repeated for each direction
+    n_labels = args.batch_size * args.unroll_steps
+    rows = []
+    for _ in range(args.n_directions):
+        labels = np.minimum(np.random.zipf(1.1, n_labels) - 1,
+                            args.n_vocab - 1)
+        samples = np.exp(np.random.rand(args.n_negative_samples) *
+                         np.log(args.n_vocab + 1)).astype(np.int64) - 1
+        rows.append(np.concatenate([labels, samples]))
+    return np.concatenate(rows).astype(np.int64)
+
+
+def main(args):
+    n_rows_per_tower = args.n_directions * (
+        args.batch_size * args.unroll_steps + args.n_negative_samples)
+    print("vocab=%s dim=%s towers=%s rows per tower=%s" % (
+        args.n_vocab, args.dim, args.n_towers, n_rows_per_tower))
+
+    with tf.device('/cpu:0'):
+        softmax_W = tf.get_variable(
+            'W', [args.n_vocab, args.dim], dtype=tf.float32,
+            initializer=tf.zeros_initializer())
+
+    indices = []
+    tower_grads = []
+    for k in range(args.n_towers):
+        with tf.device('/gpu:%d' % k):
+            ids = tf.placeholder(tf.int64, (n_rows_per_tower, ))
+            values = tf.random_normal((n_rows_per_tower, args.dim))
+            indices.append(ids)
+            tower_grads.append(
+                [(tf.IndexedSlices(values, ids, dense_shape=softmax_W.shape),
+                  softmax_W)])
+
+    with tf.device('/cpu:0'):
+        concat_grad = _concat_average([g[0][0] for g in tower_grads])
+        per_tower_grad = average_gradients(
+            tower_grads, args.batch_size,
+            {'sparse_grad_dense_threshold': None})[0][0]
+        dense_grad = average_gradients(
+            tower_grads, args.batch_size,
+            {'sparse_grad_dense_threshold': 0.0})[0][0]
+
+    benchmarks = [
+        ('concat then deduplicate', [concat_grad.values, concat_grad.indices]),
+        ('deduplicate per tower', [per_tower_grad.values,
+                                   per_tower_grad.indices]),
+        ('dense', [dense_grad]),
+    ]
+
+    config = tf.ConfigProto(allow_soft_placement=True)
+    with tf.Session(config=config) as sess:
+        sess.run(tf.global_variables_initializer())
+        for name, op in benchmarks:
+            times = []
+            for i in range(args.n_warmup + args.n_iterations):
+                feed_dict = {ids: _sampled_rows(args) for ids in indices}
+                t1 = time.time()
+                sess.run(op, feed_dict=feed_dict)
+                if i >= args.n_warmup:
+                    times.append(time.time() - t1)
+            print("%s: %.1f ms (+/- %.1f)" % (
+                name, 1000 * np.mean(times), 1000 * np.std(times)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark averaging the softmax gradient across towers')
+    parser.add_argument('--n_vocab', type=int, default=793471)
+    parser.add_argument('--dim', type=int, default=512)
+    parser.add_argument('--n_towers', type=int, default=4)
+    parser.add_argument('--n_directions', type=int, default=2)
+    parser.add_argument('--batch_size', type=int, default=128)
+    parser.add_argument('--unroll_steps', type=int, default=20)
+    parser.add_argument('--n_negative_samples', type=int, default=8192)
+    parser.add_argument('--n_warmup', type=int, default=2)
+    parser.add_argument('--n_iterations', type=int, default=10)
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,30 @@
+
+import argparse
+
+from bilm.evaluation import watch_checkpoints
+
+
+def main(args):
+    watch_checkpoints(args.save_dir, args.vocab_file, args.dev_prefix,
+                      tf_log_dir=args.log_dir, batch_size=args.batch_size,
+                      poll_secs=args.poll_secs, n_threads=args.n_threads)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Evaluate new checkpoints on a dev set while training')
+    parser.add_argument('--save_dir', help='Location of checkpoint files')
+    parser.add_argument('--vocab_file', help='Vocabulary file')
+    parser.add_argument('--dev_prefix', help='Prefix for the dev files')
+    parser.add_argument('--log_dir', default=None,
+        help='TensorBoard log directory, defaults to --save_dir')
+    parser.add_argument('--batch_size',
+        type=int, default=256,
+        help='Batch size')
+    parser.add_argument('--poll_secs', type=float, default=60,
+        help='Seconds between checks for a new checkpoint')
+    parser.add_argument('--n_threads', type=int, default=None,
+        help='Number of CPU threads for the evaluation')
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,34 @@
+
+import argparse
+
+from bilm.export import export_saved_model, export_frozen_graph
+
+
+def main(args):
+    kwargs = {
+        'use_character_inputs': args.embedding_weight_file is None,
+        'embedding_weight_file': args.embedding_weight_file,
+    }
+    if args.frozen:
+        export_frozen_graph(args.options_file, args.weight_file,
+                            args.outfile, **kwargs)
+    else:
+        export_saved_model(args.options_file, args.weight_file,
+                           args.outfile, **kwargs)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Export the biLM for serving')
+    parser.add_argument('--options_file', help='Options file')
+    parser.add_argument('--weight_file', help='hdf5 weight file')
+    parser.add_argument('--embedding_weight_file', default=None,
+        help='Token embeddings from dump_token_embeddings, to export a '
+             'model taking token ids instead of characters')
+    parser.add_argument('--outfile',
+        help='SavedModel directory, or GraphDef file with --frozen')
+    parser.add_argument('--frozen', action='store_true',
+        help='Write a frozen GraphDef instead of a SavedModel')
+
+    args = parser.parse_args()
+    main(args)
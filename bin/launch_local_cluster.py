@@ -0,0 +1,74 @@
+
+import sys
+import socket
+import argparse
+import subprocess
+
+
+def _free_ports(n):
+    # bind all the sockets before closing any so the ports are distinct
+    sockets = []
+    for _ in range(n):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.bind(('localhost', 0))
+        sockets.append(s)
+    ports = [s.getsockname()[1] for s in sockets]
+    for s in sockets:
+        s.close()
+    return ports
+
+
+def main(args, command):
+    ports = _free_ports(args.n_ps + args.n_workers)
+    ps_hosts = ','.join('localhost:%d' % p for p in ports[:args.n_ps])
+    worker_hosts = ','.join('localhost:%d' % p for p in ports[args.n_ps:])
+    print("ps: %s" % ps_hosts)
+    print("workers: %s" % worker_hosts)
+
+    def launch(job_name, task_index):
+        cmd = command + [
+            '--ps_hosts', ps_hosts,
+            '--worker_hosts', worker_hosts,
+            '--job_name', job_name,
+            '--task_index', str(task_index),
+        ]
+        return subprocess.Popen(cmd)
+
+    ps = [launch('ps', k) for k in range(args.n_ps)]
+    workers = [launch('worker', k) for k in range(args.n_workers)]
+
+    returncode = 0
+    try:
+        for p in workers:
+            returncode = p.wait() or returncode
+    finally:
+        # the parameter servers serve forever
+        for p in ps + workers:
+            if p.poll() is None:
+                p.terminate()
+        for p in ps + workers:
+            p.wait()
+
+    return returncode
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Run a training script as a cluster of local processes, '
+                    'e.g. launch_local_cluster.py --n_workers 2 -- '
+                    'python bin/train_elmo.py --save_dir ...')
+    parser.add_argument('--n_ps', type=int, default=1,
+                        help='Number of parameter servers.')
+    parser.add_argument('--n_workers', type=int, default=2,
+                        help='Number of workers.')
+    parser.add_argument('command', nargs=argparse.REMAINDER,
+                        help='Training command, the cluster flags are '
+                             'appended to it.')
+
+    args = parser.parse_args()
+    command = args.command
+    if command and command[0] == '--':
+        command = command[1:]
+    if not command:
+        parser.error('missing training command')
+    sys.exit(main(args, command))
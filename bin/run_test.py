@@ -2,11 +2,18 @@
 import argparse
 
 from bilm.training import test, load_options_latest_checkpoint, load_vocab
-from bilm.data import LMDataset, BidirectionalLMDataset, MultidirectionalLMDataset
+from bilm.evaluation import parallel_test, load_test_data
 
 def main(args):
     options, ckpt_file = load_options_latest_checkpoint(args.save_dir)
 
+    if args.n_workers > 1 or args.report is not None:
+        # split the test shards across worker processes
+        parallel_test(options, ckpt_file, args.vocab_file, args.test_prefix,
+                      n_workers=args.n_workers, batch_size=args.batch_size,
+                      n_gpus=args.n_gpus, outfile=args.report)
+        return
+
     # load the vocab
     if 'char_cnn' in options:
         max_word_length = options['char_cnn']['max_characters_per_token']
@@ -14,23 +21,9 @@ def main(args):
         max_word_length = None
     vocab = load_vocab(args.vocab_file, max_word_length)
 
-    test_prefix = args.test_prefix
-
-    kwargs = {
-        'test': True,
-        'shuffle_on_load': False,
-    }
-
-    permute_number = options.get('permute_number', 4)
+    data = load_test_data(options, vocab, args.test_prefix)
 
-    if options.get('bidirectional'):
-        data = BidirectionalLMDataset(test_prefix, vocab, **kwargs)
-    elif options.get('multidirectional'):
-        data = MultidirectionalLMDataset(test_prefix, vocab, permute_number, **kwargs)
-    else:
-        data = LMDataset(test_prefix, vocab, **kwargs)
-
-    test(options, ckpt_file, data, batch_size=args.batch_siz, permute_number=permute_number)
+    test(options, ckpt_file, data, batch_size=args.batch_size)
 
 
 if __name__ == '__main__':
@@ -41,7 +34,12 @@ if __name__ == '__main__':
     parser.add_argument('--batch_size',
         type=int, default=256,
         help='Batch size')
+    parser.add_argument('--n_workers', type=int, default=1,
+        help='Number of processes to split the test shards across')
+    parser.add_argument('--n_gpus', type=int, default=0,
+        help='Number of GPUs shared by the workers, 0 to run on CPU')
+    parser.add_argument('--report', default=None,
+        help='Write a JSON report with per direction perplexity here')
 
     args = parser.parse_args()
     main(args)
-
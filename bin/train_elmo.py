@@ -3,11 +3,23 @@ import argparse
 
 import numpy as np
 
-from bilm.training import train, load_options_latest_checkpoint, load_vocab
+from bilm.training import train, load_options_latest_checkpoint, load_vocab, \
+    make_cluster, run_parameter_server
 from bilm.data import BidirectionalLMDataset
 
 
 def main(args):
+    cluster = None
+    task_index = 0
+    n_tasks = 1
+    if args.worker_hosts is not None:
+        cluster = make_cluster(args.ps_hosts, args.worker_hosts)
+        if args.job_name == 'ps':
+            run_parameter_server(cluster, args.task_index)
+            return
+        task_index = args.task_index
+        n_tasks = len(cluster['worker'])
+
     ckpt_file = None
     if os.path.exists(args.save_dir+'options.json'):
         options, ckpt_file = load_options_latest_checkpoint(args.save_dir)
@@ -59,12 +71,13 @@ def main(args):
     }
 
     prefix = args.train_prefix
-    data = BidirectionalLMDataset(prefix, vocab, test=False, shuffle_on_load=True)
+    data = BidirectionalLMDataset(prefix, vocab, test=False, shuffle_on_load=True,
+                                  task_index=task_index, n_tasks=n_tasks)
 
     tf_save_dir = args.save_dir
     tf_log_dir = args.save_dir
     train(options, data, n_gpus, tf_save_dir, tf_log_dir,
-          restart_ckpt_file=ckpt_file)
+          restart_ckpt_file=ckpt_file, cluster=cluster, task_index=task_index)
     # if ckpt_file exists, reload to train
 
 
@@ -74,6 +87,11 @@ if __name__ == '__main__':
     parser.add_argument('--vocab_file', help='Vocabulary file')
     parser.add_argument('--train_prefix', help='Prefix for train files')
     parser.add_argument('--n_gpus', type=int, default=4, help='Number of gpu cards.')
+    parser.add_argument('--ps_hosts', help='Comma separated host:port of the parameter servers')
+    parser.add_argument('--worker_hosts', help='Comma separated host:port of the workers')
+    parser.add_argument('--job_name', default='worker', choices=['ps', 'worker'],
+                        help='Role of this process in the cluster')
+    parser.add_argument('--task_index', type=int, default=0, help='Index of the task within its job')
 
     args = parser.parse_args()
     main(args)
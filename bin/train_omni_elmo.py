@@ -3,11 +3,24 @@ import argparse
 
 import numpy as np
 
-from bilm.training import train, load_options_latest_checkpoint, load_vocab
+from bilm.training import train, load_options_latest_checkpoint, load_vocab, \
+    make_cluster, run_parameter_server
 from bilm.data import BidirectionalLMDataset, MultidirectionalLMDataset
+from bilm.directions import direction_names
 
 
 def main(args):
+    cluster = None
+    task_index = 0
+    n_tasks = 1
+    if args.worker_hosts is not None:
+        cluster = make_cluster(args.ps_hosts, args.worker_hosts)
+        if args.job_name == 'ps':
+            run_parameter_server(cluster, args.task_index)
+            return
+        task_index = args.task_index
+        n_tasks = len(cluster['worker'])
+
     ckpt_file = None
     if os.path.exists(args.save_dir+'options.json'):
         options, ckpt_file = load_options_latest_checkpoint(args.save_dir)
@@ -19,6 +32,10 @@ def main(args):
     batch_size = 128  # batch size for each GPU
     n_gpus = args.n_gpus
     permute_number = args.permute_number
+    if args.directions is not None:
+        directions = args.directions.split(',')
+    else:
+        directions = direction_names(True, True, permute_number)
 
     # number of tokens in training data (this for 1B Word Benchmark)
     n_train_tokens = 768648884
@@ -27,6 +44,7 @@ def main(args):
      'bidirectional': True,
      'multidirectional': True,
      'permute_number': permute_number,
+     'directions': directions,
 
      'char_cnn': {'activation': 'relu',
       'embedding': {'dim': 16},
@@ -63,12 +81,14 @@ def main(args):
 
     prefix = args.train_prefix
     data = MultidirectionalLMDataset(prefix, vocab, permute_number, test=False,
-                                     shuffle_on_load=True)
+                                     shuffle_on_load=True,
+                                     directions=directions,
+                                     task_index=task_index, n_tasks=n_tasks)
 
     tf_save_dir = args.save_dir
     tf_log_dir = args.save_dir
     train(options, data, n_gpus, tf_save_dir, tf_log_dir, permute_number,
-          restart_ckpt_file=ckpt_file)
+          restart_ckpt_file=ckpt_file, cluster=cluster, task_index=task_index)
     # if ckpt_file exists, reload to train
 
 
@@ -79,8 +99,16 @@ if __name__ == '__main__':
     parser.add_argument('--train_prefix', help='Prefix for train files')
     parser.add_argument('--n_gpus', type=int, default=4, help='Number of gpu cards.')
     parser.add_argument('--permute_number', type=int, default=4, help='Number of permutations.')
+    parser.add_argument('--directions', default=None,
+                        help='Comma separated directions to train, e.g. forward,backward,inward '
+                             '(overrides --permute_number)')
     parser.add_argument('--dim', type=int, default=2048, help='Input dimension.')
     parser.add_argument('--projection_dim', type=int, default=256, help='Hidden dimension.')
+    parser.add_argument('--ps_hosts', help='Comma separated host:port of the parameter servers')
+    parser.add_argument('--worker_hosts', help='Comma separated host:port of the workers')
+    parser.add_argument('--job_name', default='worker', choices=['ps', 'worker'],
+                        help='Role of this process in the cluster')
+    parser.add_argument('--task_index', type=int, default=0, help='Index of the task within its job')
 
     args = parser.parse_args()
     main(args)
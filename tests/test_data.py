@@ -362,6 +362,48 @@ class TestLMDataset(unittest.TestCase):
                 expected = self._expected(a1, a2, True)
             self._compare(expected, batches)
 
+    def test_lm_dataset_flush(self):
+        vocab = Vocabulary(self._tmp_vocab)
+
+        def n_targets(flush):
+            data = LMDataset(self._tmp_train, vocab, test=True)
+            batches = list(data.iter_batches(2, 3, flush=flush))
+            if flush:
+                for X in batches:
+                    self.assertTrue(np.all(
+                        X['next_token_id'][X['next_token_weights'] == 0] == 0))
+                return int(sum(X['next_token_weights'].sum()
+                               for X in batches))
+            return sum(X['next_token_id'].size for X in batches)
+
+        # 4 + 3 + 2 targets, the last incomplete batch is dropped
+        # unless flushing
+        self.assertEqual(n_targets(True), 9)
+        self.assertEqual(n_targets(False), 6)
+
+    def test_lm_dataset_task_shards(self):
+        tmp_dir = tempfile.mkdtemp()
+        for k in range(5):
+            with open(os.path.join(tmp_dir, 'shard_%s.txt' % k), 'w') as fout:
+                fout.write('the .')
+        vocab = Vocabulary(self._tmp_vocab)
+        filepattern = os.path.join(tmp_dir, 'shard_*.txt')
+
+        # every shard is used by exactly one of the tasks
+        shards = []
+        for task_index in range(2):
+            data = LMDataset(filepattern, vocab,
+                             task_index=task_index, n_tasks=2)
+            shards.append(data._all_shards)
+        self.assertEqual(len(shards[0]), 3)
+        self.assertEqual(len(shards[1]), 2)
+        self.assertEqual(sorted(shards[0] + shards[1]),
+                         sorted(LMDataset(filepattern, vocab)._all_shards))
+
+        for k in range(5):
+            os.remove(os.path.join(tmp_dir, 'shard_%s.txt' % k))
+        os.rmdir(tmp_dir)
+
 
 if __name__ == '__main__':
     unittest.main()
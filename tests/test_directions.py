@@ -0,0 +1,57 @@
+
+import unittest
+
+from bilm.directions import DIRECTIONS, Direction, get_direction, \
+    get_directions, register_direction
+
+
+class TestDirections(unittest.TestCase):
+    def test_permutations(self):
+        tokens = [1, 2, 3, 4, 5, 6]
+        expected = {
+            'forward': [1, 2, 3, 4, 5, 6],
+            'backward': [6, 5, 4, 3, 2, 1],
+            'inward': [1, 6, 2, 5, 3, 4],
+            'outward': [4, 3, 5, 2, 6, 1],
+            'skip2forward': [1, 3, 5, 2, 4, 6],
+            'skip2backward': [6, 4, 2, 5, 3, 1],
+            'skip3forward': [1, 4, 2, 5, 3, 6],
+            'skip3backward': [6, 3, 5, 2, 4, 1],
+        }
+        for name, permuted in expected.items():
+            self.assertEqual(get_direction(name).permute(tokens), permuted)
+
+    def test_get_directions(self):
+        def names(options, permute_number=None):
+            return [d.name for d in get_directions(options, permute_number)]
+
+        self.assertEqual(names({}), ['forward'])
+        self.assertEqual(names({'bidirectional': True}),
+                         ['forward', 'backward'])
+        self.assertEqual(
+            names({'bidirectional': True, 'multidirectional': True}),
+            ['forward', 'backward', 'inward', 'outward'])
+        self.assertEqual(
+            names({'bidirectional': True, 'multidirectional': True}, 6),
+            ['forward', 'backward', 'inward', 'outward',
+             'skip2forward', 'skip2backward'])
+        # an explicit subset takes precedence over the flags
+        self.assertEqual(
+            names({'bidirectional': True, 'directions': ['forward', 'inward']}),
+            ['forward', 'inward'])
+
+        with self.assertRaises(ValueError):
+            get_directions({'directions': ['sideways']})
+
+    def test_register_direction(self):
+        with self.assertRaises(ValueError):
+            register_direction(Direction(
+                'forward', '', 'bos', 'eos', 'RNN_0', list))
+        self.assertEqual(
+            len(set(d.suffix for d in DIRECTIONS.values())), len(DIRECTIONS))
+        self.assertEqual(
+            len(set(d.scope for d in DIRECTIONS.values())), len(DIRECTIONS))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,182 @@
+
+import unittest
+import os
+import glob
+import json
+import shutil
+import tempfile
+
+import tensorflow as tf
+import numpy as np
+
+from bilm.training import train, load_vocab, load_options_latest_checkpoint
+from bilm.data import BidirectionalLMDataset
+from bilm.evaluation import merge_stats, parallel_test, _assign_shards, \
+    watch_checkpoints
+
+FIXTURES = 'tests/fixtures/train/'
+
+
+class TestMergeStats(unittest.TestCase):
+    def test_merge_stats(self):
+        shard_stats = [
+            {'n_tokens': 10,
+             'total_loss': {'forward': 20.0, 'backward': 10.0}},
+            {'n_tokens': 30,
+             'total_loss': {'forward': 60.0, 'backward': 50.0}},
+        ]
+        report = merge_stats(shard_stats)
+        self.assertEqual(report['n_tokens'], 40)
+        self.assertAlmostEqual(
+            report['directions']['forward']['perplexity'], np.exp(2.0))
+        self.assertAlmostEqual(
+            report['directions']['backward']['perplexity'], np.exp(1.5))
+        self.assertAlmostEqual(report['perplexity'], np.exp(1.75))
+
+    def test_assign_shards(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            shards = []
+            for k, size in enumerate([5, 40, 10, 30]):
+                fname = os.path.join(tmp_dir, 'shard_%s.txt' % k)
+                with open(fname, 'w') as fout:
+                    fout.write('x' * size)
+                shards.append(fname)
+            assignments = _assign_shards(shards, 2)
+            self.assertEqual(len(assignments), 2)
+            self.assertEqual(
+                sorted(s for a in assignments for s in a), sorted(shards))
+            self.assertEqual(
+                sorted(sorted(a) for a in assignments),
+                sorted([sorted([shards[1], shards[0]]),
+                        sorted([shards[3], shards[2]])]))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+class TestParallelTest(unittest.TestCase):
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        tf.reset_default_graph()
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def test_parallel_test(self):
+        vocab_file = os.path.join(FIXTURES, 'vocab.txt')
+        vocab = load_vocab(vocab_file, None)
+        data = BidirectionalLMDataset(
+            os.path.join(FIXTURES, 'data.txt'), vocab)
+        options = {
+            'n_tokens_vocab': vocab.size,
+            'n_negative_samples_batch': 16,
+            'n_train_tokens': 134,
+            'batch_size': 2,
+            'unroll_steps': 10,
+            'n_epochs': 50,
+            'all_clip_norm_val': 1.0,
+            'dropout': 0.1,
+            'lstm': {'dim': 16, 'projection_dim': 8, 'n_layers': 2},
+            'bidirectional': True,
+        }
+        save_dir = os.path.join(self.tmp_dir, 'model')
+        os.mkdir(save_dir)
+        train(options, data, 1, save_dir, save_dir)
+        tf.reset_default_graph()
+
+        # split the data into two shards
+        with open(os.path.join(FIXTURES, 'data.txt')) as fin:
+            lines = fin.readlines()
+        for k in range(2):
+            fname = os.path.join(self.tmp_dir, 'test_%s.txt' % k)
+            with open(fname, 'w') as fout:
+                fout.write(''.join(lines[k::2]))
+
+        options, ckpt_file = load_options_latest_checkpoint(save_dir)
+        outfile = os.path.join(self.tmp_dir, 'report.json')
+        report = parallel_test(
+            options, ckpt_file, vocab_file,
+            os.path.join(self.tmp_dir, 'test_*.txt'),
+            n_workers=2, batch_size=1, outfile=outfile)
+
+        self.assertEqual(report['n_workers'], 2)
+        self.assertEqual(len(report['shards']), 2)
+        self.assertEqual(
+            report['n_tokens'], sum(s['n_tokens'] for s in report['shards']))
+        self.assertEqual(
+            sorted(report['directions'].keys()), ['backward', 'forward'])
+        self.assertTrue(report['perplexity'] < 20.0)
+
+        with open(outfile) as fin:
+            self.assertEqual(json.load(fin)['n_tokens'], report['n_tokens'])
+
+        # the final batches are flushed, so every target is scored once
+        # whatever the number of workers
+        n_targets = sum(len(line.split()) + 1 for line in lines)
+        self.assertEqual(report['n_tokens'], n_targets)
+        report_one_worker = parallel_test(
+            options, ckpt_file, vocab_file,
+            os.path.join(self.tmp_dir, 'test_*.txt'),
+            n_workers=1, batch_size=3)
+        self.assertEqual(report_one_worker['n_workers'], 1)
+        self.assertEqual(report_one_worker['n_tokens'], report['n_tokens'])
+
+
+
+class TestWatchCheckpoints(unittest.TestCase):
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        tf.reset_default_graph()
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def test_watch_checkpoints(self):
+        vocab_file = os.path.join(FIXTURES, 'vocab.txt')
+        vocab = load_vocab(vocab_file, None)
+        data = BidirectionalLMDataset(
+            os.path.join(FIXTURES, 'data.txt'), vocab)
+        options = {
+            'n_tokens_vocab': vocab.size,
+            'n_negative_samples_batch': 16,
+            'n_train_tokens': 134,
+            'batch_size': 2,
+            'unroll_steps': 10,
+            'n_epochs': 5,
+            'all_clip_norm_val': 1.0,
+            'dropout': 0.1,
+            'lstm': {'dim': 16, 'projection_dim': 8, 'n_layers': 2},
+            'bidirectional': True,
+        }
+        save_dir = os.path.join(self.tmp_dir, 'model')
+        log_dir = os.path.join(self.tmp_dir, 'log')
+        os.mkdir(save_dir)
+        os.mkdir(log_dir)
+        train(options, data, 1, save_dir, save_dir)
+        tf.reset_default_graph()
+
+        reports = watch_checkpoints(
+            save_dir, vocab_file, os.path.join(FIXTURES, 'data.txt'),
+            tf_log_dir=log_dir, batch_size=1, poll_secs=0.1, max_evals=1)
+
+        # the latest checkpoint is evaluated
+        self.assertEqual(len(reports), 1)
+        self.assertEqual(reports[0]['global_step'], 30)
+        self.assertEqual(
+            sorted(reports[0]['directions'].keys()), ['backward', 'forward'])
+
+        events = glob.glob(os.path.join(log_dir, 'events.*'))
+        tags = {}
+        for e in tf.train.summary_iterator(events[0]):
+            for v in e.summary.value:
+                tags[v.tag] = e.step
+        self.assertEqual(tags, {'dev_perplexity': 30,
+                                'dev_perplexity/backward': 30,
+                                'dev_perplexity/forward': 30})
+
+        with open(os.path.join(log_dir, 'dev_perplexity.jsonl')) as fin:
+            self.assertEqual(json.loads(fin.readline())['global_step'], 30)
+
+
+if __name__ == '__main__':
+    unittest.main()
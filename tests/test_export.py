@@ -0,0 +1,84 @@
+
+import unittest
+import os
+import json
+import shutil
+import tempfile
+
+import numpy as np
+import tensorflow as tf
+
+from bilm.model import BidirectionalLanguageModel
+from bilm.data import Batcher
+from bilm.export import export_saved_model, export_frozen_graph, \
+    load_saved_model, load_frozen_graph
+
+FIXTURES = 'tests/fixtures/model/'
+
+
+class TestExport(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.options_file = os.path.join(FIXTURES, 'options.json')
+        self.weight_file = os.path.join(FIXTURES, 'lm_weights.hdf5')
+
+        with open(os.path.join(FIXTURES,
+                               'lm_embeddings_sentences.json')) as fin:
+            sentences = json.load(fin)
+        batcher = Batcher(os.path.join(FIXTURES, 'vocab_test.txt'), 50)
+        self.X = batcher.batch_sentences(
+            [sentence.strip().split() for sentence in sentences[0][:3]])
+
+        # the embeddings from the python model
+        with tf.Graph().as_default():
+            character_ids = tf.placeholder('int32', (None, None, 50))
+            model = BidirectionalLanguageModel(
+                self.options_file, self.weight_file, stateless=True)
+            ops = model(character_ids)
+            with tf.Session() as sess:
+                sess.run(tf.global_variables_initializer())
+                self.expected = sess.run(
+                    {k: ops[k] for k in ['lm_embeddings', 'mask', 'lengths']},
+                    feed_dict={character_ids: self.X})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _check(self, sess, ids_placeholder, outputs):
+        actual = sess.run(outputs, feed_dict={ids_placeholder: self.X})
+        self.assertEqual(sorted(actual.keys()),
+                         ['lengths', 'lm_embeddings', 'mask'])
+        self.assertTrue(np.array_equal(actual['lengths'],
+                                       self.expected['lengths']))
+        self.assertTrue(np.array_equal(actual['mask'], self.expected['mask']))
+        self.assertTrue(np.allclose(actual['lm_embeddings'],
+                                    self.expected['lm_embeddings'],
+                                    atol=1e-5))
+
+    def test_saved_model(self):
+        export_dir = os.path.join(self.tmp_dir, 'saved_model')
+        export_saved_model(self.options_file, self.weight_file, export_dir)
+
+        with tf.Graph().as_default():
+            with tf.Session() as sess:
+                ids_placeholder, outputs = load_saved_model(sess, export_dir)
+                self.assertEqual(ids_placeholder.op.name, 'character_ids')
+                self._check(sess, ids_placeholder, outputs)
+
+    def test_frozen_graph(self):
+        outfile = os.path.join(self.tmp_dir, 'bilm.pb')
+        export_frozen_graph(self.options_file, self.weight_file, outfile)
+
+        with tf.Graph().as_default():
+            ids_placeholder, outputs = load_frozen_graph(outfile)
+            graph = tf.get_default_graph()
+            op_types = set(op.type for op in graph.get_operations())
+            # no variables, initializers or state updates
+            for op_type in ['VariableV2', 'Assign', 'PyFunc']:
+                self.assertFalse(op_type in op_types)
+            with tf.Session() as sess:
+                self._check(sess, ids_placeholder, outputs)
+
+
+if __name__ == '__main__':
+    unittest.main()
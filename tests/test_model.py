@@ -5,12 +5,17 @@ import json
 import h5py
 import tempfile
 import shutil
+import threading
 
 import numpy as np
 import tensorflow as tf
 
-from bilm.model import BidirectionalLanguageModel, dump_token_embeddings
-from bilm.data import Batcher, TokenBatcher
+from bilm.model import BidirectionalLanguageModel, DocumentEmbedder, \
+    dump_token_embeddings, dump_bilm_embeddings, load_bilm_embeddings, \
+    _permuted_positions
+from bilm.data import Batcher, TokenBatcher, HybridBatcher, \
+    UnicodeCharsVocabulary
+from bilm.directions import DIRECTIONS
 
 FIXTURES = 'tests/fixtures/model/'
 
@@ -130,6 +135,171 @@ class TestBidirectionalLanguageModel(unittest.TestCase):
                     k += 1
 
 
+    def test_weights_not_in_graph_def(self):
+        options_file = os.path.join(FIXTURES, 'options.json')
+        weight_file = os.path.join(FIXTURES, 'lm_weights.hdf5')
+        character_ids = tf.placeholder('int32', (None, None, 50))
+        model = BidirectionalLanguageModel(options_file, weight_file,
+            max_batch_size=4)
+        model(character_ids)
+
+        # the weights are read from the file when initializing, not
+        # stored as constants
+        for node in tf.get_default_graph().as_graph_def().node:
+            if node.op == 'Const':
+                self.assertTrue(node.ByteSize() < 1024)
+
+        self.sess.run(tf.global_variables_initializer())
+        with h5py.File(weight_file, 'r') as fin:
+            expected = fin['CNN_high_0/W_carry'][...]
+            expected_char_embed = fin['char_embed'][...]
+        with tf.variable_scope('', reuse=True):
+            W_carry = tf.get_variable('bilm/CNN_high_0/W_carry')
+            char_embed = tf.get_variable('bilm/char_embed')
+        W_carry, char_embed = self.sess.run([W_carry, char_embed])
+        self.assertTrue(np.array_equal(W_carry, expected))
+        self.assertTrue(np.all(char_embed[0] == 0.0))
+        self.assertTrue(np.array_equal(char_embed[1:], expected_char_embed))
+
+
+    def test_bilm_stateless(self):
+        sentences, _ = _load_sentences_embeddings()
+        vocab_file = os.path.join(FIXTURES, 'vocab_test.txt')
+        batcher = Batcher(vocab_file, 50)
+        options_file = os.path.join(FIXTURES, 'options.json')
+        weight_file = os.path.join(FIXTURES, 'lm_weights.hdf5')
+        character_ids = tf.placeholder('int32', (None, None, 50))
+        model = BidirectionalLanguageModel(options_file, weight_file,
+            max_batch_size=2, stateless=True)
+        ops = model(character_ids)
+        self.sess.run(tf.global_variables_initializer())
+
+        # no state variables, and the only assign ops initialize the weights
+        for v in tf.global_variables():
+            self.assertFalse(v.op.name.split('/')[-1].startswith('Variable'))
+        n_assign = sum(op.type == 'Assign'
+                       for op in tf.get_default_graph().get_operations())
+        self.assertEqual(n_assign, len(tf.global_variables()))
+
+        # larger than max_batch_size
+        batch = [sentence.strip().split() for sentence in sentences[0][:5]]
+        X = batcher.batch_sentences(batch)
+        first = self.sess.run(ops['lm_embeddings'],
+                              feed_dict={character_ids: X})
+        self.assertEqual(first.shape[0], 5)
+
+        # the outputs don't depend on the previous batches, or on the other
+        # sentences in the batch
+        second = self.sess.run(ops['lm_embeddings'],
+                               feed_dict={character_ids: X})
+        self.assertTrue(np.allclose(first, second, atol=1e-6))
+        one = self.sess.run(ops['lm_embeddings'],
+                            feed_dict={character_ids: X[2:3]})
+        length = len(batch[2])
+        self.assertTrue(np.allclose(
+            first[2, :, :length], one[0, :, :length], atol=1e-5))
+
+        # run concurrently from several threads
+        results = [None] * 4
+
+        def run(k):
+            results[k] = self.sess.run(ops['lm_embeddings'],
+                                       feed_dict={character_ids: X})
+
+        threads = [threading.Thread(target=run, args=(k, ))
+                   for k in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        for result in results:
+            self.assertTrue(np.allclose(result, first, atol=1e-6))
+
+    def test_bilm_output_layers(self):
+        sentences, _ = _load_sentences_embeddings()
+        batcher = Batcher(os.path.join(FIXTURES, 'vocab_test.txt'), 50)
+        options_file = os.path.join(FIXTURES, 'options.json')
+        weight_file = os.path.join(FIXTURES, 'lm_weights.hdf5')
+        character_ids = tf.placeholder('int32', (None, None, 50))
+        model = BidirectionalLanguageModel(
+            options_file, weight_file, stateless=True)
+        ops = model(character_ids)
+        with tf.variable_scope('', reuse=True):
+            top_model = BidirectionalLanguageModel(
+                options_file, weight_file, stateless=True,
+                output_layers=[0, 2])
+            top_ops = top_model(character_ids)
+        self.sess.run(tf.global_variables_initializer())
+
+        batch = [sentence.strip().split() for sentence in sentences[1][:4]]
+        X = batcher.batch_sentences(batch)
+        lm_embeddings, lm_layers, mask, top = self.sess.run(
+            [ops['lm_embeddings'], ops['lm_layers'], ops['mask'],
+             top_ops['lm_embeddings']],
+            feed_dict={character_ids: X})
+
+        self.assertEqual(lm_embeddings.shape, (4, 3, X.shape[1] - 2, 32))
+        for i in range(3):
+            self.assertTrue(np.array_equal(lm_layers[i], lm_embeddings[:, i]))
+        self.assertTrue(np.allclose(top, lm_embeddings[:, [0, 2]], atol=1e-6))
+
+        # the token layer is the token embedding for both directions
+        self.assertTrue(np.array_equal(lm_embeddings[:, 0, :, :16],
+                                       lm_embeddings[:, 0, :, 16:]))
+        self.assertEqual(mask.sum(axis=1).tolist(),
+                         [len(sentence) for sentence in batch])
+
+
+class TestDocumentEmbedder(unittest.TestCase):
+    def tearDown(self):
+        tf.reset_default_graph()
+
+    def test_windows_match_full_sequence(self):
+        sentences, _ = _load_sentences_embeddings()
+        documents = [
+            ' '.join(sentences[0][:4]).split(),
+            sentences[1][0].split(),
+            ' '.join(sentences[2][:2]).split(),
+        ]
+        vocab_file = os.path.join(FIXTURES, 'vocab_test.txt')
+        options_file = os.path.join(FIXTURES, 'options.json')
+        weight_file = os.path.join(FIXTURES, 'lm_weights.hdf5')
+        batcher = Batcher(vocab_file, 50)
+
+        # each document as a single sequence
+        expected = []
+        with tf.Graph().as_default():
+            character_ids = tf.placeholder('int32', (None, None, 50))
+            model = BidirectionalLanguageModel(
+                options_file, weight_file, stateless=True)
+            ops = model(character_ids)
+            with tf.Session() as sess:
+                sess.run(tf.global_variables_initializer())
+                for document in documents:
+                    expected.append(sess.run(
+                        ops['lm_embeddings'],
+                        feed_dict={character_ids: batcher.batch_sentences(
+                            [document])})[0])
+
+        # in windows of 7 tokens, two documents at a time
+        character_ids = tf.placeholder('int32', (None, None, 50))
+        model = BidirectionalLanguageModel(
+            options_file, weight_file, max_batch_size=2)
+        embedder = DocumentEmbedder(model, character_ids, batcher,
+                                    window_size=7)
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            actual = embedder(sess, documents)
+            # the states are reset for each call
+            again = embedder(sess, documents[:1])
+
+        self.assertEqual(len(actual), 3)
+        for k, document in enumerate(documents):
+            self.assertEqual(actual[k].shape, expected[k].shape)
+            self.assertTrue(np.allclose(actual[k], expected[k], atol=1e-5))
+        self.assertTrue(np.allclose(again[0], actual[0], atol=1e-6))
+
+
 class TestBidirectionalLanguageModelTokenInput(unittest.TestCase):
     def setUp(self):
         self.sess = tf.Session()
@@ -218,6 +388,318 @@ class TestBidirectionalLanguageModelTokenInput(unittest.TestCase):
                     )
                 )
 
+    def test_dump_token_embeddings_batched(self):
+        options_file = os.path.join(FIXTURES, 'options.json')
+        weight_file = os.path.join(FIXTURES, 'lm_weights.hdf5')
+        with open(options_file, 'r') as fin:
+            max_word_length = json.load(fin)['char_cnn'][
+                'max_characters_per_token']
+
+        vocab_file = os.path.join(self.tmp_dir, 'vocab_file.txt')
+        with open(vocab_file, 'w') as fout:
+            fout.write('\n'.join(['<S>', '</S>', 'the', 'cat', 'sat', '.']))
+
+        # uneven batches, and everything in one batch
+        embeddings = []
+        for k, (batch_size, timesteps) in enumerate([(2, 3), (64, 64)]):
+            outfile = os.path.join(self.tmp_dir, 'embeddings%s.hdf5' % k)
+            dump_token_embeddings(
+                vocab_file, options_file, weight_file, outfile,
+                batch_size=batch_size, timesteps=timesteps)
+            tf.reset_default_graph()
+            with h5py.File(outfile, 'r') as fin:
+                embeddings.append(fin['embedding'][...])
+        self.assertTrue(np.allclose(embeddings[0], embeddings[1], atol=1e-6))
+
+        # every token, including the boundary tokens, matches the
+        # character model
+        vocab = UnicodeCharsVocabulary(vocab_file, max_word_length)
+        self.assertEqual(embeddings[0].shape[0], vocab.size)
+        self.assertTrue(vocab.size > 6)
+
+        char_ids = tf.placeholder('int32', (None, None, max_word_length))
+        model = BidirectionalLanguageModel(options_file, weight_file)
+        token_embeddings = model(char_ids)['token_embeddings']
+        self.sess.run(tf.global_variables_initializer())
+        n_characters = model._options['char_cnn']['n_characters']
+        for k in range(vocab.size):
+            X = vocab.word_char_ids[k:k + 1][None] + 1
+            if X.max() >= n_characters:
+                # a boundary token the model was trained without
+                self.assertTrue(np.all(embeddings[0][k] == 0.0))
+                continue
+            expected = self.sess.run(token_embeddings,
+                                     feed_dict={char_ids: X})
+            self.assertTrue(
+                np.allclose(embeddings[0][k], expected[0, 0], atol=1e-6))
+
+    def test_bilm_hybrid(self):
+        sentences, _ = _load_sentences_embeddings()
+        batch = [sentence.strip().split() for sentence in sentences[0][:3]]
+        batch[1].append('Qwertyuiopasdf')
+
+        options_file = os.path.join(FIXTURES, 'options.json')
+        weight_file = os.path.join(FIXTURES, 'lm_weights.hdf5')
+
+        # a vocabulary without the first token of each sentence
+        oov = set(sentence[0] for sentence in batch)
+        tokens = set(['<S>', '</S>', '<UNK>'])
+        for sentence in batch:
+            tokens.update(sentence)
+        vocab_file = os.path.join(self.tmp_dir, 'vocab_file.txt')
+        with open(vocab_file, 'w') as fout:
+            fout.write('\n'.join(sorted(tokens - oov - {'Qwertyuiopasdf'})))
+        embedding_weight_file = os.path.join(self.tmp_dir, 'embeddings.hdf5')
+        dump_token_embeddings(
+            vocab_file, options_file, weight_file, embedding_weight_file)
+        tf.reset_default_graph()
+        self.sess.close()
+        self.sess = tf.Session()
+
+        token_ids, char_ids = HybridBatcher(vocab_file, 50).batch_sentences(
+            batch)
+        self.assertEqual(int(np.sum(np.any(char_ids > 0, axis=2))),
+                         len(oov) + 1)
+
+        token_ids_placeholder = tf.placeholder('int32', (None, None))
+        char_ids_placeholder = tf.placeholder('int32', (None, None, 50))
+        model = BidirectionalLanguageModel(
+            options_file, weight_file, hybrid_inputs=True,
+            embedding_weight_file=embedding_weight_file, stateless=True)
+        ops = model((token_ids_placeholder, char_ids_placeholder))
+
+        self.sess.run(tf.global_variables_initializer())
+        lm_embeddings, lengths = self.sess.run(
+            [ops['lm_embeddings'], ops['lengths']],
+            feed_dict={token_ids_placeholder: token_ids,
+                       char_ids_placeholder: char_ids})
+
+        # the same embeddings as the character inputs
+        with tf.Graph().as_default():
+            character_ids = tf.placeholder('int32', (None, None, 50))
+            char_model = BidirectionalLanguageModel(
+                options_file, weight_file, stateless=True)
+            char_ops = char_model(character_ids)
+            with tf.Session() as sess:
+                sess.run(tf.global_variables_initializer())
+                expected = sess.run(
+                    char_ops['lm_embeddings'],
+                    feed_dict={character_ids: Batcher(
+                        vocab_file, 50).batch_sentences(batch)})
+        self.assertEqual(list(lengths), [len(sentence) for sentence in batch])
+        self.assertTrue(np.allclose(lm_embeddings, expected, atol=1e-5))
+
+
+
+def _write_omnidirectional_model(tmp_dir):
+    # the fixture biLM with two permuted directions that reuse the
+    # forward LSTM, and char embeddings for the boundary tokens,
+    # returns (options_file, weight_file)
+    with open(os.path.join(FIXTURES, 'options.json')) as fin:
+        options = json.load(fin)
+    options['char_cnn']['n_characters'] = 267
+    options['directions'] = [
+        'forward', 'backward', 'inward', 'skip3backward']
+    options_file = os.path.join(tmp_dir, 'omni_options.json')
+    with open(options_file, 'w') as fout:
+        json.dump(options, fout)
+
+    weight_file = os.path.join(tmp_dir, 'omni_lm_weights.hdf5')
+    with h5py.File(os.path.join(FIXTURES, 'lm_weights.hdf5'), 'r') as fin, \
+            h5py.File(weight_file, 'w') as fout:
+        def copy(name, obj):
+            if not isinstance(obj, h5py.Dataset):
+                return
+            values = obj[...]
+            if name == 'char_embed':
+                extra = np.random.RandomState(0).uniform(
+                    -1, 1, (266 - values.shape[0], values.shape[1]))
+                values = np.concatenate([values, extra], axis=0)
+            fout[name] = values
+            if name.startswith('RNN_0/'):
+                fout['RNN_2/' + name[6:]] = values
+                fout['RNN_7/' + name[6:]] = values
+        fin.visititems(copy)
+    return options_file, weight_file
+
+
+class TestDumpBilmEmbeddings(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        tf.reset_default_graph()
+        shutil.rmtree(self.tmp_dir)
+
+    def _dump(self, dataset_file, outfile, options_file=None,
+              weight_file=None, **kwargs):
+        dump_bilm_embeddings(
+            os.path.join(FIXTURES, 'vocab_test.txt'), dataset_file,
+            options_file or os.path.join(FIXTURES, 'options.json'),
+            weight_file or os.path.join(FIXTURES, 'lm_weights.hdf5'),
+            outfile, **kwargs)
+        tf.reset_default_graph()
+
+    def _stateless_embeddings(self, sentences, options_file=None,
+                              weight_file=None):
+        # the embeddings of each sentence from a zero LSTM state, as
+        # (n_tokens, n_layers, dim)
+        batcher = Batcher(os.path.join(FIXTURES, 'vocab_test.txt'), 50)
+        with tf.Graph().as_default():
+            character_ids = tf.placeholder('int32', (None, None, 50))
+            model = BidirectionalLanguageModel(
+                options_file or os.path.join(FIXTURES, 'options.json'),
+                weight_file or os.path.join(FIXTURES, 'lm_weights.hdf5'),
+                stateless=True)
+            ops = model(character_ids)
+            with tf.Session() as sess:
+                sess.run(tf.global_variables_initializer())
+                return [
+                    sess.run(ops['lm_embeddings'], feed_dict={
+                        character_ids: batcher.batch_sentences([sentence])
+                    })[0].transpose(1, 0, 2)
+                    for sentence in sentences]
+
+    def test_dump_contiguous(self):
+        sentences, _ = _load_sentences_embeddings()
+        sentences = [sentence.strip().split() for sentence in sentences[0]]
+        # an empty line is an empty sentence
+        sentences.insert(3, [])
+        dataset_file = os.path.join(self.tmp_dir, 'dataset.txt')
+        with open(dataset_file, 'w') as fout:
+            fout.write('\n'.join(' '.join(s) for s in sentences) + '\n')
+
+        # every sentence starts from a zero LSTM state, so the batches
+        # give the embeddings of a fresh stateless model
+        expected = self._stateless_embeddings(sentences)
+        contiguous_file = os.path.join(self.tmp_dir, 'contiguous.hdf5')
+        self._dump(dataset_file, contiguous_file, contiguous=True,
+                   batch_size=4, bucket_window=2)
+
+        embeddings, offsets = load_bilm_embeddings(contiguous_file)
+        self.assertEqual(list(np.diff(offsets)),
+                         [len(s) for s in sentences])
+        self.assertEqual(embeddings.shape[0], offsets[-1])
+        for k in range(len(sentences)):
+            self.assertTrue(np.allclose(
+                embeddings[offsets[k]:offsets[k + 1]], expected[k],
+                atol=1e-5))
+
+        # so they don't depend on the batching, here stored as float16
+        batched_file = os.path.join(self.tmp_dir, 'batched.hdf5')
+        self._dump(dataset_file, batched_file, contiguous=True,
+                   batch_size=1, float16=True)
+        embeddings16, offsets16 = load_bilm_embeddings(batched_file)
+        self.assertEqual(embeddings16.dtype, np.float16)
+        self.assertEqual(list(offsets16), list(offsets))
+        self.assertEqual(embeddings16.shape, embeddings.shape)
+        self.assertTrue(np.allclose(embeddings16, embeddings,
+                                    rtol=1e-2, atol=1e-2))
+
+        # a model with four directions is twice as wide
+        options_file, weight_file = _write_omnidirectional_model(self.tmp_dir)
+        omni_expected = self._stateless_embeddings(
+            sentences, options_file=options_file, weight_file=weight_file)
+        omni_contiguous_file = os.path.join(self.tmp_dir, 'omni.hdf5')
+        self._dump(dataset_file, omni_contiguous_file,
+                   options_file=options_file, weight_file=weight_file,
+                   contiguous=True, batch_size=4, bucket_window=2)
+        omni_embeddings, omni_offsets = load_bilm_embeddings(
+            omni_contiguous_file)
+        self.assertEqual(list(omni_offsets), list(offsets))
+        self.assertEqual(omni_embeddings.shape,
+                         embeddings.shape[:2] + (2 * embeddings.shape[2], ))
+        for k in range(len(sentences)):
+            self.assertTrue(np.allclose(
+                omni_embeddings[omni_offsets[k]:omni_offsets[k + 1]],
+                omni_expected[k], atol=1e-5))
+
+
+class TestOmnidirectionalLanguageModel(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+        self.options_file, self.weight_file = \
+            _write_omnidirectional_model(self.tmp_dir)
+
+        sentences, _ = _load_sentences_embeddings()
+        self.batch = [sentence.strip().split()
+                      for sentence in sentences[0][:3]]
+        self.vocab = UnicodeCharsVocabulary(
+            os.path.join(FIXTURES, 'vocab_test.txt'), 50)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        tf.reset_default_graph()
+
+    def _run(self, options_file, X, weight_file=None):
+        with tf.Graph().as_default():
+            character_ids = tf.placeholder('int32', (None, None, 50))
+            model = BidirectionalLanguageModel(
+                options_file, weight_file or self.weight_file,
+                stateless=True)
+            ops = model(character_ids)
+            lm_graph = model._graphs[character_ids]
+            with tf.Session() as sess:
+                sess.run(tf.global_variables_initializer())
+                return sess.run(
+                    [ops['lm_embeddings'], lm_graph.lstm_outputs],
+                    feed_dict={character_ids: X})
+
+    def test_permuted_positions(self):
+        k = tf.placeholder('int32', (None, ))
+        n = tf.placeholder('int32', (None, ))
+        positions = {name: _permuted_positions(name, k, n)
+                     for name in DIRECTIONS}
+        with tf.Session() as sess:
+            for length in range(12):
+                actual = sess.run(positions, feed_dict={
+                    k: np.arange(length), n: np.full(length, length)})
+                for name, direction in DIRECTIONS.items():
+                    self.assertEqual(list(actual[name]),
+                                     direction.permute(list(range(length))))
+
+    def test_omnidirectional(self):
+        X = Batcher(os.path.join(FIXTURES, 'vocab_test.txt'), 50
+                    ).batch_sentences(self.batch)
+        lm_embeddings, lstm_outputs = self._run(self.options_file, X)
+        self.assertEqual(lm_embeddings.shape[1], 3)
+        self.assertEqual(lm_embeddings.shape[3], 4 * 16)
+
+        # the forward and backward layers are those of the biLM
+        bilm_embeddings, _ = self._run(
+            os.path.join(FIXTURES, 'options.json'), X,
+            weight_file=os.path.join(FIXTURES, 'lm_weights.hdf5'))
+        self.assertTrue(np.allclose(
+            lm_embeddings[..., :32], bilm_embeddings, atol=1e-6))
+
+        # the permuted directions are the forward LSTM run on the
+        # permuted sentences, with the outputs back at the token positions
+        forward_options = os.path.join(self.tmp_dir, 'forward.json')
+        with open(self.options_file) as fin:
+            options = json.load(fin)
+        options['directions'] = ['forward']
+        with open(forward_options, 'w') as fout:
+            json.dump(options, fout)
+
+        for name in ['inward', 'skip3backward']:
+            X_permuted = np.zeros(X.shape, dtype=np.int64)
+            for k, sentence in enumerate(self.batch):
+                X_permuted[k, :len(sentence) + 2] = self.vocab.encode_chars(
+                    DIRECTIONS[name].permute(sentence), permuted=name,
+                    split=False) + 1
+            _, expected = self._run(forward_options, X_permuted)
+
+            for k, sentence in enumerate(self.batch):
+                n = len(sentence)
+                order = [0] + [1 + p for p in
+                               DIRECTIONS[name].permute(list(range(n)))] + \
+                    [n + 1]
+                for i in range(2):
+                    self.assertTrue(np.allclose(
+                        lstm_outputs[name][i][k, order],
+                        expected['forward'][i][k, :n + 2], atol=1e-5))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,64 @@
+
+import unittest
+import os
+import json
+import shutil
+import tempfile
+
+import tensorflow as tf
+import numpy as np
+
+from bilm.monitor import StepMonitor
+
+
+class TestStepMonitor(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        tf.reset_default_graph()
+
+    def test_step_stats(self):
+        x = tf.placeholder(tf.float32, (3, ))
+        y = tf.reduce_sum(x * x)
+
+        log_file = os.path.join(self.tmp_dir, 'step_stats.jsonl')
+        summary_writer = tf.summary.FileWriter(self.tmp_dir)
+        monitor = StepMonitor(
+            log_file, ['forward', 'backward'], 10,
+            summary_writer=summary_writer, log_every=2, trace_every=3)
+
+        batches = [np.ones(3) * k for k in range(4)]
+        with tf.Session() as sess:
+            for step, batch in enumerate(monitor.timed(batches), start=1):
+                with monitor.time('feed_dict'):
+                    feed_dict = {x: batch}
+                with monitor.time('session_run'):
+                    sess.run(y, feed_dict=feed_dict,
+                             **monitor.run_kwargs(step))
+                monitor.end_step(step)
+        monitor.close()
+        summary_writer.close()
+
+        with open(log_file) as fin:
+            stats = [json.loads(line) for line in fin]
+        self.assertEqual([s['step'] for s in stats], [2, 4])
+        for s in stats:
+            for key in ['data_wait_secs', 'feed_dict_secs',
+                        'session_run_secs', 'checkpoint_secs', 'step_secs',
+                        'tokens_per_sec_forward', 'tokens_per_sec_backward',
+                        'host_rss_mb']:
+                self.assertTrue(s[key] >= 0)
+            self.assertEqual(s['checkpoint_secs'], 0)
+            self.assertTrue(s['host_rss_mb'] > 0)
+
+        # only step 3 was traced
+        self.assertTrue(
+            os.path.exists(os.path.join(self.tmp_dir, 'timeline_3.json')))
+        self.assertFalse(
+            os.path.exists(os.path.join(self.tmp_dir, 'timeline_2.json')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+
+import unittest
+import glob
+import os
+import shutil
+import tempfile
+
+import tensorflow as tf
+import numpy as np
+
+from bilm.summaries import variable_histograms, AsyncSummaryRunner
+
+
+class TestVariableHistograms(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        tf.reset_default_graph()
+
+    def test_allow_and_sample(self):
+        with tf.variable_scope('lm'):
+            softmax = tf.get_variable(
+                'softmax_W', initializer=np.ones((100, 4), dtype=np.float32))
+            bias = tf.get_variable(
+                'softmax_b', initializer=np.ones((100, ), dtype=np.float32))
+            tf.get_variable(
+                'lstm_W', initializer=np.ones((3, 3), dtype=np.float32))
+
+        summaries = variable_histograms(
+            tf.global_variables(), allow=['softmax'], max_rows=10)
+        self.assertEqual(len(summaries), 2)
+
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            counts = []
+            for summary in sess.run(summaries):
+                histo = tf.Summary.FromString(summary).value[0].histo
+                counts.append(histo.num)
+
+        # 10 sampled rows of the matrix, all of the vector
+        self.assertEqual(sorted(counts), [40, 100])
+
+    def test_async_runner(self):
+        v = tf.get_variable(
+            'v', initializer=np.arange(6, dtype=np.float32))
+        summary_op = tf.summary.merge(variable_histograms([v]))
+        summary_writer = tf.summary.FileWriter(self.tmp_dir)
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            runner = AsyncSummaryRunner(sess, summary_op, summary_writer)
+            self.assertTrue(runner.run(5))
+            runner.close()
+        summary_writer.close()
+
+        events = glob.glob(os.path.join(self.tmp_dir, 'events.*'))
+        steps = [e.step for e in tf.train.summary_iterator(events[0])
+                 if e.HasField('summary')]
+        self.assertEqual(steps, [5])
+
+
+if __name__ == '__main__':
+    unittest.main()
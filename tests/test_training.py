@@ -3,14 +3,19 @@
 import unittest
 import os
 import shutil
+import glob
+import socket
 import tempfile
 
 import tensorflow as tf
 import numpy as np
 
 from bilm.training import train, test, load_vocab, \
-                                load_options_latest_checkpoint
-from bilm.data import LMDataset, BidirectionalLMDataset
+                                load_options_latest_checkpoint, \
+                                GradientAccumulator, average_gradients, \
+                                LossScale
+from bilm.data import LMDataset, BidirectionalLMDataset, \
+    MultidirectionalLMDataset
 
 FIXTURES = 'tests/fixtures/train/'
 
@@ -99,6 +104,27 @@ class TestLanguageModel(unittest.TestCase):
         perplexity = test(options, ckpt_file, data_test, batch_size=1)
         self.assertTrue(perplexity < 20.0)
 
+    def test_train_direction_subset(self):
+        vocab, _, options = self._get_vocab_data_options(False, True)
+        options['directions'] = ['forward', 'inward']
+        prefix = os.path.join(FIXTURES, 'data.txt')
+        data = MultidirectionalLMDataset(
+            prefix, vocab, directions=options['directions'])
+        train(options, data, 1, self.tmp_dir, self.tmp_dir)
+
+        # one LSTM per direction, in the scope of the direction
+        lstm_scopes = set(v.name.split('/')[1]
+                          for v in tf.global_variables() if 'lstm' in v.name)
+        self.assertEqual(lstm_scopes, set(['RNN_0', 'RNN_2']))
+
+        # now test
+        tf.reset_default_graph()
+        options, ckpt_file = load_options_latest_checkpoint(self.tmp_dir)
+        data_test = MultidirectionalLMDataset(
+            prefix, vocab, directions=options['directions'], test=True)
+        perplexity = test(options, ckpt_file, data_test, batch_size=1)
+        self.assertTrue(perplexity < 20.0)
+
     def test_shared_variables(self):
         vocab, data, options = self._get_vocab_data_options(True, True)
         options['n_epochs'] = 1
@@ -146,6 +172,291 @@ class TestLanguageModel(unittest.TestCase):
         perplexity = test(options, ckpt_file, data_test, batch_size=1)
         self.assertTrue(perplexity < 20.0)
 
+    def test_train_async_checkpoint(self):
+        vocab, data, options = self._get_vocab_data_options(True, False)
+        options['async_checkpoint'] = True
+        options['save_every_batches'] = 10
+        train(options, data, 1, self.tmp_dir, self.tmp_dir)
+
+        # only the last two checkpoints are kept, with no temporary files
+        index_files = glob.glob(os.path.join(self.tmp_dir, '*.index'))
+        self.assertEqual(len(index_files), 2)
+        self.assertEqual(
+            glob.glob(os.path.join(self.tmp_dir, '.tmp_*')), [])
+
+        # now test
+        tf.reset_default_graph()
+        options, ckpt_file = load_options_latest_checkpoint(self.tmp_dir)
+        self.assertTrue(ckpt_file.endswith('model.ckpt-300'))
+        data_test, vocab_test = self._get_data(True, False, True)
+        perplexity = test(options, ckpt_file, data_test, batch_size=1)
+        self.assertTrue(perplexity < 20.0)
+
+    def test_train_grad_accumulation(self):
+        vocab, data, options = self._get_vocab_data_options(True, True)
+        options['grad_accum_steps'] = 2
+        train(options, data, 1, self.tmp_dir, self.tmp_dir)
+
+        # now test
+        tf.reset_default_graph()
+        options, ckpt_file = load_options_latest_checkpoint(self.tmp_dir)
+        # the optimizer only took a step every other batch
+        self.assertTrue(ckpt_file.endswith('model.ckpt-150'))
+        data_test, vocab_test = self._get_data(True, True, True)
+        perplexity = test(options, ckpt_file, data_test, batch_size=1)
+        self.assertTrue(perplexity < 20.0)
+
+    def test_train_grad_accumulation_partial_step(self):
+        vocab, data, options = self._get_vocab_data_options(True, False)
+        options['grad_accum_steps'] = 7
+        options['save_every_batches'] = 10
+        train(options, data, 1, self.tmp_dir, self.tmp_dir)
+
+        # the 300 batches are rounded up to 43 whole steps, and the
+        # checkpoints due at batches 290 and 300 wait for the steps at
+        # batches 294 and 301
+        options, ckpt_file = load_options_latest_checkpoint(self.tmp_dir)
+        self.assertTrue(ckpt_file.endswith('model.ckpt-43'))
+        steps = sorted(
+            int(index_file[:-len('.index')].split('-')[-1])
+            for index_file in glob.glob(
+                os.path.join(self.tmp_dir, 'model.ckpt-*.index')))
+        self.assertEqual(steps, [42, 43])
+
+    def test_train_bilm_chars_bfloat16(self):
+        vocab, data, options = self._get_vocab_data_options(True, True)
+        options['compute_dtype'] = 'bfloat16'
+        train(options, data, 1, self.tmp_dir, self.tmp_dir)
+
+        # the master weights are float32
+        for v in tf.global_variables():
+            self.assertNotEqual(v.dtype.base_dtype, tf.bfloat16)
+
+        # now test
+        tf.reset_default_graph()
+        options, ckpt_file = load_options_latest_checkpoint(self.tmp_dir)
+        data_test, vocab_test = self._get_data(True, True, True)
+        perplexity = test(options, ckpt_file, data_test, batch_size=1)
+        self.assertTrue(perplexity < 20.0)
+
+    def test_train_restart_imports_graph(self):
+        vocab, data, options = self._get_vocab_data_options(True, True)
+        options['n_epochs'] = 1
+        train(options, data, 1, self.tmp_dir, self.tmp_dir)
+        graph_files = glob.glob(os.path.join(self.tmp_dir, 'train_graph-*.meta'))
+        self.assertEqual(len(graph_files), 1)
+
+        # restart from the checkpoint with the same options, the graph
+        # is imported instead of built again
+        tf.reset_default_graph()
+        options, ckpt_file = load_options_latest_checkpoint(self.tmp_dir)
+        train(options, data, 1, self.tmp_dir, self.tmp_dir,
+              restart_ckpt_file=ckpt_file)
+        self.assertEqual(
+            glob.glob(os.path.join(self.tmp_dir, 'train_graph-*.meta')),
+            graph_files)
+        self.assertEqual(
+            len(tf.get_collection('train_graph/tower_0/tokens_characters')),
+            1)
+
+        # the global step continued from the restored checkpoint
+        options, ckpt_file = load_options_latest_checkpoint(self.tmp_dir)
+        self.assertTrue(ckpt_file.endswith('model.ckpt-12'))
+
+    def test_train_restart_more_epochs_imports_graph(self):
+        vocab, data, options = self._get_vocab_data_options(True, False)
+        options['n_epochs'] = 1
+        train(options, data, 1, self.tmp_dir, self.tmp_dir)
+        graph_files = glob.glob(os.path.join(self.tmp_dir, 'train_graph-*.meta'))
+        self.assertEqual(len(graph_files), 1)
+
+        # the training loop options don't change the graph
+        tf.reset_default_graph()
+        options, ckpt_file = load_options_latest_checkpoint(self.tmp_dir)
+        options['n_epochs'] = 2
+        options['n_train_tokens'] = 2 * options['n_train_tokens']
+        options['save_every_batches'] = 100
+        train(options, data, 1, self.tmp_dir, self.tmp_dir,
+              restart_ckpt_file=ckpt_file)
+        self.assertEqual(
+            glob.glob(os.path.join(self.tmp_dir, 'train_graph-*.meta')),
+            graph_files)
+        self.assertEqual(
+            len(tf.get_collection('train_graph/tower_0/token_ids')), 1)
+
+    def _train_cluster(self, n_ps, **extra_options):
+        # n_ps parameter servers in this process and a single worker
+        ports = []
+        for _ in range(n_ps + 1):
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            s.bind(('localhost', 0))
+            ports.append(s.getsockname()[1])
+            s.close()
+        cluster = {'ps': ['localhost:%d' % port for port in ports[:-1]],
+                   'worker': ['localhost:%d' % ports[-1]]}
+        ps_servers = [
+            tf.train.Server(
+                tf.train.ClusterSpec(cluster), job_name='ps', task_index=k)
+            for k in range(n_ps)]
+
+        vocab, data, options = self._get_vocab_data_options(True, False)
+        options.update(extra_options)
+        train(options, data, 1, self.tmp_dir, self.tmp_dir,
+              cluster=cluster, task_index=0)
+
+        # now test
+        tf.reset_default_graph()
+        options, ckpt_file = load_options_latest_checkpoint(self.tmp_dir)
+        data_test, vocab_test = self._get_data(True, False, True)
+        perplexity = test(options, ckpt_file, data_test, batch_size=1)
+        self.assertTrue(perplexity < 20.0)
+
+    def test_train_cluster(self):
+        self._train_cluster(1)
+
+    def test_train_cluster_partitioned_async_checkpoint(self):
+        # the embedding and softmax are partitioned across the two
+        # parameter servers, and saved as slices of the full variables
+        self._train_cluster(2, async_checkpoint=True)
+        options, ckpt_file = load_options_latest_checkpoint(self.tmp_dir)
+        names = [name for name, _ in
+                 tf.contrib.framework.list_variables(ckpt_file)]
+        self.assertTrue('lm/softmax/W' in names)
+        self.assertFalse(any('part_' in name for name in names))
+
+
+class TestGradientAccumulator(unittest.TestCase):
+    def tearDown(self):
+        tf.reset_default_graph()
+
+    def test_accumulate_dense_and_sparse(self):
+        dense_var = tf.Variable(np.zeros((2, 3), dtype=np.float32))
+        sparse_var = tf.Variable(np.zeros((5, 2), dtype=np.float32))
+
+        dense_grad = tf.placeholder(tf.float32, (2, 3))
+        sparse_indices = tf.placeholder(tf.int32, (None, ))
+        sparse_values = tf.placeholder(tf.float32, (None, 2))
+        sparse_grad = tf.IndexedSlices(
+            sparse_values, sparse_indices, dense_shape=[5, 2])
+
+        accumulator = GradientAccumulator(
+            [(dense_grad, dense_var), (sparse_grad, sparse_var)], 2)
+        grads = accumulator.accumulated_gradients()
+        with tf.control_dependencies([g for g, v in grads]):
+            reset_op = accumulator.reset_op()
+
+        batches = [
+            {dense_grad: np.ones((2, 3)),
+             sparse_indices: [1, 3, 1],
+             sparse_values: [[1, 2], [3, 4], [5, 6]]},
+            {dense_grad: 3 * np.ones((2, 3)),
+             sparse_indices: [3],
+             sparse_values: [[1, 1]]},
+        ]
+
+        with tf.Session() as sess:
+            sess.run(tf.local_variables_initializer())
+            sess.run(accumulator.accumulate_op, feed_dict=batches[0])
+            dense, sparse, _ = sess.run(
+                [grads[0][0], grads[1][0], reset_op], feed_dict=batches[1])
+
+            self.assertTrue(np.allclose(dense, 2 * np.ones((2, 3))))
+            rows = dict(zip(sparse.indices, sparse.values.tolist()))
+            self.assertEqual(sorted(rows.keys()), [1, 3])
+            self.assertTrue(np.allclose(rows[1], [3.0, 4.0]))
+            self.assertTrue(np.allclose(rows[3], [2.0, 2.5]))
+
+            # the buffers are empty again after the reset
+            for v in accumulator.variables:
+                self.assertEqual(np.abs(sess.run(v)).sum(), 0)
+
+
+class TestLossScale(unittest.TestCase):
+    def tearDown(self):
+        tf.reset_default_graph()
+
+    def test_dynamic_loss_scale(self):
+        var = tf.Variable(np.zeros((3, 2), dtype=np.float32))
+        dense_grad = tf.placeholder(tf.float32, (3, 2))
+        sparse_values = tf.placeholder(tf.float32, (2, 2))
+        sparse_grad = tf.IndexedSlices(
+            sparse_values, tf.constant([0, 2]), dense_shape=[3, 2])
+
+        loss_scale = LossScale(
+            initial_scale=8.0, increment_every=2, factor=2.0)
+        grads, finite = loss_scale.unscale_gradients(
+            [(dense_grad, var), (sparse_grad, var)])
+        with tf.control_dependencies([g for g, v in grads[:1]] +
+                                     [grads[1][0].values]):
+            update_op = loss_scale.update_op(finite)
+
+        fetches = [grads[0][0], grads[1][0].values, finite, update_op]
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+
+            # finite gradients are divided by the scale
+            dense, sparse, is_finite, _ = sess.run(fetches, feed_dict={
+                dense_grad: 8 * np.ones((3, 2)),
+                sparse_values: 16 * np.ones((2, 2))})
+            self.assertTrue(is_finite)
+            self.assertTrue(np.allclose(dense, np.ones((3, 2))))
+            self.assertTrue(np.allclose(sparse, 2 * np.ones((2, 2))))
+            self.assertEqual(sess.run(loss_scale.scale), 8.0)
+
+            # an overflow zeros the gradients and halves the scale
+            dense, sparse, is_finite, _ = sess.run(fetches, feed_dict={
+                dense_grad: np.ones((3, 2)),
+                sparse_values: [[np.inf, 1.0], [1.0, 1.0]]})
+            self.assertFalse(is_finite)
+            self.assertEqual(np.abs(dense).sum(), 0)
+            self.assertEqual(np.abs(sparse).sum(), 0)
+            self.assertEqual(sess.run(loss_scale.scale), 4.0)
+
+            # it grows again after increment_every finite steps
+            for _ in range(2):
+                sess.run(fetches, feed_dict={
+                    dense_grad: np.ones((3, 2)),
+                    sparse_values: np.ones((2, 2))})
+            self.assertEqual(sess.run(loss_scale.scale), 8.0)
+
+
+class TestAverageGradients(unittest.TestCase):
+    def tearDown(self):
+        tf.reset_default_graph()
+
+    def test_average_indexed_slices(self):
+        var = tf.Variable(np.zeros((6, 2), dtype=np.float32))
+        tower_indices = [[0, 3, 3, 5], [3, 1, 0, 0]]
+        tower_values = [np.arange(8, dtype=np.float32).reshape(4, 2),
+                        np.ones((4, 2), dtype=np.float32)]
+        tower_grads = [
+            [(tf.IndexedSlices(tf.constant(values), tf.constant(indices),
+                               dense_shape=[6, 2]), var)]
+            for indices, values in zip(tower_indices, tower_values)
+        ]
+
+        expected = np.zeros((6, 2))
+        for indices, values in zip(tower_indices, tower_values):
+            for i, value in zip(indices, values):
+                expected[i] += value / 2.0
+
+        sparse_grad = average_gradients(
+            tower_grads, 2, {'sparse_grad_dense_threshold': None})[0][0]
+        dense_grad = average_gradients(
+            tower_grads, 2, {'sparse_grad_dense_threshold': 0.5})[0][0]
+        self.assertTrue(isinstance(sparse_grad, tf.IndexedSlices))
+        self.assertFalse(isinstance(dense_grad, tf.IndexedSlices))
+
+        with tf.Session() as sess:
+            values, indices, dense = sess.run(
+                [sparse_grad.values, sparse_grad.indices, dense_grad])
+
+        self.assertEqual(sorted(indices), [0, 1, 3, 5])
+        actual = np.zeros((6, 2))
+        actual[indices] = values
+        self.assertTrue(np.allclose(actual, expected))
+        self.assertTrue(np.allclose(dense, expected))
+
 
 if __name__ == '__main__':
     unittest.main()